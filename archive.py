@@ -3,18 +3,31 @@ import discord
 import os
 import asyncio
 import datetime
+import logging
+import psutil
 from dotenv import load_dotenv
-from database import SessionLocal, add_message, init_db
+from sqlalchemy.exc import OperationalError
+from database import SessionLocal, add_messages, init_db
+from rollups import update_rollups
+from style_profiles import update_style_profiles
+from log_config import setup_logging
 
 load_dotenv()
+setup_logging()
+logger = logging.getLogger('archive')
 
 ARCHIVE_BOT_TOKEN = os.getenv('ARCHIVE_BOT_TOKEN', os.getenv('DISCORD_TOKEN')) 
 OLD_GUILD_ID = int(os.getenv('OLD_GUILD_ID', 0)) 
 # If channles are not specified to archive, archive all readable text channels in guild
 CHANNEL_IDS_TO_ARCHIVE = [int(cid.strip()) for cid in os.getenv('CHANNEL_IDS_TO_ARCHIVE', '').split(',') if cid.strip()]
+# Messages written per transaction, and batches the fetcher may run ahead of the writer;
+# together they bound how many messages are held in memory at once
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_QUEUE_BATCHES = int(os.getenv('ARCHIVE_QUEUE_BATCHES', 4))
+ARCHIVE_PROGRESS_EVERY = int(os.getenv('ARCHIVE_PROGRESS_EVERY', 1000))
 
 if not ARCHIVE_BOT_TOKEN or not OLD_GUILD_ID:
-    print("Error: ARCHIVE_BOT_TOKEN or OLD_GUILD_ID not found in .env file.")
+    logger.error("ARCHIVE_BOT_TOKEN or OLD_GUILD_ID not found in .env file.")
     exit()
 
 intents = discord.Intents.default()
@@ -23,21 +36,148 @@ intents.guilds = True
 intents.members = True 
 
 client = discord.Client(intents=intents)
-db_session = SessionLocal()
+
+
+class ArchivedMessage:
+    """What the archive keeps of a discord.Message; attachments are (id, url, filename, content_type, size) tuples."""
+    __slots__ = ('message_id', 'guild_id', 'channel_id', 'author_id', 'author_name', 'content', 'timestamp', 'attachments')
+
+    def __init__(self, message_id, guild_id, channel_id, author_id, author_name, content, timestamp, attachments):
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.timestamp = timestamp
+        self.attachments = attachments
+
+
+def message_record(message):
+    """Compact record of a discord.Message, so the Message object itself can be freed right away."""
+    return ArchivedMessage(
+        message.id,
+        message.guild.id,
+        message.channel.id,
+        message.author.id,
+        str(message.author),
+        message.content,
+        message.created_at.replace(tzinfo=None),
+        tuple((a.id, a.url, a.filename, a.content_type, a.size) for a in message.attachments),
+    )
+
+
+def write_batch(records):
+    """
+    Writes one batch in its own short-lived session (no identity map grows
+    across batches). Returns (added, skipped as duplicates, failed).
+
+    A batch that fails on its rows (e.g. one bad message, or the bot archiving
+    one of them at the same time) is retried in halves down to single
+    messages, so only the messages that really fail are lost. Connection
+    errors fail the whole batch right away.
+    """
+    with SessionLocal() as db_session:
+        try:
+            added, skipped = add_messages(db_session, records)
+            return added, skipped, 0
+        except Exception as e:
+            db_session.rollback()
+            if len(records) == 1 or isinstance(e, OperationalError):
+                logger.error("Error writing %s message(s) (%s..%s): %s", len(records), records[0].message_id, records[-1].message_id, e)
+                return 0, 0, len(records)
+            logger.warning("Error writing a batch of %s messages (%s..%s), retrying in halves: %s", len(records), records[0].message_id, records[-1].message_id, e)
+    middle = len(records) // 2
+    return tuple(first + second for first, second in zip(write_batch(records[:middle]), write_batch(records[middle:])))
+
+
+def rss_mb():
+    return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+async def archive_channel(channel, batch_size=ARCHIVE_BATCH_SIZE, queue_batches=ARCHIVE_QUEUE_BATCHES):
+    """
+    Archives one channel's history, oldest first, skipping bots and duplicates.
+    The fetcher turns messages into compact records and hands full batches to
+    the writer through a bounded queue, so fetching continues while a batch is
+    written (in a worker thread) but never runs more than `queue_batches` ahead.
+    If the writer dies, the fetcher stops too. Returns (added, skipped, failed).
+    """
+    logger.info("Archiving channel: #%s (%s)...", channel.name, channel.id)
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue(maxsize=queue_batches)
+    counts = {"added": 0, "skipped": 0, "failed": 0}
+
+    async def writer():
+        next_progress = ARCHIVE_PROGRESS_EVERY
+        while True:
+            records = await batches.get()
+            if records is None:
+                return
+            added, skipped, failed = await loop.run_in_executor(None, write_batch, records)
+            counts["added"] += added
+            counts["skipped"] += skipped
+            counts["failed"] += failed
+            processed = counts["added"] + counts["skipped"] + counts["failed"]
+            if processed >= next_progress:
+                next_progress = processed + ARCHIVE_PROGRESS_EVERY
+                logger.info("... processed %s messages in #%s (%s added, %s skipped, %s failed), RSS %.0f MB", processed, channel.name,
+                            counts["added"], counts["skipped"], counts["failed"], rss_mb(),
+                            extra={"channel_id": channel.id, "processed": processed, "rss_mb": round(rss_mb(), 1)})
+
+    writer_task = asyncio.create_task(writer())
+
+    async def hand_over(item):
+        # Waits for room in the queue, but not on a writer that died: its error is raised here instead
+        put = asyncio.ensure_future(batches.put(item))
+        await asyncio.wait((put, writer_task), return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            await writer_task
+
+    try:
+        records = []
+        # Using async for loop to iterate through history
+        async for message in channel.history(limit=None, oldest_first=True): # Fetch oldest first
+            if message.author.bot: # Skipping bot messages
+                continue
+            records.append(message_record(message))
+            if len(records) >= batch_size:
+                await hand_over(records)
+                records = []
+        if records:
+            await hand_over(records)
+    except discord.Forbidden:
+        logger.error("Bot lacks permissions to read history in channel #%s. Skipping.", channel.name)
+    except Exception as e:
+        # A writer error is logged below
+        if not writer_task.done():
+            logger.error("Error archiving channel #%s: %s", channel.name, e)
+    finally:
+        try:
+            if not writer_task.done():
+                await hand_over(None)
+            await writer_task
+        except Exception as e:
+            logger.error("Error writing messages for channel #%s: %s", channel.name, e)
+
+    logger.info("Finished archiving #%s. Added: %s, Skipped: %s, Failed: %s", channel.name, counts["added"], counts["skipped"], counts["failed"],
+                extra={"channel_id": channel.id, "added": counts["added"], "skipped": counts["skipped"], "failed": counts["failed"], "rss_mb": round(rss_mb(), 1)})
+    return counts["added"], counts["skipped"], counts["failed"]
+
 
 @client.event
 async def on_ready():
-    print(f'Archive bot logged in as {client.user}')
-    print(f'Target Guild ID: {OLD_GUILD_ID}')
+    logger.info("Archive bot logged in as %s", client.user)
+    logger.info("Target Guild ID: %s", OLD_GUILD_ID)
     guild = client.get_guild(OLD_GUILD_ID)
 
     if not guild:
-        print(f"Error: Could not find guild with ID {OLD_GUILD_ID}. Make sure the bot is in the server.")
+        logger.error("Could not find guild with ID %s. Make sure the bot is in the server.", OLD_GUILD_ID)
         await client.close()
-        db_session.close()
         return
 
-    print(f"Found guild: {guild.name}")
+    logger.info("Found guild: %s", guild.name)
 
     channels_to_process = []
     if CHANNEL_IDS_TO_ARCHIVE:
@@ -46,102 +186,68 @@ async def on_ready():
             if channel and isinstance(channel, discord.TextChannel):
                 channels_to_process.append(channel)
             else:
-                print(f"Warning: Could not find text channel with ID {channel_id} or it's not a text channel.")
+                logger.warning("Could not find text channel with ID %s or it's not a text channel.", channel_id)
     else:
         # If no specific channels listed, get all readable text channels
         channels_to_process = [ch for ch in guild.text_channels if ch.permissions_for(guild.me).read_message_history]
 
     if not channels_to_process:
-        print("Error: No readable text channels found to archive.")
+        logger.error("No readable text channels found to archive.")
         await client.close()
-        db_session.close()
         return
 
-    print(f"Found {len(channels_to_process)} channels to archive:")
+    logger.info("Found %s channels to archive:", len(channels_to_process))
     for channel in channels_to_process:
-        print(f"- {channel.name} ({channel.id})")
+        logger.info("- %s (%s)", channel.name, channel.id)
 
     total_archived = 0
     total_skipped = 0
+    total_failed = 0
     start_time = datetime.datetime.now()
 
     for channel in channels_to_process:
-        print(f"\nArchiving channel: #{channel.name} ({channel.id})...")
-        channel_archived = 0
-        channel_skipped = 0
-        try:
-            # Using async for loop to iterate through history
-            async for message in channel.history(limit=None, oldest_first=True): # Fetch oldest first
-                if message.author.bot: # Skipping bot messages
-                    continue
-
-                attachments_data = []
-                for attachment in message.attachments:
-                    attachments_data.append({
-                        'attachment_id': attachment.id,
-                        'url': attachment.url,
-                        'filename': attachment.filename,
-                        'content_type': attachment.content_type
-                    })
-
-                msg_data = {
-                    'message_id': message.id,
-                    'guild_id': message.guild.id,
-                    'channel_id': message.channel.id,
-                    'author_id': message.author.id,
-                    'author_name': str(message.author), 
-                    'content': message.content,
-                    'timestamp': message.created_at.replace(tzinfo=None), 
-                    'attachments': attachments_data
-                }
-
-                added = add_message(db_session, msg_data)
-                if added:
-                    channel_archived += 1
-                    total_archived += 1
-                else:
-                    channel_skipped += 1
-                    total_skipped += 1
-
-                if (channel_archived + channel_skipped) % 1000 == 0:
-                    print(f"  ... processed {channel_archived + channel_skipped} messages in #{channel.name} ({channel_archived} added, {channel_skipped} skipped)")
-
-        except discord.Forbidden:
-            print(f"Error: Bot lacks permissions to read history in channel #{channel.name}. Skipping.")
-        except Exception as e:
-            print(f"Error archiving channel #{channel.name}: {e}")
-
-        print(f"Finished archiving #{channel.name}. Added: {channel_archived}, Skipped: {channel_skipped}")
+        channel_archived, channel_skipped, channel_failed = await archive_channel(channel)
+        total_archived += channel_archived
+        total_skipped += channel_skipped
+        total_failed += channel_failed
+
+        # Fold the new rows into the dashboard analytics rollups
+        with SessionLocal() as db_session:
+            try:
+                update_rollups(db_session)
+            except Exception as e:
+                db_session.rollback()
+                logger.error("Error updating analytics rollups: %s", e)
+            try:
+                update_style_profiles(db_session)
+            except Exception as e:
+                db_session.rollback()
+                logger.error("Error updating style profiles: %s", e)
 
     end_time = datetime.datetime.now()
     duration = end_time - start_time
-    print("\n--- Archiving Complete ---")
-    print(f"Total messages added: {total_archived}")
-    print(f"Total messages skipped (duplicates): {total_skipped}")
-    print(f"Duration: {duration}")
+    logger.info("--- Archiving Complete ---")
+    logger.info("Total messages added: %s", total_archived)
+    logger.info("Total messages skipped (duplicates): %s", total_skipped)
+    if total_failed:
+        logger.warning("Total messages that could not be written: %s", total_failed)
+    logger.info("Duration: %s", duration)
 
     await client.close()
-    db_session.close()
 
 
 if __name__ == "__main__":
-    print("Initializing database for archive script...")
+    logger.info("Initializing database for archive script...")
     init_db() # 
 
-    print("Starting archive process...")
+    logger.info("Starting archive process...")
     if ARCHIVE_BOT_TOKEN:
         try:
              asyncio.run(client.start(ARCHIVE_BOT_TOKEN))
         except discord.LoginFailure:
-            print("Error: Invalid ARCHIVE_BOT_TOKEN. Please check your token on .env file.")
+            logger.error("Invalid ARCHIVE_BOT_TOKEN. Please check your token on .env file.")
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-        finally:
-            if not db_session.is_active: 
-                 try:
-                     db_session.close()
-                 except Exception as e:
-                     print(f"Error closing DB session: {e}")
+            logger.error("An unexpected error occurred: %s", e)
 
     else:
-        print("ARCHIVE_BOT_TOKEN not set.")
+        logger.error("ARCHIVE_BOT_TOKEN not set.")
@@ -0,0 +1,184 @@
+# Queries behind the /api/v1 JSON endpoints: field projection, filters and cursor pagination
+import base64
+import datetime
+import json
+from sqlalchemy import select
+from database import Message, Attachment, AppLog, tiered_messages
+
+API_DEFAULT_LIMIT = 50
+API_MAX_LIMIT = 500
+
+# Discord IDs exceed JavaScript's safe integer range, so they are sent as strings
+SNOWFLAKE_FIELDS = {'message_id', 'attachment_id', 'guild_id', 'channel_id', 'author_id'}
+
+
+def _parse_int(value):
+    return int(value)
+
+
+def _parse_datetime(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+def _parse_text(value):
+    return value.strip()
+
+
+# resource -> model, fields returned when ?fields= is not given, filters (name -> parser)
+API_RESOURCES = {
+    'messages': {
+        'model': Message,
+        'default_fields': ('id', 'message_id', 'guild_id', 'channel_id', 'author_id', 'author_name', 'content', 'timestamp'),
+        'filters': {'guild_id': _parse_int, 'channel_id': _parse_int, 'author_id': _parse_int,
+                    'since': _parse_datetime, 'until': _parse_datetime, 'q': _parse_text},
+    },
+    'attachments': {
+        'model': Attachment,
+        'default_fields': ('id', 'attachment_id', 'message_id', 'filename', 'content_type', 'size', 'url'),
+        'filters': {'message_id': _parse_int, 'content_type': _parse_text, 'guild_id': _parse_int, 'channel_id': _parse_int},
+    },
+    'app_logs': {
+        'model': AppLog,
+        'default_fields': ('id', 'timestamp', 'level', 'event_type', 'message'),
+        'filters': {'level': _parse_text, 'event_type': _parse_text, 'since': _parse_datetime,
+                    'until': _parse_datetime, 'q': _parse_text},
+    },
+}
+
+# Query string parameters that are not filters
+_RESERVED_PARAMS = {'fields', 'limit', 'cursor', 'order'}
+
+
+def encode_cursor(order, last_id):
+    return base64.urlsafe_b64encode(json.dumps([order, last_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        order, last_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return order, int(last_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+
+
+def parse_api_args(resource, args):
+    """
+    Validates query parameters for a resource. Returns (fields, filters, limit,
+    order, after_id); raises ValueError with a message for the client.
+    """
+    if resource not in API_RESOURCES:
+        raise ValueError(f"Unknown resource '{resource}'.")
+    spec = API_RESOURCES[resource]
+    columns = spec['model'].__table__.columns
+
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in columns]
+        if unknown:
+            raise ValueError(f"Unknown field(s): {', '.join(unknown)}. Available: {', '.join(columns.keys())}.")
+        # The id is the cursor, so it is always included
+        fields = ['id'] + [field for field in dict.fromkeys(fields) if field != 'id']
+    else:
+        fields = list(spec['default_fields'])
+
+    filters = {}
+    for name, value in args.items():
+        if name in _RESERVED_PARAMS or value == '':
+            continue
+        parser = spec['filters'].get(name)
+        if parser is None:
+            raise ValueError(f"Unknown filter '{name}'. Available: {', '.join(spec['filters'])}.")
+        try:
+            filters[name] = parser(value)
+        except ValueError:
+            raise ValueError(f"Invalid value for '{name}': {value!r}.")
+
+    try:
+        limit = int(args.get('limit') or API_DEFAULT_LIMIT)
+    except ValueError:
+        raise ValueError("limit must be an integer.")
+    if not 1 <= limit <= API_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {API_MAX_LIMIT}.")
+
+    order = args.get('order') or 'desc'
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be 'asc' or 'desc'.")
+    after_id = None
+    if args.get('cursor'):
+        cursor_order, after_id = decode_cursor(args['cursor'])
+        if cursor_order != order:
+            raise ValueError("The cursor was issued for a different order.")
+    return fields, filters, limit, order, after_id
+
+
+def build_api_query(resource, fields, filters, limit, order='desc', after_id=None):
+    """Builds a column-only SELECT (one row more than limit, to detect a next page)."""
+    if resource == 'messages':
+        # Hot and cold messages alike; ids are unique across both tiers
+        columns = tiered_messages().c
+    else:
+        columns = API_RESOURCES[resource]['model'].__table__.c
+    stmt = select(*(columns[field] for field in fields))
+
+    if resource == 'messages':
+        if 'guild_id' in filters:
+            stmt = stmt.where(columns.guild_id == filters['guild_id'])
+        if 'channel_id' in filters:
+            stmt = stmt.where(columns.channel_id == filters['channel_id'])
+        if 'author_id' in filters:
+            stmt = stmt.where(columns.author_id == filters['author_id'])
+        if 'q' in filters:
+            stmt = stmt.where(columns.content.ilike(f"%{filters['q']}%"))
+    elif resource == 'attachments':
+        if 'guild_id' in filters or 'channel_id' in filters:
+            messages = tiered_messages('message_id', 'guild_id', 'channel_id')
+            stmt = stmt.join(messages, messages.c.message_id == Attachment.message_id)
+            if 'guild_id' in filters:
+                stmt = stmt.where(messages.c.guild_id == filters['guild_id'])
+            if 'channel_id' in filters:
+                stmt = stmt.where(messages.c.channel_id == filters['channel_id'])
+        if 'message_id' in filters:
+            stmt = stmt.where(Attachment.message_id == filters['message_id'])
+        if 'content_type' in filters:
+            stmt = stmt.where(Attachment.content_type.startswith(filters['content_type'], autoescape=True))
+    else:
+        if 'level' in filters:
+            stmt = stmt.where(AppLog.level == filters['level'].upper())
+        if 'event_type' in filters:
+            stmt = stmt.where(AppLog.event_type == filters['event_type'])
+        if 'q' in filters:
+            stmt = stmt.where(AppLog.message.ilike(f"%{filters['q']}%"))
+    if 'since' in filters:
+        stmt = stmt.where(columns.timestamp >= filters['since'])
+    if 'until' in filters:
+        stmt = stmt.where(columns.timestamp < filters['until'])
+
+    # Keyset pagination on the primary key: every page is an index range scan
+    if order == 'desc':
+        if after_id is not None:
+            stmt = stmt.where(columns.id < after_id)
+        stmt = stmt.order_by(columns.id.desc())
+    else:
+        if after_id is not None:
+            stmt = stmt.where(columns.id > after_id)
+        stmt = stmt.order_by(columns.id)
+    return stmt.limit(limit + 1)
+
+
+def _serialize(field, value):
+    if value is None:
+        return None
+    if field in SNOWFLAKE_FIELDS:
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def fetch_api_page(db_session, resource, args):
+    """Runs a validated API request. Returns {"data": [...], "next_cursor": str or None}."""
+    fields, filters, limit, order, after_id = parse_api_args(resource, args)
+    rows = db_session.execute(build_api_query(resource, fields, filters, limit, order, after_id)).all()
+    next_cursor = encode_cursor(order, rows[limit - 1][0]) if len(rows) > limit else None
+    data = [{field: _serialize(field, value) for field, value in zip(fields, row)} for row in rows[:limit]]
+    return {"data": data, "next_cursor": next_cursor}
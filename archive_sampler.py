@@ -0,0 +1,252 @@
+# Weighted random archive replies using Walker alias tables over message buckets
+import datetime
+import os
+import random
+import threading
+from array import array
+from sqlalchemy import func, select
+from database import get_message_by_id, get_random_unique_message, tiered_messages
+from revisions import last_revision_id, revised_messages
+
+ARCHIVE_SAMPLER_BATCH_SIZE = int(os.getenv('ARCHIVE_SAMPLER_BATCH_SIZE', 50000))
+
+# Length classes: under 20 characters, up to 100, longer
+LENGTH_CLASSES = ('short', 'medium', 'long')
+
+
+def _length_class(length):
+    if length < 20:
+        return 0
+    if length <= 100:
+        return 1
+    return 2
+
+
+def parse_weights(value, key_type=int):
+    """Parses "key:weight,key:weight" (weight 0 excludes the key). Raises ValueError on bad input."""
+    weights = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, sep, weight = item.partition(':')
+        if not sep:
+            raise ValueError(f"Expected key:weight, got '{item}'.")
+        weight = float(weight)
+        if weight < 0:
+            raise ValueError(f"Weight for '{key.strip()}' cannot be negative.")
+        weights[key_type(key.strip())] = weight
+    return weights
+
+
+def format_weights(weights):
+    return ','.join(f"{key}:{weight:g}" for key, weight in weights.items())
+
+
+class SampleConfig:
+    """Archive reply weighting, read from the ARCHIVE_SAMPLE_* settings."""
+
+    def __init__(self, channel_weights=None, author_weights=None, length_weights=None,
+                 recency_half_life_days=0.0, min_length=1):
+        self.channel_weights = channel_weights or {}
+        self.author_weights = author_weights or {}
+        self.length_weights = length_weights or {}
+        self.recency_half_life_days = recency_half_life_days
+        self.min_length = min_length
+
+    @classmethod
+    def from_values(cls, values):
+        """Builds a config from a settings mapping (os.environ or .env values)."""
+        length_weights = parse_weights(values.get('ARCHIVE_SAMPLE_LENGTH_WEIGHTS'), key_type=str)
+        unknown = set(length_weights) - set(LENGTH_CLASSES)
+        if unknown:
+            raise ValueError(f"Unknown length class(es): {', '.join(sorted(unknown))} (use short, medium, long).")
+        config = cls(
+            channel_weights=parse_weights(values.get('ARCHIVE_SAMPLE_CHANNEL_WEIGHTS')),
+            author_weights=parse_weights(values.get('ARCHIVE_SAMPLE_AUTHOR_WEIGHTS')),
+            length_weights=length_weights,
+            recency_half_life_days=float(values.get('ARCHIVE_SAMPLE_RECENCY_HALF_LIFE') or 0),
+            min_length=int(values.get('ARCHIVE_SAMPLE_MIN_LENGTH') or 1),
+        )
+        if config.recency_half_life_days < 0 or config.min_length < 0:
+            raise ValueError("Recency half-life and minimum length cannot be negative.")
+        return config
+
+    @classmethod
+    def from_env(cls):
+        return cls.from_values(os.environ)
+
+    def bucket_weight(self, channel_id, author_id, month, length_class, today):
+        weight = self.channel_weights.get(channel_id, 1.0) * self.author_weights.get(author_id, 1.0)
+        weight *= self.length_weights.get(LENGTH_CLASSES[length_class], 1.0)
+        if weight and self.recency_half_life_days > 0:
+            # Age of the middle of the month
+            age_days = max(0, (today.year * 12 + today.month - 1 - month) * 30.4 - today.day + 15)
+            weight *= 0.5 ** (age_days / self.recency_half_life_days)
+        return weight
+
+
+class AliasTable:
+    """Walker/Vose alias table: O(n) to build, O(1) per weighted pick."""
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        if n == 0 or total <= 0:
+            raise ValueError("AliasTable needs at least one positive weight.")
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] += scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Leftovers are 1.0 up to rounding error
+
+    def sample(self, rng=random):
+        i = int(rng.random() * len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+class ArchiveSampler:
+    """
+    Picks archived messages according to a SampleConfig.
+
+    Messages are grouped into buckets by (guild, channel, author, month,
+    length class); each bucket keeps its message ids and alias tables are
+    built over bucket count x bucket weight, one for the whole archive and one
+    per guild. A pick is one alias draw plus one uniform index, then a primary
+    key lookup. refresh() only reads messages added and revisions made since
+    the previous call and rebuilds the (small) alias tables.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._buckets = {}       # key -> array of message ids
+        self._last_id = 0
+        self._last_revision_id = 0
+        self._tables = {}        # guild_id (None = all guilds) -> (bucket keys, AliasTable)
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def message_count(self):
+        return sum(len(ids) for ids in self._buckets.values())
+
+    def _key(self, guild_id, channel_id, author_id, timestamp, content_length):
+        return (guild_id, channel_id, author_id, timestamp.year * 12 + timestamp.month - 1, _length_class(content_length))
+
+    def _apply_revisions(self, db_session):
+        # Deleted messages leave their bucket; an edit can move a message to another length class
+        if self._last_id == 0:
+            # Nothing loaded yet: the first refresh reads the current text anyway
+            self._last_revision_id = last_revision_id(db_session)
+            return
+        for revision_id, rows in revised_messages(db_session, self._last_revision_id,
+                                                  'id', 'guild_id', 'channel_id', 'author_id', 'timestamp', 'content'):
+            for row in rows:
+                if row.id > self._last_id:
+                    continue
+                for length_class in range(len(LENGTH_CLASSES)):
+                    key = self._key(row.guild_id, row.channel_id, row.author_id, row.timestamp, 0)[:-1] + (length_class,)
+                    ids = self._buckets.get(key)
+                    if ids is not None and row.id in ids:
+                        # Replaced rather than changed in place: picks may be reading it
+                        ids = array('q', (row_id for row_id in ids if row_id != row.id))
+                        if ids:
+                            self._buckets[key] = ids
+                        else:
+                            del self._buckets[key]
+                content_length = len(row.content or '')
+                if row.deleted_at is None and content_length >= self.config.min_length:
+                    key = self._key(row.guild_id, row.channel_id, row.author_id, row.timestamp, content_length)
+                    self._buckets.setdefault(key, array('q')).append(row.id)
+            self._last_revision_id = revision_id
+
+    def refresh(self, db_session, batch_size=ARCHIVE_SAMPLER_BATCH_SIZE):
+        """
+        Applies edits and deletes, adds new messages and rebuilds the alias
+        tables. Returns the number of messages added.
+        """
+        with self._refresh_lock:
+            self._apply_revisions(db_session)
+            added = 0
+            # Both tiers: a fresh sampler has to see the cold messages too
+            messages = tiered_messages('id', 'guild_id', 'channel_id', 'author_id', 'timestamp', 'content', live_only=True)
+            length = func.length(messages.c.content)
+            while True:
+                rows = db_session.execute(
+                    select(messages.c.id, messages.c.guild_id, messages.c.channel_id, messages.c.author_id, messages.c.timestamp, length)
+                    .where(messages.c.id > self._last_id)
+                    .order_by(messages.c.id)
+                    .limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                for row_id, guild_id, channel_id, author_id, timestamp, content_length in rows:
+                    if (content_length or 0) < self.config.min_length:
+                        continue
+                    key = self._key(guild_id, channel_id, author_id, timestamp, content_length)
+                    ids = self._buckets.get(key)
+                    if ids is None:
+                        ids = self._buckets[key] = array('q')
+                    ids.append(row_id)
+                    added += 1
+                self._last_id = rows[-1][0]
+            self._rebuild_tables()
+            return added
+
+    def _rebuild_tables(self):
+        # Recomputed on every refresh so recency weights follow the calendar
+        today = datetime.date.today()
+        grouped = {None: ([], [])}
+        for key, ids in self._buckets.items():
+            weight = len(ids) * self.config.bucket_weight(*key[1:], today)
+            if weight > 0:
+                for guild_id in (None, key[0]):
+                    keys, weights = grouped.setdefault(guild_id, ([], []))
+                    keys.append(key)
+                    weights.append(weight)
+        # Swapped in one assignment so concurrent picks see consistent tables
+        self._tables = {guild_id: (keys, AliasTable(weights)) for guild_id, (keys, weights) in grouped.items() if weights}
+
+    def pick_id(self, guild_id=None, rng=random):
+        """
+        Returns a weighted random message id (from one guild if guild_id is
+        given), or None before the first refresh / when nothing matches.
+        """
+        table = self._tables.get(guild_id)
+        if table is None:
+            return None
+        keys, alias_table = table
+        # Revisions may have emptied the bucket since the tables were built
+        ids = self._buckets.get(keys[alias_table.sample(rng)])
+        if not ids:
+            return None
+        return ids[int(rng.random() * len(ids))]
+
+    def _pick_message(self, db_session, model, guild_id):
+        # A few extra picks in case messages were deleted (or soft deleted) since the last refresh
+        for _ in range(3):
+            message_id = self.pick_id(guild_id)
+            if message_id is None:
+                return None
+            # The message may have moved to the cold tier since the refresh
+            message = get_message_by_id(db_session, message_id)
+            if message is not None and message.deleted_at is None:
+                return message
+        return None
+
+    def get_message(self, db_session, guild_id=None):
+        """
+        Fetches a weighted random message, still weighting repeated content
+        down like get_random_unique_message. Returns None if the sampler has
+        nothing to pick from.
+        """
+        if guild_id not in self._tables:
+            return None
+        return get_random_unique_message(db_session, guild_id=guild_id, pick=self._pick_message)
@@ -0,0 +1,46 @@
+# Awaitable wrappers that run blocking SQLAlchemy work off the Discord event loop
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from database import SessionLocal, log_app_event
+
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 4))
+
+# Bounded pool: at most DB_EXECUTOR_WORKERS queries run at once and the rest wait
+# in the executor queue instead of on the event loop. Keep this at or below the
+# engine's connection pool size (5 by default).
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+
+def _run_in_session(func, args, kwargs):
+    # expire_on_commit=False keeps returned ORM objects readable after the session closes
+    with SessionLocal(expire_on_commit=False) as db_session:
+        try:
+            result = func(db_session, *args, **kwargs)
+            db_session.commit()
+            return result
+        except Exception:
+            db_session.rollback()
+            raise
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Runs func(db_session, *args, **kwargs) on the DB thread pool in its own session.
+
+    The session is committed on success and rolled back on error. Returned ORM
+    objects are detached but keep their loaded attributes.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(_run_in_session, func, args, kwargs))
+
+
+async def log_event(level, event_type, message, extra=None):
+    """Awaitable log_app_event that commits in its own session."""
+    await run_db(log_app_event, level, event_type, message, extra=extra)
+
+
+def shutdown_db_executor():
+    """Waits for queued DB work to finish. Call once the event loop is done with the DB."""
+    db_executor.shutdown(wait=True)
@@ -0,0 +1,126 @@
+# Per-guild audit log cache used by voice protection
+import asyncio
+import datetime
+import time
+
+
+def is_voice_moderation_role(role):
+    """Returns True if the role grants mute, deafen or move permissions."""
+    perms = role.permissions
+    return perms.mute_members or perms.deafen_members or perms.move_members
+
+
+def aggregate_count(entry):
+    """
+    extra.count of an aggregated entry, else None. Discord reuses a recent
+    member_move/member_disconnect entry by the same moderator for repeat
+    actions: it bumps the count and keeps created_at at the first action.
+    """
+    return getattr(getattr(entry, 'extra', None), 'count', None)
+
+
+class AuditLogCache:
+    """
+    Caches recent audit log entries per (guild, action) for a short window and
+    coalesces concurrent lookups so they share a single in-flight API call.
+
+    Also keeps the set of voice moderation role IDs per guild, computed once from
+    the guild's roles and invalidated by the role events in bot.py.
+    """
+
+    def __init__(self, ttl=5.0, limit=5, skew=2.0):
+        self.ttl = ttl
+        self.limit = limit
+        # Seconds an audit log entry may predate the gateway event it explains
+        self.skew = skew
+        self._entries = {}   # (guild_id, action) -> (fetched_at, [entries])
+        self._inflight = {}  # (guild_id, action) -> (started_at, Task)
+        self._voice_mod_roles = {}  # guild_id -> frozenset of role IDs
+        self._counts = {}  # aggregated entry id -> highest extra.count seen by find_perpetrator
+
+    async def _fetch(self, guild, action, key, started_at):
+        entries = [entry async for entry in guild.audit_logs(limit=self.limit, action=action)]
+        cached = self._entries.get(key)
+        if not cached or cached[0] < started_at:
+            self._entries[key] = (started_at, entries)
+        return started_at, entries
+
+    async def _get(self, guild, action, newer_than):
+        """Returns (fetched_at, entries) from cache, a running fetch or a new fetch started after newer_than."""
+        key = (guild.id, action)
+
+        cached = self._entries.get(key)
+        if cached and cached[0] > newer_than:
+            return cached
+
+        inflight = self._inflight.get(key)
+        if inflight and inflight[0] > newer_than:
+            task = inflight[1]
+        else:
+            started_at = time.monotonic()
+            task = asyncio.ensure_future(self._fetch(guild, action, key, started_at))
+            self._inflight[key] = (started_at, task)
+
+            def _clear(_task, key=key, started_at=started_at):
+                current = self._inflight.get(key)
+                if current and current[0] == started_at:
+                    del self._inflight[key]
+            task.add_done_callback(_clear)
+
+        # Shield so one cancelled waiter does not cancel the shared fetch
+        return await asyncio.shield(task)
+
+    async def get_entries(self, guild, action):
+        """Returns audit log entries for the action fetched within the last ttl seconds."""
+        _, entries = await self._get(guild, action, time.monotonic() - self.ttl)
+        return entries
+
+    async def find_perpetrator(self, guild, action, target_id, event_time=None):
+        """
+        Finds who performed the action on target_id at event_time (an aware
+        datetime, default now).
+
+        Entries older than event_time minus skew belong to an earlier action
+        (maybe by another moderator) and are ignored, unless they are aggregated
+        and their count went up since a previous lookup saw them: that is a
+        repeat action. The first lookup to see an aggregated entry only records
+        its count, so a repeat right after a restart is missed. Discord gives
+        member_move/member_disconnect entries no target, and entries without one
+        never match. If the cached window does not contain a matching entry,
+        refetches once; concurrent misses share that refetch.
+        """
+        if event_time is None:
+            event_time = datetime.datetime.now(datetime.timezone.utc)
+        not_before = event_time - datetime.timedelta(seconds=self.skew)
+        newer_than = time.monotonic() - self.ttl
+        for _ in range(2):
+            fetched_at, entries = await self._get(guild, action, newer_than)
+            for entry in entries:
+                # Add checks for None before accessing attributes
+                if not (entry and entry.target and entry.user and entry.target.id == target_id):
+                    continue
+                count = aggregate_count(entry)
+                seen = self._counts.get(entry.id) if count is not None else None
+                if count is not None:
+                    self._counts[entry.id] = max(count, seen or 0)
+                if entry.created_at >= not_before or (seen is not None and count > seen):
+                    return entry.user
+            newer_than = fetched_at
+        return None
+
+    def voice_moderation_role_ids(self, guild):
+        """Returns the IDs of the guild's roles with voice moderation permissions."""
+        role_ids = self._voice_mod_roles.get(guild.id)
+        if role_ids is None:
+            role_ids = frozenset(role.id for role in guild.roles if is_voice_moderation_role(role))
+            self._voice_mod_roles[guild.id] = role_ids
+        return role_ids
+
+    def voice_moderation_roles(self, member):
+        """Returns the member's roles that grant voice moderation permissions."""
+        role_ids = self.voice_moderation_role_ids(member.guild)
+        return [role for role in member.roles if role.id in role_ids]
+
+    def invalidate_roles(self, guild_id):
+        """Drops the cached voice moderation roles for a guild (call on role changes)."""
+        self._voice_mod_roles.pop(guild_id, None)
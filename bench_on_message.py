@@ -0,0 +1,52 @@
+# Measures per-message overhead of bot.on_message with synthetic messages (no Discord connection)
+import argparse
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+# bot.py exits without a token; nothing here logs in
+os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+import bot
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = 0
+
+    async def send(self, content):
+        self.sent += 1
+        return SimpleNamespace(id=self.sent)
+
+
+def make_messages(count, kind):
+    """Synthetic messages: 'bot' (other bots), 'empty', 'chatter' (plain text) or 'command' (unknown !command)."""
+    guild = SimpleNamespace(id=1, name="bench")
+    channel = FakeChannel(2)
+    author = SimpleNamespace(id=3, bot=kind == 'bot', name="user")
+    content = {'bot': "beep", 'empty': "", 'chatter': "just chatting about nothing in particular", 'command': "!unknown arg"}[kind]
+    return [SimpleNamespace(id=1000 + i, author=author, channel=channel, guild=guild, content=content, mentions=[])
+            for i in range(count)]
+
+
+async def run(count):
+    # Never take an action, so only the dispatch path is measured
+    bot.guild_settings.defaults.update(prob_archive_reply=0.0, prob_relevant_reply=0.0, prob_ai_reply=0.0)
+    results = {}
+    for kind in ('bot', 'empty', 'chatter', 'command'):
+        messages = make_messages(count, kind)
+        start = time.perf_counter()
+        for message in messages:
+            await bot.on_message(message)
+        elapsed = time.perf_counter() - start
+        results[kind] = elapsed / count * 1e6
+        print(f"{kind:>8}: {results[kind]:7.2f} us/message ({count / elapsed:,.0f} messages/s)")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark on_message dispatch with synthetic messages.")
+    parser.add_argument('-n', '--count', type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.run(run(args.count))
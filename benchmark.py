@@ -0,0 +1,464 @@
+# End-to-end benchmark: seeds a synthetic archive, then drives the bot, the archiver and the web app
+# with local fakes for Discord and OpenRouter, and writes throughput/latency/memory figures to JSON
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+WORDS = ("selam", "naber", "oyun", "akşam", "maç", "film", "kod", "python", "discord", "bot", "server", "müzik",
+         "yarın", "bugün", "hafta", "sonu", "gel", "git", "tamam", "evet", "hayır", "belki", "güzel", "kötü",
+         "lol", "gg", "wp", "rank", "elo", "build", "patch", "update", "bug", "fix", "deploy", "kahve", "çay",
+         "pizza", "burger", "sınav", "ders", "proje", "toplantı", "tatil", "deniz", "kar", "yağmur", "güneş")
+GUILD_BASE_ID = 100_000_000_000_000_000
+CHANNEL_BASE_ID = 200_000_000_000_000_000
+AUTHOR_BASE_ID = 300_000_000_000_000_000
+MESSAGE_BASE_ID = 400_000_000_000_000_000
+ATTACHMENT_BASE_ID = 500_000_000_000_000_000
+# Message IDs for the archive ingest run start here, so they never collide with the seeded ones
+INGEST_BASE_ID = 600_000_000_000_000_000
+
+BOT_SCENARIOS = {
+    # (archive, relevant, ai) reply probabilities
+    'dispatch': (0.0, 0.0, 0.0),
+    'archive_reply': (1.0, 0.0, 0.0),
+    'relevant_reply': (0.0, 1.0, 0.0),
+    'ai_reply': (0.0, 0.0, 1.0),
+}
+WEB_PATHS = ('/', '/messages', '/messages?q=oyun', '/attachments', '/applogs', '/analytics/json', '/bot/status',
+             '/api/v1/messages?limit=100', '/api/v1/messages?limit=100&q=oyun')
+
+
+def sentence(rng, low=3, high=20):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies, elapsed, traced_peak=None, **extra):
+    """Throughput, latency percentiles (ms) and memory high-water marks for one scenario."""
+    latencies = sorted(latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    result = {
+        "count": len(latencies),
+        "seconds": round(elapsed, 3),
+        "throughput_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 0.50)),
+            "p90": ms(percentile(latencies, 0.90)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        # Process high-water mark so far (it never goes down, so compare the first scenario that raises it)
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if traced_peak is not None:
+        result["traced_peak_mb"] = round(traced_peak / 1024 / 1024, 2)
+    result.update(extra)
+    return result
+
+
+class MemoryTracer:
+    """Optional per-scenario Python heap peak (tracemalloc slows everything down, so it is off by default)."""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+    def __enter__(self):
+        if self.enabled:
+            tracemalloc.start()
+        self.peak = None
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+# --- Seeding ---
+
+def seed_archive(db_session, rng, messages, guilds, channels, authors, attachment_ratio, app_logs, batch_size=5000):
+    """Bulk inserts a synthetic archive (Core executemany, like import_archive.py). Returns row counts."""
+    from sqlalchemy import insert
+    from database import Message, Attachment, AppLog, message_content_hash, attachment_content_hash
+
+    start = datetime.datetime(2022, 1, 1)
+    step = datetime.timedelta(days=730) / max(1, messages)
+    message_rows, attachment_rows = [], []
+    attachment_count = 0
+    for i in range(messages):
+        guild = i % guilds
+        content = sentence(rng)
+        message_id = MESSAGE_BASE_ID + i
+        message_rows.append({
+            "message_id": message_id,
+            "guild_id": GUILD_BASE_ID + guild,
+            "channel_id": CHANNEL_BASE_ID + guild * channels + rng.randrange(channels),
+            "author_id": AUTHOR_BASE_ID + rng.randrange(authors),
+            "author_name": f"user{rng.randrange(authors)}",
+            "content": content,
+            "timestamp": start + step * i,
+            "content_hash": message_content_hash(content),
+        })
+        if rng.random() < attachment_ratio:
+            filename, content_type, size = f"image{i}.png", "image/png", rng.randint(10_000, 5_000_000)
+            url = f"https://cdn.discordapp.com/attachments/{message_id}/{filename}"
+            attachment_rows.append({
+                "message_id": message_id,
+                "attachment_id": ATTACHMENT_BASE_ID + i,
+                "url": url,
+                "filename": filename,
+                "content_type": content_type,
+                "size": size,
+                "content_hash": attachment_content_hash(filename, size, content_type, url),
+            })
+        if len(message_rows) >= batch_size:
+            db_session.execute(insert(Message), message_rows)
+            if attachment_rows:
+                db_session.execute(insert(Attachment), attachment_rows)
+            db_session.commit()
+            attachment_count += len(attachment_rows)
+            message_rows, attachment_rows = [], []
+    if message_rows:
+        db_session.execute(insert(Message), message_rows)
+    if attachment_rows:
+        db_session.execute(insert(Attachment), attachment_rows)
+    attachment_count += len(attachment_rows)
+    levels = ("INFO", "INFO", "INFO", "WARNING", "ERROR")
+    events = ("random_message_sent", "attachment_sent", "ai_response_success", "send_message_error")
+    for offset in range(0, app_logs, batch_size):
+        db_session.execute(insert(AppLog), [{
+            "level": rng.choice(levels),
+            "event_type": rng.choice(events),
+            "message": sentence(rng, 3, 10),
+            "extra": {"trigger_message_id": MESSAGE_BASE_ID + rng.randrange(max(1, messages))},
+        } for _ in range(min(batch_size, app_logs - offset))])
+    db_session.commit()
+    return {"messages": messages, "attachments": attachment_count, "app_logs": app_logs}
+
+
+# --- Bot ---
+
+class FakeAuthor:
+    def __init__(self, author_id, bot=False):
+        self.id = author_id
+        self.bot = bot
+        self.name = f"user{author_id % 1000}"
+
+    def __str__(self):
+        return self.name
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self._content = content
+        self.text = content
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"model": "benchmark", "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+                "choices": [{"message": {"content": self._content}}]}
+
+
+class FakeOpenRouter:
+    """Stands in for requests.post in openrouter_client: answers after `latency` seconds (simulated network)."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.prompt_chars = 0
+
+    def __call__(self, url, headers=None, json=None, timeout=None):
+        self.calls += 1
+        self.prompt_chars += sum(len(message['content']) for message in json['messages'])
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeResponse("Benchmark cevabı. " + json['messages'][-1]['content'][:100])
+
+
+def make_bot_messages(rng, count, channel, guild):
+    return [SimpleNamespace(id=INGEST_BASE_ID * 2 + i, author=FakeAuthor(AUTHOR_BASE_ID + rng.randrange(50)),
+                            channel=channel, guild=guild, content=sentence(rng, 3, 12), mentions=[])
+            for i in range(count)]
+
+
+async def drive(handler, items, concurrency):
+    """Awaits handler(item) for every item from `concurrency` workers. Returns (latencies, elapsed)."""
+    latencies = []
+    pending = iter(items)
+
+    async def worker():
+        for item in pending:
+            start = time.perf_counter()
+            await handler(item)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+async def bench_bot(args, rng, results):
+    import bot
+    import openrouter_client
+    import requests
+    from bench_on_message import FakeChannel
+    from database import SessionLocal
+    from send_queue import SendQueue
+
+    fake_openrouter = FakeOpenRouter(args.ai_latency)
+    openrouter_client.OPENROUTER_API_KEY = 'benchmark'
+    openrouter_client.requests = SimpleNamespace(post=fake_openrouter, exceptions=requests.exceptions)
+    # Discord's pacing is not what is being measured
+    bot.send_queue = SendQueue(rate=10 ** 9, period=1, stale_after=float('inf'))
+    # Warm the caches the bot normally fills in the background
+    with SessionLocal() as db_session:
+        bot.refresh_style_profiles(db_session)
+        bot.archive_sampler.refresh(db_session)
+        bot.lexical_index.update(db_session)
+
+    guild = SimpleNamespace(id=GUILD_BASE_ID, name="benchmark")
+    for name in args.bot_scenarios:
+        prob_archive, prob_relevant, prob_ai = BOT_SCENARIOS[name]
+        bot.guild_settings.defaults.update(prob_archive_reply=prob_archive, prob_relevant_reply=prob_relevant, prob_ai_reply=prob_ai)
+        channel = FakeChannel(CHANNEL_BASE_ID)
+        count = args.bot_messages if name == 'dispatch' else args.bot_replies
+        messages = make_bot_messages(rng, count, channel, guild)
+        calls_before = fake_openrouter.calls
+        with MemoryTracer(args.trace_memory) as tracer:
+            latencies, elapsed = await drive(bot.on_message, messages, args.concurrency)
+        results[f"bot.{name}"] = summarize(latencies, elapsed, tracer.peak, sent=channel.sent,
+                                          ai_calls=fake_openrouter.calls - calls_before)
+        print_result(f"bot.{name}", results[f"bot.{name}"])
+    bot.shutdown_db_executor()
+
+
+# --- Archiver ---
+
+class FakeHistoryChannel:
+    """
+    A text channel whose history() generates synthetic messages on the fly (so
+    the fake itself holds no memory). The time the consumer spends between two
+    messages is recorded as that message's latency.
+    """
+
+    def __init__(self, rng, count, duplicate_ratio, attachment_ratio, seeded_messages):
+        self.id = CHANNEL_BASE_ID
+        self.name = "bench-history"
+        self.guild = SimpleNamespace(id=GUILD_BASE_ID)
+        self.rng = rng
+        self.count = count
+        self.duplicate_ratio = duplicate_ratio
+        self.attachment_ratio = attachment_ratio
+        self.seeded_messages = seeded_messages
+        self.latencies = []
+
+    def make_message(self, i, start):
+        rng = self.rng
+        if self.seeded_messages and rng.random() < self.duplicate_ratio:
+            # Already archived: exercises the duplicate check
+            message_id = MESSAGE_BASE_ID + rng.randrange(self.seeded_messages)
+        else:
+            message_id = INGEST_BASE_ID + i
+        attachments = []
+        if rng.random() < self.attachment_ratio:
+            attachments.append(SimpleNamespace(id=INGEST_BASE_ID + i, filename=f"clip{i}.mp4", content_type="video/mp4",
+                                               size=rng.randint(100_000, 20_000_000),
+                                               url=f"https://cdn.discordapp.com/attachments/{message_id}/clip{i}.mp4"))
+        return SimpleNamespace(id=message_id, author=FakeAuthor(AUTHOR_BASE_ID + rng.randrange(50), bot=rng.random() < 0.02),
+                               guild=self.guild, channel=self, content=sentence(rng),
+                               created_at=start + datetime.timedelta(seconds=i), attachments=attachments)
+
+    async def history(self, limit=None, oldest_first=True):
+        start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+        for i in range(self.count):
+            message = self.make_message(i, start)
+            started = time.perf_counter()
+            yield message
+            self.latencies.append(time.perf_counter() - started)
+
+
+async def bench_archive(args, rng, results):
+    import archive
+    import psutil
+
+    channel = FakeHistoryChannel(rng, args.archive_messages, args.archive_duplicates, args.attachment_ratio, args.messages)
+    process = psutil.Process()
+    rss_start = process.memory_info().rss
+    with MemoryTracer(args.trace_memory) as tracer:
+        start = time.perf_counter()
+        added, skipped, failed = await archive.archive_channel(channel)
+        elapsed = time.perf_counter() - start
+    # A flat pipeline keeps this near zero however long the history is
+    rss_growth = (process.memory_info().rss - rss_start) / 1024 / 1024
+    results["archive.ingest"] = summarize(channel.latencies, elapsed, tracer.peak, added=added, skipped=skipped,
+                                          failed=failed, rss_growth_mb=round(rss_growth, 1))
+    print_result("archive.ingest", results["archive.ingest"])
+
+
+# --- Web ---
+
+def bench_web(args, results):
+    import web_app
+
+    app = web_app.create_app()
+    credentials = base64.b64encode(f"{web_app.ADMIN_USERNAME}:{web_app.ADMIN_PASSWORD}".encode()).decode()
+    headers = {"Authorization": f"Basic {credentials}", "Accept-Encoding": "gzip"}
+    local = threading.local()
+
+    def request(path):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        start = time.perf_counter()
+        response = client.get(path, headers=headers)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    # One request each first, so the one-off cache fills (e.g. the 1 s CPU sample) are not counted
+    for path in args.web_paths:
+        request(path)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for path in args.web_paths:
+            with MemoryTracer(args.trace_memory) as tracer:
+                start = time.perf_counter()
+                responses = list(pool.map(request, [path] * args.web_requests))
+                elapsed = time.perf_counter() - start
+            errors = sum(1 for _, status in responses if status >= 400)
+            results[f"web.{path}"] = summarize([latency for latency, _ in responses], elapsed, tracer.peak, errors=errors)
+            print_result(f"web.{path}", results[f"web.{path}"])
+
+
+# --- Report ---
+
+def print_result(name, result):
+    latency = result["latency_ms"]
+    print(f"{name:<45} {result['throughput_per_s'] or 0:>10,.1f}/s  p50 {latency['p50'] or 0:8.3f} ms  "
+          f"p99 {latency['p99'] or 0:8.3f} ms  rss {result['peak_rss_mb']:7.1f} MB", flush=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(previous, current):
+    """Prints throughput and p99 changes for the scenarios both reports have."""
+    print(f"\nCompared with {previous.get('commit')} ({previous.get('created')}):")
+    for name, result in current["results"].items():
+        before = previous.get("results", {}).get(name)
+        if not before or not before.get("throughput_per_s") or not result.get("throughput_per_s"):
+            continue
+        throughput = (result["throughput_per_s"] / before["throughput_per_s"] - 1) * 100
+        p99_before, p99_now = before["latency_ms"]["p99"], result["latency_ms"]["p99"]
+        p99 = f"{(p99_now / p99_before - 1) * 100:+6.1f}%" if p99_before else "   n/a"
+        print(f"{name:<45} throughput {throughput:+6.1f}%  p99 {p99}")
+
+
+def configure_environment(args, workdir):
+    """Everything the imported modules read at import time; never the configured production database."""
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    os.environ['DISCORD_TOKEN'] = os.environ['ARCHIVE_BOT_TOKEN'] = 'benchmark'
+    os.environ['OLD_GUILD_ID'] = str(GUILD_BASE_ID)
+    os.environ['LEXICAL_INDEX_DIR'] = os.path.join(workdir, 'lexical_index')
+    os.environ['WEB_CACHE_FILE'] = os.path.join(workdir, 'web-cache.sqlite')
+    os.environ['BOT_HEARTBEAT_FILE'] = os.path.join(workdir, 'heartbeat.json')
+    os.environ['ARCHIVE_SCOPE'] = 'all'
+    os.environ['LOG_LEVEL'] = args.log_level
+    if args.no_render_cache:
+        os.environ['HTTP_RENDER_CACHE_TTL'] = '0'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed a synthetic archive and benchmark the bot, the archiver and the web app.")
+    parser.add_argument('--database-url', help="Database to seed (must be empty and disposable; default: SQLite in a temporary directory).")
+    parser.add_argument('--messages', type=int, default=20000, help="Archived messages to seed.")
+    parser.add_argument('--guilds', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=10, help="Channels per guild.")
+    parser.add_argument('--authors', type=int, default=200)
+    parser.add_argument('--attachment-ratio', type=float, default=0.1)
+    parser.add_argument('--app-logs', type=int, default=5000)
+    parser.add_argument('--bot-messages', type=int, default=20000, help="Messages for the dispatch-only scenario.")
+    parser.add_argument('--bot-replies', type=int, default=500, help="Messages for each reply scenario.")
+    parser.add_argument('--bot-scenarios', nargs='+', choices=sorted(BOT_SCENARIOS), default=list(BOT_SCENARIOS))
+    parser.add_argument('--ai-latency', type=float, default=0.0, help="Seconds the fake OpenRouter takes per reply.")
+    parser.add_argument('--archive-messages', type=int, default=5000, help="Messages in the fake channel history.")
+    parser.add_argument('--archive-duplicates', type=float, default=0.1, help="Share of history messages already archived.")
+    parser.add_argument('--web-requests', type=int, default=200, help="Requests per web path.")
+    parser.add_argument('--web-paths', nargs='+', default=list(WEB_PATHS))
+    parser.add_argument('--no-render-cache', action='store_true', help="Render every web request (HTTP_RENDER_CACHE_TTL=0).")
+    parser.add_argument('--concurrency', type=int, default=1, help="Concurrent bot handlers / web client threads.")
+    parser.add_argument('--only', nargs='+', choices=('bot', 'archive', 'web'), default=['bot', 'archive', 'web'])
+    parser.add_argument('--trace-memory', action='store_true', help="Also report the Python heap peak per scenario (slower).")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', default='bench_report.json', help="JSON report path.")
+    parser.add_argument('--compare', help="Previous JSON report to compare with.")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='discord-archive-bench-') as workdir:
+        configure_environment(args, workdir)
+        # Imported only now: these modules read their settings at import time
+        from database import SessionLocal, engine, init_db
+
+        rng = random.Random(args.seed)
+        init_db()
+        with SessionLocal() as db_session:
+            start = time.perf_counter()
+            seeded = seed_archive(db_session, rng, args.messages, args.guilds, args.channels, args.authors,
+                                  args.attachment_ratio, args.app_logs)
+            seeded["seconds"] = round(time.perf_counter() - start, 3)
+        print(f"Seeded {seeded['messages']:,} messages, {seeded['attachments']:,} attachments and "
+              f"{seeded['app_logs']:,} app logs in {seeded['seconds']} s ({engine.dialect.name})", flush=True)
+
+        results = {}
+        if 'bot' in args.only:
+            asyncio.run(bench_bot(args, rng, results))
+        if 'archive' in args.only:
+            asyncio.run(bench_archive(args, rng, results))
+        if 'web' in args.only:
+            bench_web(args, results)
+        engine.dispose()
+
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "database": engine.dialect.name,
+        "settings": {key: value for key, value in vars(args).items() if key not in ('database_url', 'output', 'compare')},
+        "seed": seeded,
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
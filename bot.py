@@ -3,29 +3,94 @@ import discord
 import os
 import random
 import asyncio
-from dotenv import load_dotenv
-from sqlalchemy.orm import sessionmaker
-from database import SessionLocal, get_random_message, get_random_attachment, delete_message, get_recent_messages_for_context, init_db, log_app_event
+from functools import partial
+import logging
+from dotenv import load_dotenv, find_dotenv
+from database import get_random_unique_message, get_random_unique_attachment, delete_message, get_recent_messages_for_context, init_db
+from async_db import db_executor, run_db, log_event, shutdown_db_executor
+from loop_monitor import LoopLagMonitor
+from health import HealthMonitor
 from openrouter_client import get_ai_response
+from audit_log_cache import AuditLogCache
+from style_profiles import StyleProfileCache, update_style_profiles
+from archive_sampler import ArchiveSampler, SampleConfig
+from lexical_index import LexicalIndex, search_messages
+from retrieval import retrieve_context
+from guild_settings import GuildSettingsCache
+from send_queue import SendQueue
+from revisions import RevisionWriter
+from log_config import setup_logging
 import time
 import re
 
 # Load environment variables
-load_dotenv()
+DOTENV_PATH = find_dotenv()
+load_dotenv(DOTENV_PATH)
+setup_logging()
+logger = logging.getLogger('bot')
+# Per-message and voice event details; enable with LOG_LEVELS=bot.dispatch=DEBUG (and sample with LOG_SAMPLE)
+dispatch_logger = logging.getLogger('bot.dispatch')
+voice_logger = logging.getLogger('bot.voice')
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 BOT_OWNER_ID = int(os.getenv('BOT_OWNER_ID', 0))
 PROB_ARCHIVE_REPLY = float(os.getenv('PROB_ARCHIVE_REPLY', 0.4))
 PROB_AI_REPLY = float(os.getenv('PROB_AI_REPLY', 0.4))
+# Reply with the archived message most related to the trigger (local lexical index)
+PROB_RELEVANT_REPLY = float(os.getenv('PROB_RELEVANT_REPLY', 0))
 AI_CONTEXT_LIMIT = int(os.getenv('AI_CONTEXT_MESSAGE_LIMIT', 50))
+AUDIT_LOG_CACHE_TTL = float(os.getenv('AUDIT_LOG_CACHE_TTL', 5))
+AUDIT_LOG_EVENT_SKEW = float(os.getenv('AUDIT_LOG_EVENT_SKEW', 2))
+# Which style profile the AI copies: 'author', 'channel' or 'global'
+STYLE_PROFILE_SCOPE = os.getenv('STYLE_PROFILE_SCOPE', 'channel')
+STYLE_PROFILE_REFRESH = float(os.getenv('STYLE_PROFILE_REFRESH', 300))
+ARCHIVE_SAMPLER_REFRESH = float(os.getenv('ARCHIVE_SAMPLER_REFRESH', 300))
+LEXICAL_INDEX_REFRESH = float(os.getenv('LEXICAL_INDEX_REFRESH', 300))
+GUILD_SETTINGS_REFRESH = float(os.getenv('GUILD_SETTINGS_REFRESH', 60))
+# Archive replies/AI context from every archived guild ('all') or only the guild the message came from ('guild');
+# a guild's archive_guild_id setting overrides both
+ARCHIVE_SCOPE = os.getenv('ARCHIVE_SCOPE', 'all')
+# Messages in these channels are never answered (comma separated IDs)
+IGNORED_CHANNEL_IDS = {int(x) for x in os.getenv('IGNORED_CHANNEL_IDS', '').replace(' ', '').split(',') if x}
+COMMAND_PREFIX = '!'
+
+
+def parse_shard_ids(value):
+    """Parses "0,1" or "0-3" into a list of shard IDs (None when empty)."""
+    shard_ids = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids or None
+
+# Sharding: SHARD_COUNT shards in total, of which this process runs SHARD_IDS.
+# Unset, discord.py picks the recommended shard count and runs all of them.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0)) or None
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', ''))
+# Only one process writes the shared style profiles and lexical index; the others just reload them
+IS_PRIMARY_SHARD = not SHARD_IDS or 0 in SHARD_IDS
 
 # Basic validation
 if not DISCORD_TOKEN:
-    print("Error: DISCORD_TOKEN not found in .env file.")
+    logger.error("DISCORD_TOKEN not found in .env file.")
     exit()
 if not BOT_OWNER_ID:
-    print("Warning: BOT_OWNER_ID not found or invalid in .env file. Delete command will not work.")
-if PROB_ARCHIVE_REPLY + PROB_AI_REPLY > 1.0:
-    print("Warning: Sum of PROB_ARCHIVE_REPLY and PROB_AI_REPLY exceeds 1.0.")
+    logger.warning("BOT_OWNER_ID not found or invalid in .env file. Delete command will not work.")
+if SHARD_IDS and not SHARD_COUNT:
+    logger.error("SHARD_IDS requires SHARD_COUNT.")
+    exit()
+if ARCHIVE_SCOPE not in ('all', 'guild'):
+    logger.warning("ARCHIVE_SCOPE must be 'all' or 'guild'. Using 'all'.")
+    ARCHIVE_SCOPE = 'all'
+if PROB_ARCHIVE_REPLY + PROB_RELEVANT_REPLY + PROB_AI_REPLY > 1.0:
+    logger.warning("Sum of PROB_ARCHIVE_REPLY, PROB_RELEVANT_REPLY and PROB_AI_REPLY exceeds 1.0.")
+try:
+    ARCHIVE_SAMPLE_CONFIG = SampleConfig.from_env()
+except ValueError as e:
+    logger.warning("Invalid archive reply weighting (%s). Using uniform weights.", e)
+    ARCHIVE_SAMPLE_CONFIG = SampleConfig()
 
 # Discord Client Setup
 intents = discord.Intents.default()
@@ -37,25 +102,88 @@ intents.voice_states = True  # Enable voice state events
 intents.members = True       # Needed to fetch member info for role removal
 intents.guilds = True
 
-client = discord.Client(intents=intents)
+client = discord.AutoShardedClient(intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+
+# Shared audit log lookups and voice moderation roles for voice protection
+audit_log_cache = AuditLogCache(ttl=AUDIT_LOG_CACHE_TTL, skew=AUDIT_LOG_EVENT_SKEW)
+loop_monitor = LoopLagMonitor()
+health_monitor = HealthMonitor(client, loop_monitor)
+style_profiles = StyleProfileCache()
+archive_sampler = ArchiveSampler(ARCHIVE_SAMPLE_CONFIG)
+lexical_index = LexicalIndex()
+# Every reply goes through per-channel queues paced under Discord's rate limits
+send_queue = SendQueue()
+guild_settings = GuildSettingsCache({
+    'prob_archive_reply': PROB_ARCHIVE_REPLY,
+    'prob_relevant_reply': PROB_RELEVANT_REPLY,
+    'prob_ai_reply': PROB_AI_REPLY,
+    'archive_guild_id': None,
+})
+
+_env_mtime = None
+
+def reload_env():
+    """Re-reads .env for settings changed from the web UI, only when the file was modified."""
+    global _env_mtime
+    try:
+        mtime = os.stat(DOTENV_PATH).st_mtime if DOTENV_PATH else None
+    except OSError:
+        mtime = None
+    if mtime != _env_mtime:
+        _env_mtime = mtime
+        load_dotenv(DOTENV_PATH, override=True)
+
+def archive_guild_for(guild, settings):
+    """Guild ID archive queries are limited to for a message from `guild`, or None for the whole archive."""
+    if settings['archive_guild_id']:
+        return settings['archive_guild_id']
+    if ARCHIVE_SCOPE == 'guild' and guild is not None:
+        return guild.id
+    return None
+
+@client.event
+async def on_connect():
+    health_monitor.record_connect()
+
+@client.event
+async def on_disconnect():
+    health_monitor.record_disconnect()
+
+@client.event
+async def on_resumed():
+    health_monitor.record_resume()
+
+@client.event
+async def on_guild_role_create(role):
+    audit_log_cache.invalidate_roles(role.guild.id)
+
+@client.event
+async def on_guild_role_update(before, after):
+    audit_log_cache.invalidate_roles(after.guild.id)
+
+@client.event
+async def on_guild_role_delete(role):
+    audit_log_cache.invalidate_roles(role.guild.id)
 
 @client.event
 async def on_voice_state_update(member, before, after):
-    print(f"[DEBUG] on_voice_state_update triggered for member {member} ({member.id})", flush=True)
+    voice_logger.debug("on_voice_state_update triggered for member %s (%s)", member, member.id)
+    # Audit log entries for this change can not be older than this (minus skew)
+    event_time = discord.utils.utcnow()
     # Reload env for live config
-    load_dotenv(override=True)
+    reload_env()
     BOT_OWNER_ID = int(os.getenv('BOT_OWNER_ID', 0))
     ENABLE_VOICE_PROTECTION = os.getenv('ENABLE_VOICE_PROTECTION', 'false').lower() == 'true'
 
     if not ENABLE_VOICE_PROTECTION:
-        print("[DEBUG] Voice protection disabled.", flush=True)
+        voice_logger.debug("Voice protection disabled.")
         return
 
     # Only act if the affected member is the owner
     if member.id != BOT_OWNER_ID:
-        # print(f"[DEBUG] Voice update for non-owner {member.id}, ignoring.", flush=True) # Can be noisy
+        voice_logger.debug("Voice update for non-owner %s, ignoring.", member.id)
         return
-    print(f"[DEBUG] Voice update for owner {member.id}.", flush=True)
+    voice_logger.debug("Voice update for owner %s.", member.id)
 
     # Detect mute, deafen, or disconnect
     was_muted = not before.mute and after.mute
@@ -63,15 +191,15 @@ async def on_voice_state_update(member, before, after):
     was_disconnected = before.channel is not None and after.channel is None
 
     if not (was_muted or was_deafened or was_disconnected):
-        # print("[DEBUG] No relevant voice action detected.", flush=True) # Can be noisy
+        voice_logger.debug("No relevant voice action detected.")
         return
-    print(f"[DEBUG] Relevant voice action detected: muted={was_muted}, deafened={was_deafened}, disconnected={was_disconnected}", flush=True)
+    voice_logger.debug("Relevant voice action detected: muted=%s, deafened=%s, disconnected=%s", was_muted, was_deafened, was_disconnected)
 
     guild = after.channel.guild if after.channel else before.channel.guild if before.channel else None
     if not guild:
-        print("[DEBUG] Could not determine guild.", flush=True)
+        voice_logger.debug("Could not determine guild.")
         return
-    print(f"[DEBUG] Guild found: {guild.name} ({guild.id})", flush=True)
+    voice_logger.debug("Guild found: %s (%s)", guild.name, guild.id)
 
     # Fetch audit logs for the relevant action
     try:
@@ -79,285 +207,349 @@ async def on_voice_state_update(member, before, after):
         action_type = discord.AuditLogAction.member_update if (was_muted or was_deafened) else discord.AuditLogAction.member_move if was_disconnected else None
 
         if action_type:
-            async for entry in guild.audit_logs(limit=5, action=action_type):
-                # Add checks for None before accessing attributes
-                if entry and entry.target and entry.user and entry.target.id == BOT_OWNER_ID:
-                    perpetrator = entry.user
-                    break
+            # Cached and coalesced, so spammed actions share one audit log fetch
+            perpetrator = await audit_log_cache.find_perpetrator(guild, action_type, BOT_OWNER_ID, event_time)
 
         if not perpetrator:
-            print("[DEBUG] Could not find perpetrator in audit logs.", flush=True)
+            voice_logger.debug("Could not find perpetrator in audit logs.")
             return  # Could not find who did it
-        print(f"[DEBUG] Found perpetrator: {perpetrator} ({perpetrator.id})", flush=True)
+        voice_logger.debug("Found perpetrator: %s (%s)", perpetrator, perpetrator.id)
 
         # Prevent action if owner performed the action on themselves
         if perpetrator.id == BOT_OWNER_ID:
-            print("[DEBUG] Owner performed action on self, ignoring.", flush=True)
+            voice_logger.debug("Owner performed action on self, ignoring.")
             return
 
         # Get the perpetrator's member object
         perp_member = guild.get_member(perpetrator.id)
         if not perp_member:
-            print(f"[DEBUG] Could not get member object for perpetrator {perpetrator.id}.", flush=True)
+            voice_logger.debug("Could not get member object for perpetrator %s.", perpetrator.id)
             return
-        print(f"[DEBUG] Got member object for perpetrator: {perp_member}", flush=True)
+        voice_logger.debug("Got member object for perpetrator: %s", perp_member)
 
-        # Identify all roles with voice moderation permissions
-        roles_to_remove = []
-        for role in perp_member.roles:
-            perms = role.permissions
-            if perms.mute_members or perms.deafen_members or perms.move_members:
-                roles_to_remove.append(role)
+        # Identify all roles with voice moderation permissions (precomputed per guild)
+        roles_to_remove = audit_log_cache.voice_moderation_roles(perp_member)
 
         if not roles_to_remove:
-            print(f"[DEBUG] Perpetrator {perp_member} has no relevant roles to remove.", flush=True)
+            voice_logger.debug("Perpetrator %s has no relevant roles to remove.", perp_member)
             return
-        print(f"[DEBUG] Roles to remove from {perp_member}: {[r.name for r in roles_to_remove]}", flush=True)
+        voice_logger.debug("Roles to remove from %s: %s", perp_member, [r.name for r in roles_to_remove])
 
         # Remove all offending roles
         await perp_member.remove_roles(*roles_to_remove, reason="Voice protection: muted/deafened/disconnected the owner")
-        print(f"[DEBUG] Roles removed successfully.", flush=True)
+        voice_logger.debug("Roles removed successfully.")
 
         # Log the action
-        with SessionLocal() as db_session:
-            log_app_event(
-                db_session,
-                level="INFO",
-                event_type="voice_protection",
-                message="Voice protection triggered: roles removed from perpetrator.",
-                extra={
-                    "perpetrator_id": perpetrator.id,
-                    "perpetrator_name": str(perp_member),
-                    "roles_removed": [role.name for role in roles_to_remove],
-                    "action": "mute" if was_muted else "deafen" if was_deafened else "disconnect",
-                    "guild_id": guild.id
-                }
-            )
-            db_session.commit()
+        await log_event(
+            level="INFO",
+            event_type="voice_protection",
+            message="Voice protection triggered: roles removed from perpetrator.",
+            extra={
+                "perpetrator_id": perpetrator.id,
+                "perpetrator_name": str(perp_member),
+                "roles_removed": [role.name for role in roles_to_remove],
+                "action": "mute" if was_muted else "deafen" if was_deafened else "disconnect",
+                "guild_id": guild.id
+            }
+        )
     except Exception as e:
-        print(f"Error in voice protection: {e}")
-        with SessionLocal() as db_session:
-            log_app_event(
-                db_session,
-                level="ERROR",
-                event_type="voice_protection_error",
-                message=f"Error in voice protection: {e}",
-                extra={"guild_id": guild.id if guild else None}
-            )
-            db_session.commit()
+        voice_logger.exception("Error in voice protection: %s", e)
+        await log_event(
+            level="ERROR",
+            event_type="voice_protection_error",
+            message=f"Error in voice protection: {e}",
+            extra={"guild_id": guild.id if guild else None}
+        )
 
 @client.event
 async def on_ready():
-    print(f'Logged in as {client.user}', flush=True)
-    print(f'Owner ID: {BOT_OWNER_ID}', flush=True)
-    print(f'Probabilities: Archive={PROB_ARCHIVE_REPLY*100}%, AI={PROB_AI_REPLY*100}%', flush=True)
+    logger.info("Logged in as %s", client.user)
+    logger.info("Owner ID: %s", BOT_OWNER_ID)
+    logger.info("Probabilities: Archive=%s%%, Relevant=%s%%, AI=%s%%", PROB_ARCHIVE_REPLY*100, PROB_RELEVANT_REPLY*100, PROB_AI_REPLY*100)
+    logger.info("Shards: %s of %s, %s guilds", sorted(client.shards), client.shard_count, len(client.guilds))
     # Ensure DB tables exist when bot starts
     try:
-        init_db()
+        await asyncio.get_running_loop().run_in_executor(db_executor, init_db)
     except Exception as e:
-        print(f"Error initializing database on startup: {e}")
+        logger.error("Error initializing database on startup: %s", e)
         # Depending on the error, you might want to exit or just log it
         # exit()
 
 
+def refresh_style_profiles(db_session):
+    # Fold newly archived messages into the profiles, then pick up any changes
+    update_style_profiles(db_session)
+    return style_profiles.load(db_session)
+
+def reload_lexical_index(db_session):
+    # Secondary shard processes pick up segments written by the primary
+    lexical_index.load()
+
+def refresh_after_revisions(db_session):
+    # Deleted and pre-edit text must stop showing up in replies and prompts
+    archive_sampler.refresh(db_session)
+    if IS_PRIMARY_SHARD:
+        refresh_style_profiles(db_session)
+        lexical_index.update(db_session)
+
+# Edits/deletes of archived messages, applied in batches
+revision_writer = RevisionWriter(on_applied=refresh_after_revisions)
+
+async def run_periodically(name, func, interval):
+    """Runs func(db_session) in the DB executor every `interval` seconds, logging failures."""
+    while True:
+        try:
+            result = await run_db(func)
+            if result:
+                logger.info("%s refreshed (%s).", name, result)
+        except Exception as e:
+            logger.error("Error refreshing %s: %s", name, e)
+        await asyncio.sleep(interval)
+
+
 # Cooldown tracking for AI mention responses
 ai_mention_cooldowns = {}
 
+async def get_ai_response_async(*args, **kwargs):
+    """Runs the blocking OpenRouter request in the default executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(get_ai_response, *args, **kwargs))
+
+async def find_relevant_messages(text, guild_id=None, k=5):
+    """Searches the lexical index off the event loop and loads the matching messages, best first."""
+    return await run_db(search_messages, lexical_index, text, k, guild_id=guild_id)
+
+async def retrieve_for_prompt(text, guild_id=None):
+    """
+    Relevant archived messages for an AI prompt, packed under RAG_TOKEN_BUDGET.
+    Returns (context or None, stats with retrieval latency and estimated prompt savings).
+    """
+    try:
+        context, stats = await run_db(retrieve_context, lexical_index, text, guild_id=guild_id, baseline_messages=AI_CONTEXT_LIMIT)
+    except Exception as e:
+        logger.error("Error retrieving archive context: %s", e)
+        return None, {"error": str(e)}
+    dispatch_logger.info("Retrieval: %s messages, ~%s tokens (~%s fewer than the last %s messages) in %s ms",
+                         stats['messages_used'], stats['context_tokens'], stats['estimated_saved_tokens'], AI_CONTEXT_LIMIT, stats['retrieval_ms'], extra={"retrieval": stats})
+    return context, stats
+
+@client.event
+async def on_raw_message_edit(payload):
+    # Embed-only updates carry no content
+    content = payload.data.get('content')
+    if content is None:
+        return
+    edited = payload.data.get('edited_timestamp')
+    edited_at = discord.utils.parse_time(edited) if edited else discord.utils.utcnow()
+    # Archive timestamps are naive UTC
+    revision_writer.edit(payload.message_id, content, edited_at.replace(tzinfo=None))
+
+@client.event
+async def on_raw_message_delete(payload):
+    revision_writer.delete(payload.message_id, discord.utils.utcnow().replace(tzinfo=None))
+
+@client.event
+async def on_raw_bulk_message_delete(payload):
+    deleted_at = discord.utils.utcnow().replace(tzinfo=None)
+    for message_id in payload.message_ids:
+        revision_writer.delete(message_id, deleted_at)
+
 @client.event
 async def on_message(message):
-    print(f"[DEBUG] on_message called: message.id={message.id}, author={message.author}, content={message.content}, mentions={[str(m) for m in message.mentions]}", flush=True)
-    # Ignore messages from the bot itself
-    if message.author == client.user:
+    # Track in-flight handlers for the health heartbeat
+    health_monitor.handler_started()
+    try:
+        await handle_message(message)
+    finally:
+        health_monitor.handler_finished()
+
+def prefilter(message):
+    """Cheap checks run before anything else; returns why a message is ignored, or None."""
+    if message.author.bot:
+        return "bot author"
+    if message.channel.id in IGNORED_CHANNEL_IDS:
+        return "ignored channel"
+    if not message.content:
+        return "no content"
+    return None
+
+# Command router: "!name" -> (handler, owner only)
+commands = {}
+
+def command(name, owner_only=False):
+    """Registers `async def handler(message, args)` for messages starting with COMMAND_PREFIX + name."""
+    def decorator(handler):
+        commands[name] = (handler, owner_only)
+        return handler
+    return decorator
+
+def route_command(message):
+    """Returns (handler, args) if the message is a known command its author may run, else None."""
+    if not message.content.startswith(COMMAND_PREFIX):
+        return None
+    parts = message.content[len(COMMAND_PREFIX):].split()
+    entry = commands.get(parts[0]) if parts else None
+    if entry is None:
+        return None
+    handler, owner_only = entry
+    if owner_only and message.author.id != BOT_OWNER_ID:
+        return None
+    return handler, parts[1:]
+
+async def handle_message(message):
+    reason = prefilter(message)
+    if reason is not None:
         return
+    if dispatch_logger.isEnabledFor(logging.DEBUG):
+        dispatch_logger.debug("on_message: id=%s author=%s content=%r mentions=%s", message.id, message.author, message.content, [str(m) for m in message.mentions])
 
-    # --- AI Mention Handler ---
     if client.user in message.mentions:
-        print(f"[DEBUG] Bot was mentioned by {message.author} ({message.author.id}) in message {message.id}", flush=True)
-        # Reload env for live config
-        load_dotenv(override=True)
-        BOT_OWNER_ID = int(os.getenv('BOT_OWNER_ID', 0))
-        AI_MENTION_COOLDOWN = int(os.getenv('AI_MENTION_COOLDOWN', 60))
-        # Determine mention model (override must differ from chat model)
-        mention_model_env = os.getenv('OPENROUTER_MENTION_MODEL')
-        chat_model = os.getenv('OPENROUTER_CHAT_MODEL')
-        if mention_model_env and mention_model_env != chat_model:
-            mention_model = mention_model_env
-        else:
-            mention_model = 'google/gemini-flash-1.5'
-        print(f"[DEBUG] Using mention model: {mention_model}", flush=True)
-
-        is_owner = message.author.id == BOT_OWNER_ID
-        now = time.time()
-        user_id = message.author.id
-
-        # Check cooldown (owner bypasses)
-        if not is_owner:
-            last_time = ai_mention_cooldowns.get(user_id, 0)
-            if now - last_time < AI_MENTION_COOLDOWN:
-                print(f"[DEBUG] User {user_id} is on cooldown.", flush=True)
-                # Silent on cooldown
-                return
-            print(f"[DEBUG] User {user_id} is not on cooldown.", flush=True)
-        else:
-            print(f"[DEBUG] User {user_id} is owner, bypassing cooldown.", flush=True)
-
-        # Remove bot mention from message content
-        content = message.content
-        for mention in message.mentions:
-            if mention == client.user:
-                content = re.sub(rf"<@!?{client.user.id}>", "", content)
-        content = content.strip()
-
-        # Generate AI response
-        # Debug: Generating AI response for mention
-        print(f"[DEBUG] Generating AI response for content: '{content}'", flush=True)
-        with SessionLocal() as db_session:
+        await handle_mention(message)
+        return
+
+    routed = route_command(message)
+    if routed is not None:
+        handler, args = routed
+        await handler(message, args)
+        return
+
+    await handle_chance_reply(message)
+
+async def handle_mention(message):
+    dispatch_logger.debug("Bot was mentioned by %s (%s) in message %s", message.author, message.author.id, message.id)
+    # Reload env for live config
+    reload_env()
+    BOT_OWNER_ID = int(os.getenv('BOT_OWNER_ID', 0))
+    AI_MENTION_COOLDOWN = int(os.getenv('AI_MENTION_COOLDOWN', 60))
+    # Determine mention model (override must differ from chat model)
+    mention_model_env = os.getenv('OPENROUTER_MENTION_MODEL')
+    chat_model = os.getenv('OPENROUTER_CHAT_MODEL')
+    if mention_model_env and mention_model_env != chat_model:
+        mention_model = mention_model_env
+    else:
+        mention_model = 'google/gemini-flash-1.5'
+    dispatch_logger.debug("Using mention model: %s", mention_model)
+
+    is_owner = message.author.id == BOT_OWNER_ID
+    now = time.time()
+    user_id = message.author.id
+
+    # Check cooldown (owner bypasses)
+    if not is_owner:
+        last_time = ai_mention_cooldowns.get(user_id, 0)
+        if now - last_time < AI_MENTION_COOLDOWN:
+            dispatch_logger.debug("User %s is on cooldown.", user_id)
+            # Silent on cooldown
+            return
+        dispatch_logger.debug("User %s is not on cooldown.", user_id)
+    else:
+        dispatch_logger.debug("User %s is owner, bypassing cooldown.", user_id)
+
+    # Remove bot mention from message content
+    content = message.content
+    for mention in message.mentions:
+        if mention == client.user:
+            content = re.sub(rf"<@!?{client.user.id}>", "", content)
+    content = content.strip()
+
+    # Generate AI response
+    dispatch_logger.debug("Generating AI response for content: %r", content)
+    try:
+        # Use the specific mention model from env
+        mention_system_prompt = os.getenv('MENTION_SYSTEM_PROMPT', "You are a helpful assistant responding to a user mention.")
+        mention_archive_guild = archive_guild_for(message.guild, guild_settings.get(message.guild.id if message.guild else None))
+        retrieved, retrieval_stats = await retrieve_for_prompt(content, mention_archive_guild)
+        response = await get_ai_response_async(content, model_override=mention_model, system_prompt_override=mention_system_prompt, retrieved_context=retrieved)
+        dispatch_logger.debug("AI response received (mention model): %r", response[:100] if response else response)
+        # Send the mention response
+        if response:
             try:
-                # Use the specific mention model from env
-                mention_system_prompt = os.getenv('MENTION_SYSTEM_PROMPT', "You are a helpful assistant responding to a user mention.")
-                response = get_ai_response(content, model_override=mention_model, system_prompt_override=mention_system_prompt)
-                print(f"[DEBUG] AI response received (mention model): '{response[:100]}...'", flush=True)
-                # Send the mention response
-                if response:
-                    try:
-                        sent_msg = await message.channel.send(response)
-                        print(f"[DEBUG] Mention response sent: {sent_msg.id}", flush=True)
-                    except Exception as e:
-                        print(f"[ERROR] Failed to send mention response: {e}", flush=True)
-                # Log the event
-                log_app_event(
-                    db_session,
-                    level="INFO",
-                    event_type="ai_mention_response",
-                    message="AI mention response sent.",
-                    extra={
-                        "user_id": user_id,
-                        "is_owner": is_owner,
-                        "content": content,
-                        "response_snippet": response[:100] if response else "",
-                        "trigger_message_id": message.id,
-                        "model": mention_model
-                    }
-                )
-                db_session.commit()
+                sent_msgs = await send_queue.send(message.channel, response)
+                dispatch_logger.debug("Mention response sent: %s", [m.id for m in sent_msgs])
             except Exception as e:
-                print(f"Error in AI mention handler: {e}", flush=True)
-                with SessionLocal() as db_session2:
-                    log_app_event(
-                        db_session2,
-                        level="ERROR",
-                        event_type="ai_mention_error",
-                        message=f"Error in AI mention handler: {e}",
-                        extra={"user_id": user_id, "content": content, "trigger_message_id": message.id}
-                    )
-                    db_session2.commit()
-        # Update cooldown
-        if not is_owner:
-            ai_mention_cooldowns[user_id] = now
+                dispatch_logger.error("Failed to send mention response: %s", e)
+        # Log the event
+        await log_event(
+            level="INFO",
+            event_type="ai_mention_response",
+            message="AI mention response sent.",
+            extra={
+                "user_id": user_id,
+                "is_owner": is_owner,
+                "content": content,
+                "response_snippet": response[:100] if response else "",
+                "trigger_message_id": message.id,
+                "model": mention_model,
+                "retrieval": retrieval_stats
+            }
+        )
+    except Exception as e:
+        dispatch_logger.error("Error in AI mention handler: %s", e)
+        await log_event(
+            level="ERROR",
+            event_type="ai_mention_error",
+            message=f"Error in AI mention handler: {e}",
+            extra={"user_id": user_id, "content": content, "trigger_message_id": message.id}
+        )
+    # Update cooldown
+    if not is_owner:
+        ai_mention_cooldowns[user_id] = now
+
+@command('delete_msg', owner_only=True)
+async def delete_msg_command(message, args):
+    if len(args) == 1 and args[0].isdigit():
+        msg_id_to_delete = int(args[0])
+        dispatch_logger.info("Attempting to delete message ID: %s by owner request.", msg_id_to_delete)
+        try:
+            deleted = await run_db(delete_message, msg_id_to_delete)
+            if deleted:
+                await log_event("INFO", "message_deleted", f"Owner deleted message ID {msg_id_to_delete}", extra={"deleted_by": message.author.id})
+                await send_queue.send(message.channel, f"Successfully deleted message ID `{msg_id_to_delete}` and its attachments from the archive.")
+            else:
+                await log_event("WARNING", "message_delete_failed", f"Owner failed to delete message ID {msg_id_to_delete} (not found?)", extra={"deleted_by": message.author.id})
+                await send_queue.send(message.channel, f"Could not find message ID `{msg_id_to_delete}` in the archive or deletion failed.")
+        except Exception as e:
+            dispatch_logger.error("Error during delete command: %s", e)
+            await log_event("ERROR", "message_delete_error", f"Error deleting message ID {msg_id_to_delete}: {e}", extra={"deleted_by": message.author.id})
+            await send_queue.send(message.channel, f"An error occurred while trying to delete message ID `{msg_id_to_delete}`.")
+    else:
+        await send_queue.send(message.channel, "Usage: `!delete_msg <message_id>`")
+
+async def handle_chance_reply(message):
+    # --- Probabilistic Response Logic ---
+    settings = guild_settings.get(message.guild.id if message.guild else None)
+    prob_archive = settings['prob_archive_reply']
+    prob_relevant = settings['prob_relevant_reply']
+    prob_ai = settings['prob_ai_reply']
+    action_roll = random.random() # Get a float between 0.0 and 1.0
+    if action_roll >= prob_archive + prob_relevant + prob_ai:
+        # Most messages end here, before any DB or API work
+        dispatch_logger.debug("Action Taken: No Action | Triggered by: %s", message.id)
         return
 
-    # Use a scoped session for this event
-    with SessionLocal() as db_session:
-        try:
-            # --- Delete Command Handling ---
-            if message.content.startswith('!delete_msg') and message.author.id == BOT_OWNER_ID:
-                parts = message.content.split()
-                if len(parts) == 2 and parts[1].isdigit():
-                    msg_id_to_delete = int(parts[1])
-                    print(f"Attempting to delete message ID: {msg_id_to_delete} by owner request.", flush=True)
-                    try:
-                        deleted = delete_message(db_session, msg_id_to_delete)
-                        if deleted:
-                            log_app_event(db_session, "INFO", "message_deleted", f"Owner deleted message ID {msg_id_to_delete}", extra={"deleted_by": message.author.id})
-                            await message.channel.send(f"Successfully deleted message ID `{msg_id_to_delete}` and its attachments from the archive.")
-                        else:
-                            log_app_event(db_session, "WARNING", "message_delete_failed", f"Owner failed to delete message ID {msg_id_to_delete} (not found?)", extra={"deleted_by": message.author.id})
-                            await message.channel.send(f"Could not find message ID `{msg_id_to_delete}` in the archive or deletion failed.")
-                    except Exception as e:
-                        print(f"Error during delete command: {e}", flush=True)
-                        log_app_event(db_session, "ERROR", "message_delete_error", f"Error deleting message ID {msg_id_to_delete}: {e}", extra={"deleted_by": message.author.id})
-                        await message.channel.send(f"An error occurred while trying to delete message ID `{msg_id_to_delete}`.")
-                else:
-                    await message.channel.send("Usage: `!delete_msg <message_id>`")
-                return # Stop processing after handling command
-
-            # --- Probabilistic Response Logic ---
-            action_roll = random.random() # Get a float between 0.0 and 1.0
-
-            response_content = None
-            action_taken = "None"
-
-            if action_roll < PROB_ARCHIVE_REPLY:
-                # Action: Post random archive content
-                action_taken = "Archive Reply"
-                # Decide whether to send text or attachment (if any attachments exist)
-                # This could be refined (e.g., check attachment count first)
-                if random.random() < 0.7: # 70% chance for text message
-                    random_msg = get_random_message(db_session)
-                    if not random_msg: # Fallback if no messages found
-                        att = get_random_attachment(db_session)
-                        if att:
-                            # Log the attachment event
-                            log_app_event(
-                                db_session,
-                                level="INFO",
-                                event_type="attachment_sent",
-                                message="Attachment sent as fallback (no messages found)",
-                                extra={
-                                    "attachment_id": att.attachment_id,
-                                    "filename": att.filename,
-                                    "url": att.url,
-                                    "content_type": att.content_type,
-                                    "trigger_message_id": message.id
-                                }
-                            )
-                            response_content = att.url  # Only send the URL
-                            action_taken += " (Fallback Attachment)"
-                        else:
-                            response_content = None
-                    else:
-                        response_content = random_msg.content # Get content for sending
-                        # Log the random message event with its ID
-                        log_app_event(
-                            db_session,
-                            level="INFO",
-                            event_type="random_message_sent",
-                            message="Random message retrieved from archive.",
-                            extra={
-                                "original_message_id": random_msg.message_id,
-                                "db_message_id": random_msg.id,
-                                "content_snippet": response_content[:100],
-                                "trigger_message_id": message.id
-                            }
-                        )
-                        action_taken += " (Text)"
-                else: # 30% chance for attachment
-                    att = get_random_attachment(db_session)
-                    if not att: # Fallback if no attachments found
-                        random_msg = get_random_message(db_session)
-                        if random_msg: # Check if fallback message was found
-                            response_content = random_msg.content # Get content for sending
-                             # Log the fallback random message event
-                            log_app_event(
-                                db_session,
-                                level="INFO",
-                                event_type="random_message_sent",
-                                message="Random message retrieved as fallback (no attachments found).",
-                                extra={
-                                    "original_message_id": random_msg.message_id,
-                                    "db_message_id": random_msg.id,
-                                    "content_snippet": response_content[:100],
-                                    "trigger_message_id": message.id
-                                }
-                            )
-                        action_taken += " (Fallback Text)"
-                    else:
+    # DB work runs on the DB thread pool (see async_db.py), each call in its own session
+    try:
+        archive_guild = archive_guild_for(message.guild, settings)
+        response_content = None
+        action_taken = "None"
+
+        if action_roll < prob_archive:
+            # Action: Post random archive content
+            action_taken = "Archive Reply"
+            # Decide whether to send text or attachment (if any attachments exist)
+            # This could be refined (e.g., check attachment count first)
+            if random.random() < 0.7: # 70% chance for text message
+                # Weighted pick; uniform until the sampler has loaded the archive
+                random_msg = (await run_db(archive_sampler.get_message, guild_id=archive_guild)
+                              or await run_db(get_random_unique_message, guild_id=archive_guild))
+                if not random_msg: # Fallback if no messages found
+                    att = await run_db(get_random_unique_attachment, guild_id=archive_guild)
+                    if att:
                         # Log the attachment event
-                        log_app_event(
-                            db_session,
+                        await log_event(
                             level="INFO",
                             event_type="attachment_sent",
-                            message="Attachment sent",
+                            message="Attachment sent as fallback (no messages found)",
                             extra={
                                 "attachment_id": att.attachment_id,
                                 "filename": att.filename,
@@ -367,83 +559,173 @@ async def on_message(message):
                             }
                         )
                         response_content = att.url  # Only send the URL
-                        action_taken += " (Attachment)"
-
-            elif action_roll < PROB_ARCHIVE_REPLY + PROB_AI_REPLY:
-                # Action: Generate AI response
-                action_taken = "AI Reply"
-                print(f"Generating AI response for: '{message.content}'", flush=True)
-                try:
-                    # Fetch context (recent messages from DB)
-                    context = get_recent_messages_for_context(db_session, limit=AI_CONTEXT_LIMIT)
-                    # TODO: Potentially add current conversation history if needed
-                    # For simplicity, just using user prompt + DB context for now
-                    response_content = get_ai_response(message.content, context_messages=context)
-                    if response_content:
-                         log_app_event(db_session, "INFO", "ai_response_success", f"AI generated response for message {message.id}", extra={"prompt": message.content, "response": response_content[:200], "trigger_message_id": message.id})
+                        action_taken += " (Fallback Attachment)"
                     else:
-                         log_app_event(db_session, "WARNING", "ai_response_empty", f"AI returned empty response for message {message.id}", extra={"prompt": message.content, "trigger_message_id": message.id})
+                        response_content = None
+                else:
+                    response_content = random_msg.content # Get content for sending
+                    # Log the random message event with its ID
+                    await log_event(
+                        level="INFO",
+                        event_type="random_message_sent",
+                        message="Random message retrieved from archive.",
+                        extra={
+                            "original_message_id": random_msg.message_id,
+                            "db_message_id": random_msg.id,
+                            "content_snippet": response_content[:100],
+                            "trigger_message_id": message.id
+                        }
+                    )
+                    action_taken += " (Text)"
+            else: # 30% chance for attachment
+                att = await run_db(get_random_unique_attachment, guild_id=archive_guild)
+                if not att: # Fallback if no attachments found
+                    random_msg = await run_db(get_random_unique_message, guild_id=archive_guild)
+                    if random_msg: # Check if fallback message was found
+                        response_content = random_msg.content # Get content for sending
+                         # Log the fallback random message event
+                        await log_event(
+                            level="INFO",
+                            event_type="random_message_sent",
+                            message="Random message retrieved as fallback (no attachments found).",
+                            extra={
+                                "original_message_id": random_msg.message_id,
+                                "db_message_id": random_msg.id,
+                                "content_snippet": response_content[:100],
+                                "trigger_message_id": message.id
+                            }
+                        )
+                    action_taken += " (Fallback Text)"
+                else:
+                    # Log the attachment event
+                    await log_event(
+                        level="INFO",
+                        event_type="attachment_sent",
+                        message="Attachment sent",
+                        extra={
+                            "attachment_id": att.attachment_id,
+                            "filename": att.filename,
+                            "url": att.url,
+                            "content_type": att.content_type,
+                            "trigger_message_id": message.id
+                        }
+                    )
+                    response_content = att.url  # Only send the URL
+                    action_taken += " (Attachment)"
+
+        elif action_roll < prob_archive + prob_relevant:
+            # Action: Post the archived message most related to this one
+            action_taken = "Relevant Archive Reply"
+            trigger = message.content.strip().casefold()
+            candidates = [m for m in await find_relevant_messages(message.content, guild_id=archive_guild)
+                          if m.message_id != message.id and m.content.strip().casefold() != trigger]
+            if candidates:
+                # Pick among the best few so the same trigger does not always get the same reply
+                relevant_msg = random.choice(candidates[:3])
+                response_content = relevant_msg.content
+                await log_event(
+                    level="INFO",
+                    event_type="relevant_message_sent",
+                    message="Relevant message retrieved from archive.",
+                    extra={
+                        "original_message_id": relevant_msg.message_id,
+                        "db_message_id": relevant_msg.id,
+                        "content_snippet": response_content[:100],
+                        "trigger_message_id": message.id
+                    }
+                )
+            else:
+                action_taken += " (No Match)"
 
-                except Exception as e:
-                    print(f"Error getting AI response: {e}", flush=True)
-                    response_content = "Sorry, I encountered an error trying to think of a reply."
-                    log_app_event(db_session, "ERROR", "ai_response_error", f"Error getting AI response for message {message.id}: {e}", extra={"prompt": message.content, "trigger_message_id": message.id})
+        elif action_roll < prob_archive + prob_relevant + prob_ai:
+            # Action: Generate AI response
+            action_taken = "AI Reply"
+            dispatch_logger.info("Generating AI response for: '%s'", message.content)
+            try:
+                # Precomputed style profile; recent messages until the profiles are built
+                context = style_profiles.get_context_for(STYLE_PROFILE_SCOPE, message.author.id, message.channel.id, guild_id=archive_guild)
+                if context is None:
+                    context = await run_db(get_recent_messages_for_context, limit=AI_CONTEXT_LIMIT, guild_id=archive_guild)
+                # TODO: Potentially add current conversation history if needed
+                # For simplicity, just using user prompt + DB context for now
+                retrieved, retrieval_stats = await retrieve_for_prompt(message.content, archive_guild)
+                response_content = await get_ai_response_async(message.content, context_messages=context, retrieved_context=retrieved)
+                if response_content:
+                     await log_event("INFO", "ai_response_success", f"AI generated response for message {message.id}", extra={"prompt": message.content, "response": response_content[:200], "trigger_message_id": message.id, "retrieval": retrieval_stats})
+                else:
+                     await log_event("WARNING", "ai_response_empty", f"AI returned empty response for message {message.id}", extra={"prompt": message.content, "trigger_message_id": message.id})
 
+            except Exception as e:
+                dispatch_logger.error("Error getting AI response: %s", e)
+                response_content = "Sorry, I encountered an error trying to think of a reply."
+                await log_event("ERROR", "ai_response_error", f"Error getting AI response for message {message.id}: {e}", extra={"prompt": message.content, "trigger_message_id": message.id})
 
-            else:
-                # Action: Do nothing
-                action_taken = "No Action"
-                pass
-
-            # Send the response if one was generated
-            if response_content:
-                try:
-                    sent_message = await message.channel.send(response_content)
-                    print(f"Action Taken: {action_taken} | Triggered by: {message.id} | Sent response: {sent_message.id} | Content: {response_content[:100]}...")
-                except discord.HTTPException as e:
-                    print(f"Error sending message (triggered by {message.id}): {e}")
-                    log_app_event(db_session, "ERROR", "send_message_error", f"Discord API error sending response for trigger {message.id}: {e}", extra={"response_content": response_content[:200], "trigger_message_id": message.id})
-                    # Handle cases like message too long, etc.
-                    if e.code == 50035: # Invalid Form Body (often means message too long)
-                         await message.reply(response_content[:1990] + "...") # Truncate
-                    else:
-                         await message.channel.send("I tried to send a response, but something went wrong.")
-                except Exception as e:
-                    print(f"Unexpected error sending message: {e}")
-                    log_app_event(db_session, "ERROR", "send_message_error", f"Unexpected error sending response for trigger {message.id}: {e}", extra={"response_content": response_content[:200], "trigger_message_id": message.id})
-                    await message.channel.send("An unexpected error occurred while sending the response.")
-            else:
-                 print(f"Action Taken: {action_taken} | Triggered by: {message.id} | No response sent.")
 
-            # Commit the session after all operations within the event are done
-            db_session.commit()
+        # Send the response if one was generated
+        if response_content:
+            try:
+                # Archive replies are interchangeable: in a busy channel only the newest waiting one is sent
+                sent_messages = await send_queue.send(message.channel, response_content, droppable=action_taken != "AI Reply")
+                if sent_messages is None:
+                    dispatch_logger.info("Action Taken: %s | Triggered by: %s | Dropped (channel busy)", action_taken, message.id)
+                else:
+                    dispatch_logger.info("Action Taken: %s | Triggered by: %s | Sent response: %s | Content: %s...", action_taken, message.id, [m.id for m in sent_messages], response_content[:100])
+            except Exception as e:
+                # No error reply here: more messages into a rate limited channel only make it worse
+                dispatch_logger.error("Error sending message (triggered by %s): %s", message.id, e)
+                await log_event("ERROR", "send_message_error", f"Error sending response for trigger {message.id}: {e}", extra={"response_content": response_content[:200], "trigger_message_id": message.id, "send_stats": send_queue.stats})
+        else:
+             dispatch_logger.info("Action Taken: %s | Triggered by: %s | No response sent.", action_taken, message.id)
 
-        except Exception as e:
-            print(f"Error processing message {message.id}: {e}", flush=True)
-            log_app_event(db_session, "ERROR", "message_processing_error", f"Error processing message {message.id}: {e}", extra={"message_content": message.content[:200]})
-            db_session.rollback()
-            await message.channel.send("An internal error occurred while processing your message.")
+    except Exception as e:
+        dispatch_logger.exception("Error processing message %s: %s", message.id, e)
+        try:
+            await log_event("ERROR", "message_processing_error", f"Error processing message {message.id}: {e}", extra={"message_content": message.content[:200]})
+        except Exception as log_e:
+            dispatch_logger.error("Failed to log processing error: %s", log_e)
+        try:
+            await send_queue.send(message.channel, "An internal error occurred while processing your message.", droppable=True)
+        except Exception as send_e:
+            dispatch_logger.error("Failed to send error notice: %s", send_e)
 
 
 async def main():
+    # Warn whenever something blocks the event loop (e.g. synchronous I/O slipping back in)
+    loop_monitor.start()
+    # Heartbeat file read by the web dashboard for liveness and latency
+    health_monitor.start()
+    background_tasks = [
+        asyncio.create_task(run_periodically("Guild settings", guild_settings.load, GUILD_SETTINGS_REFRESH)),
+        asyncio.create_task(run_periodically("Style profiles", refresh_style_profiles if IS_PRIMARY_SHARD else style_profiles.load, STYLE_PROFILE_REFRESH)),
+        asyncio.create_task(run_periodically("Archive sampler", archive_sampler.refresh, ARCHIVE_SAMPLER_REFRESH)),
+        asyncio.create_task(run_periodically("Lexical index", lexical_index.update if IS_PRIMARY_SHARD else reload_lexical_index, LEXICAL_INDEX_REFRESH)),
+        asyncio.create_task(revision_writer.run()),
+    ]
     async with client:
         try:
             await client.start(DISCORD_TOKEN)
         except discord.LoginFailure:
-            print("Error: Invalid DISCORD_TOKEN. Please check your .env file.")
+            logger.error("Invalid DISCORD_TOKEN. Please check your .env file.")
         except Exception as e:
-            print(f"An unexpected error occurred during bot execution: {e}")
+            logger.error("An unexpected error occurred during bot execution: %s", e)
         finally:
+            for task in background_tasks:
+                task.cancel()
+            # Buffered edits/deletes must not be lost
+            await revision_writer.flush()
             # Log shutdown
             try:
-                with SessionLocal() as db_session:
-                    log_app_event(db_session, "INFO", "bot_shutdown", "Bot shutting down.")
+                await log_event("INFO", "bot_shutdown", "Bot shutting down.")
             except Exception as log_e:
-                print(f"Failed to log shutdown event: {log_e}")
-            print("Bot shutting down.", flush=True)
+                logger.error("Failed to log shutdown event: %s", log_e)
+            loop_monitor.stop()
+            health_monitor.stop()
+            logger.info("Bot shutting down.")
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("Bot stopped manually.", flush=True)
+        logger.info("Bot stopped manually.")
+    finally:
+        shutdown_db_executor()
@@ -1,6 +1,12 @@
 # Database interaction module (using SQLAlchemy ORM)
+import hashlib
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Text, BigInteger, DateTime, UniqueConstraint, JSON
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+from sqlalchemy import create_engine, inspect, insert, select, text, union_all, Column, Integer, String, Text, BigInteger, Date, DateTime, Float, Index, UniqueConstraint, JSON
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.sql import func
 from dotenv import load_dotenv
@@ -45,8 +51,48 @@ class Message(Base):
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    content_hash = Column(String(32), index=True)  # message_content_hash() of the content
+    edited_at = Column(DateTime)  # Last edit seen in Discord (content is the edited text, see message_revisions)
+    deleted_at = Column(DateTime)  # Soft delete: deleted in Discord, kept for history
 
-    __table_args__ = (UniqueConstraint('message_id', name='uq_message_id'),)
+    __table_args__ = (
+        UniqueConstraint('message_id', name='uq_message_id'),
+        # Guild-scoped random picks seek by id within one guild
+        Index('ix_messages_guild_id_id', 'guild_id', 'id'),
+        # The messages page pages newest first through each tier
+        Index('ix_messages_timestamp', 'timestamp'),
+        # Random picks, context and search only read live rows; partial indexes keep deleted ones out of those scans
+        Index('ix_messages_live_id', 'id', postgresql_where=text('deleted_at IS NULL'), sqlite_where=text('deleted_at IS NULL')),
+        Index('ix_messages_live_guild_id_id', 'guild_id', 'id', postgresql_where=text('deleted_at IS NULL'), sqlite_where=text('deleted_at IS NULL')),
+    )
+
+# Messages moved out of the hot table by tiering.py. Same columns (keep in step with
+# Message) and the same ids, but only the indexes that lookups, guild-scoped picks,
+# duplicate counts and the messages page need. Read both tiers through tiered_messages() / get_message_by_id().
+class ColdMessage(Base):
+    __tablename__ = 'messages_cold'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # The row's id in messages
+    message_id = Column(BigInteger, nullable=False)
+    guild_id = Column(BigInteger, nullable=False)
+    channel_id = Column(BigInteger, nullable=False)
+    author_id = Column(BigInteger, nullable=False)
+    author_name = Column(String(255))
+    content = Column(Text, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    content_hash = Column(String(32), index=True)
+    edited_at = Column(DateTime)
+    deleted_at = Column(DateTime)
+
+    __table_args__ = (
+        UniqueConstraint('message_id', name='uq_message_cold_id'),
+        Index('ix_messages_cold_guild_id_id', 'guild_id', 'id'),
+        Index('ix_messages_cold_timestamp', 'timestamp'),
+    )
+
+# Hot tier first: recent messages, and most lookups, are found there
+MESSAGE_TIERS = (Message, ColdMessage)
 
 # Define the Attachment table
 class Attachment(Base):
@@ -59,22 +105,189 @@ class Attachment(Base):
     filename = Column(String(255))
     content_type = Column(String(100)) # e.g., 'image/png', 'video/mp4'
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    size = Column(BigInteger)  # Bytes, when known
+    content_hash = Column(String(32), index=True)  # attachment_content_hash() of the file
+    deleted_at = Column(DateTime)  # Set with its message's soft delete
+
+    __table_args__ = (
+        UniqueConstraint('attachment_id', name='uq_attachment_id'),
+        Index('ix_attachments_live_id', 'id', postgresql_where=text('deleted_at IS NULL'), sqlite_where=text('deleted_at IS NULL')),
+    )
+
+
+# Edit/delete history of archived messages (written by revisions.py from gateway events)
+class MessageRevision(Base):
+    __tablename__ = 'message_revisions'
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(BigInteger, nullable=False)
+    revision = Column(Integer, nullable=False)  # 1, 2, ... per message
+    event = Column(String(10), nullable=False)  # "edit" or "delete"
+    occurred_at = Column(DateTime, nullable=False)  # Discord's edit time, or when the delete was seen
+    # Edits: revisions.content_diff(new, previous), which rebuilds the previous content from the new one
+    diff = Column(JSON)
+
+    __table_args__ = (UniqueConstraint('message_id', 'revision', name='uq_message_revision'),)
+
+
+# --- Analytics rollups (maintained incrementally by rollups.py) ---
+
+# Messages per day per guild/channel/author
+class MessageDailyRollup(Base):
+    __tablename__ = 'message_daily_rollups'
+
+    day = Column(Date, primary_key=True)
+    guild_id = Column(BigInteger, primary_key=True)
+    channel_id = Column(BigInteger, primary_key=True)
+    author_id = Column(BigInteger, primary_key=True)
+    author_name = Column(String(255))
+    message_count = Column(Integer, nullable=False, default=0)
+
+# Attachments per day per guild/channel/content type ('' when unknown)
+class AttachmentDailyRollup(Base):
+    __tablename__ = 'attachment_daily_rollups'
+
+    day = Column(Date, primary_key=True)
+    guild_id = Column(BigInteger, primary_key=True)
+    channel_id = Column(BigInteger, primary_key=True)
+    content_type = Column(String(100), primary_key=True)
+    attachment_count = Column(Integer, nullable=False, default=0)
+
+# Highest source row id already folded into a rollup
+class RollupWatermark(Base):
+    __tablename__ = 'rollup_watermarks'
+
+    name = Column(String(50), primary_key=True)
+    last_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+# Precomputed style samples for the AI "copy the style" mode (built by style_profiles.py)
+class StyleProfile(Base):
+    __tablename__ = 'style_profiles'
 
-    __table_args__ = (UniqueConstraint('attachment_id', name='uq_attachment_id'),)
+    scope = Column(String(20), primary_key=True)  # "author", "channel" or "global"
+    scope_id = Column(BigInteger, primary_key=True)  # author/channel ID, 0 for global
+    samples = Column(JSON, nullable=False)  # [{"message_id", "author_name", "content", "timestamp"}, ...]
+    message_count = Column(Integer, nullable=False, default=0)  # Messages seen for this scope
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+# Per-guild overrides of the bot's .env settings (NULL = use the .env value), see guild_settings.py
+class GuildSettings(Base):
+    __tablename__ = 'guild_settings'
+
+    guild_id = Column(BigInteger, primary_key=True)
+    guild_name = Column(String(255))
+    prob_archive_reply = Column(Float)
+    prob_relevant_reply = Column(Float)
+    prob_ai_reply = Column(Float)
+    archive_guild_id = Column(BigInteger)  # Guild whose archive replies are drawn from
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
 
 # Function to initialize the database (create tables)
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
     print("Database tables created (if they didn't exist).")
 
+def _add_missing_columns():
+    """create_all() skips existing tables, so add columns (and their indexes) defined since a table was created."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    print(f"Added column {table.name}.{column.name}.")
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+# --- Content hashes (used for deduplication, see dedup.py) ---
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def _digest(value):
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=16).hexdigest()
+
+def message_content_hash(content):
+    """Hash of the content ignoring case and whitespace, so "OK", "ok " and "ok" match."""
+    return _digest(_WHITESPACE_RE.sub(' ', (content or '').casefold()).strip())
+
+def attachment_content_hash(filename, size, content_type, url):
+    """
+    Identifies the same file uploaded again under a new attachment ID.
+
+    Discord gives every upload its own URL, so with a known size the hash uses
+    file name, size and type. Rows archived before sizes were stored fall back
+    to the URL without its (expiring) query string, which only matches itself.
+    """
+    if size is not None:
+        return _digest(f"file|{(filename or '').casefold()}|{size}|{content_type or ''}")
+    parts = urlsplit(url or '')
+    return _digest(f"url|{parts.netloc}{parts.path}")
+
+# --- Message tiers (see tiering.py) ---
+
+def tiered_messages(*names, live_only=False):
+    """
+    Hot and cold messages as one UNION ALL subquery with the named columns (all
+    of them by default); filter and order on its .c columns. Only rows that are
+    not soft deleted with live_only.
+    """
+    names = names or [column.name for column in Message.__table__.columns]
+    parts = []
+    for model in MESSAGE_TIERS:
+        stmt = select(*(model.__table__.c[name] for name in names))
+        if live_only:
+            stmt = stmt.where(model.deleted_at.is_(None))
+        parts.append(stmt)
+    return union_all(*parts).subquery('tiered_messages')
+
+def get_message_by_id(db_session, row_id):
+    """The Message (or ColdMessage) with this row id, or None."""
+    for model in MESSAGE_TIERS:
+        message = db_session.get(model, row_id)
+        if message is not None:
+            return message
+    return None
+
+def get_messages_by_id(db_session, row_ids, guild_id=None, live_only=True):
+    """Messages/ColdMessages with these row ids (only from guild_id if given), in no particular order."""
+    messages = []
+    missing = set(row_ids)
+    for model in MESSAGE_TIERS:
+        if not missing:
+            break
+        query = db_session.query(model).filter(model.id.in_(missing))
+        if live_only:
+            query = query.filter(model.deleted_at.is_(None))
+        if guild_id is not None:
+            query = query.filter(model.guild_id == guild_id)
+        for message in query:
+            messages.append(message)
+            missing.discard(message.id)
+    return messages
+
+def archived_message_ids(db_session, message_ids):
+    """The Discord message IDs among message_ids that are archived in either tier."""
+    message_ids = list(message_ids)
+    existing = set()
+    for model in MESSAGE_TIERS:
+        existing.update(db_session.scalars(select(model.message_id).where(model.message_id.in_(message_ids))))
+    return existing
+
 # --- Functions for interacting with the database ---
 
 def add_message(db_session, msg_data):
     """Adds a message and its attachments to the database, ensuring uniqueness."""
     # Check if message already exists
-    existing_message = db_session.query(Message).filter(Message.message_id == msg_data['message_id']).first()
-    if existing_message:
+    if archived_message_ids(db_session, [msg_data['message_id']]):
         # print(f"Message {msg_data['message_id']} already exists. Skipping.")
         return False # Indicate skipped
 
@@ -86,7 +299,8 @@ def add_message(db_session, msg_data):
         author_id=msg_data['author_id'],
         author_name=msg_data['author_name'],
         content=msg_data['content'],
-        timestamp=msg_data['timestamp']
+        timestamp=msg_data['timestamp'],
+        content_hash=message_content_hash(msg_data['content'])
     )
     db_session.add(new_message)
 
@@ -100,7 +314,9 @@ def add_message(db_session, msg_data):
                 attachment_id=att_data['attachment_id'],
                 url=att_data['url'],
                 filename=att_data['filename'],
-                content_type=att_data['content_type']
+                content_type=att_data['content_type'],
+                size=att_data.get('size'),
+                content_hash=attachment_content_hash(att_data['filename'], att_data.get('size'), att_data['content_type'], att_data['url'])
             )
             db_session.add(new_attachment)
         # else:
@@ -114,35 +330,182 @@ def add_message(db_session, msg_data):
         print(f"Error adding message {msg_data['message_id']}: {e}")
         return False # Indicate failure
 
+def add_messages(db_session, records):
+    """
+    Bulk add_message() for the archiver: Core inserts that bypass the session's
+    identity map, one transaction per call. `records` carry the add_message()
+    fields as attributes, with attachments as (attachment_id, url, filename,
+    content_type, size) tuples. Already archived messages/attachments are
+    skipped (in either tier). Returns (added, skipped).
+    """
+    existing = archived_message_ids(db_session, [record.message_id for record in records])
+    new_records = []
+    for record in records:
+        if record.message_id not in existing:
+            existing.add(record.message_id)
+            new_records.append(record)
+    if new_records:
+        db_session.execute(insert(Message), [{
+            'message_id': record.message_id,
+            'guild_id': record.guild_id,
+            'channel_id': record.channel_id,
+            'author_id': record.author_id,
+            'author_name': record.author_name,
+            'content': record.content,
+            'timestamp': record.timestamp,
+            'content_hash': message_content_hash(record.content),
+        } for record in new_records])
+        attachments = [(record.message_id, attachment) for record in new_records for attachment in record.attachments]
+        if attachments:
+            existing_attachments = set(db_session.scalars(select(Attachment.attachment_id).where(
+                Attachment.attachment_id.in_([attachment[0] for _, attachment in attachments]))))
+            rows = []
+            for message_id, (attachment_id, url, filename, content_type, size) in attachments:
+                if attachment_id in existing_attachments:
+                    continue
+                existing_attachments.add(attachment_id)
+                rows.append({
+                    'message_id': message_id,
+                    'attachment_id': attachment_id,
+                    'url': url,
+                    'filename': filename,
+                    'content_type': content_type,
+                    'size': size,
+                    'content_hash': attachment_content_hash(filename, size, content_type, url),
+                })
+            if rows:
+                db_session.execute(insert(Attachment), rows)
+    db_session.commit()
+    return len(new_records), len(records) - len(new_records)
+
 def get_random_message(db_session):
     """Fetches a random Message object from the database."""
     # Note: Efficiently getting a random row can depend on DB size and engine.
     # This is a common approach but might be slow on very large tables.
     # Consider alternatives like indexed random sampling if performance is critical.
-    return db_session.query(Message).order_by(func.random()).first()
+    return db_session.query(Message).filter(Message.deleted_at.is_(None)).order_by(func.random()).first()
 
 def get_random_attachment(db_session):
     """Fetches a random Attachment object from the database."""
-    return db_session.query(Attachment).order_by(func.random()).first()
+    return db_session.query(Attachment).filter(Attachment.deleted_at.is_(None)).order_by(func.random()).first()
+
+# Random picks per unique-sample call before settling for the last one
+DEDUP_SAMPLE_TRIES = 8
+# Seconds a guild's id range is reused by random picks (newer rows are only picked after that)
+RANDOM_ID_BOUNDS_TTL = float(os.getenv('RANDOM_ID_BOUNDS_TTL', 60))
+
+def scope_to_guild(query, model, guild_id):
+    """Restricts a message (either tier) or Attachment query to one guild (attachments through their message)."""
+    if model is Attachment:
+        messages = tiered_messages('message_id', 'guild_id')
+        return query.join(messages, messages.c.message_id == Attachment.message_id).filter(messages.c.guild_id == guild_id)
+    return query.filter(model.guild_id == guild_id)
+
+def _first_live_row(db_session, model, guild_id, condition):
+    # Soft-deleted rows are skipped (served by the partial "live" indexes)
+    query = db_session.query(model).filter(model.deleted_at.is_(None), condition)
+    if guild_id is not None:
+        query = scope_to_guild(query, model, guild_id)
+    return query.order_by(model.id).first()
+
+# (tier, guild_id) -> (expires at, (min id, max id)) for guild-scoped random picks
+_id_bounds = {}
+_id_bounds_lock = threading.Lock()
+
+def _id_range(db_session, tier, guild_id):
+    query = db_session.query(func.min(tier.id), func.max(tier.id))
+    if guild_id is None:
+        return query.one()
+    # A guild's range costs a scan of its rows (attachments join the messages), and
+    # _get_random_unique() asks for it on every try, so it is cached for a while
+    key = (tier.__tablename__, guild_id)
+    now = time.monotonic()
+    with _id_bounds_lock:
+        cached = _id_bounds.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    bounds = tuple(scope_to_guild(query, tier, guild_id).one())
+    with _id_bounds_lock:
+        _id_bounds[key] = (now + RANDOM_ID_BOUNDS_TTL, bounds)
+    return bounds
 
-def get_recent_messages_for_context(db_session, limit=50):
-    """Fetches recent messages to potentially use as context for the AI."""
-    messages = db_session.query(Message.author_name, Message.content)\
-                         .order_by(Message.timestamp.desc())\
-                         .limit(limit)\
+def _random_row_by_id(db_session, model, guild_id=None):
+    """
+    The first live row at or after a random id (from one guild if guild_id is
+    given), or None. Seeking to a random id avoids ORDER BY random(), which
+    sorts the whole table, but a row is picked in proportion to the id gap
+    before it: rows after deleted ones, or after another guild's run of ids,
+    come up more often. Only dense id ranges give uniform picks; the archive
+    sampler's buckets are uniform for messages.
+    """
+    # Messages keep their id when moved to the cold tier, so both tiers share one id range.
+    models = MESSAGE_TIERS if model is Message else (model,)
+    # The guild's own id range: a pivot outside it would always land on its first row
+    bounds = [_id_range(db_session, tier, guild_id) for tier in models]
+    bounds = [(low, high) for low, high in bounds if low is not None]
+    if not bounds:
+        return None
+    pivot = random.randint(min(low for low, _ in bounds), max(high for _, high in bounds))
+
+    def first(condition):
+        rows = [_first_live_row(db_session, tier, guild_id, condition(tier)) for tier in models]
+        return min((row for row in rows if row is not None), key=lambda row: row.id, default=None)
+    # Wrap around when there are no (guild) rows above the pivot
+    return first(lambda tier: tier.id >= pivot) or first(lambda tier: tier.id < pivot)
+
+def _get_random_unique(db_session, model, max_tries, pick=_random_row_by_id, guild_id=None):
+    candidate = None
+    models = MESSAGE_TIERS if model is Message else (model,)
+    for _ in range(max_tries):
+        candidate = pick(db_session, model, guild_id)
+        if candidate is None or candidate.content_hash is None:
+            return candidate
+        copies = sum(db_session.query(func.count(tier.id)).filter(tier.content_hash == candidate.content_hash, tier.deleted_at.is_(None)).scalar()
+                     for tier in models)
+        # Keeping a pick with probability 1/copies makes every distinct content as likely as the pick allows
+        if random.random() * copies < 1:
+            return candidate
+    return candidate
+
+def get_random_unique_message(db_session, guild_id=None, max_tries=DEDUP_SAMPLE_TRIES, pick=_random_row_by_id):
+    """
+    Fetches a random message (from one guild if guild_id is given), weighting
+    repeated content down by its number of copies so spam is not favoured.
+    `pick(db_session, Message, guild_id)` supplies the candidates (by default
+    _random_row_by_id(), which favours rows after id gaps).
+    """
+    return _get_random_unique(db_session, Message, max_tries, pick, guild_id)
+
+def get_random_unique_attachment(db_session, guild_id=None, max_tries=DEDUP_SAMPLE_TRIES):
+    """Fetches a random attachment (from one guild if guild_id is given), weighting repeated files down like get_random_unique_message."""
+    return _get_random_unique(db_session, Attachment, max_tries, guild_id=guild_id)
+
+def get_recent_messages_for_context(db_session, limit=50, guild_id=None):
+    """Fetches recent messages (from one guild if guild_id is given) to potentially use as context for the AI."""
+    messages = []
+    # Recent messages are hot; the cold tier only tops up a short hot table
+    for model in MESSAGE_TIERS:
+        query = db_session.query(model.author_name, model.content).filter(model.deleted_at.is_(None))
+        if guild_id is not None:
+            query = query.filter(model.guild_id == guild_id)
+        messages += query.order_by(model.timestamp.desc())\
+                         .limit(limit - len(messages))\
                          .all()
+        if len(messages) >= limit:
+            break
     # Format for AI context (e.g., "User1: message\nUser2: another message")
     context = "\n".join([f"{name}: {content}" for name, content in reversed(messages)])
     return context
 
-
 def delete_message(db_session, message_id_to_delete):
-    """Deletes a message and its associated attachments by message_id."""
+    """Deletes a message, its attachments and its revision history by message_id."""
     try:
         # Delete attachments first (if any)
         db_session.query(Attachment).filter(Attachment.message_id == message_id_to_delete).delete()
-        # Delete the message
-        deleted_count = db_session.query(Message).filter(Message.message_id == message_id_to_delete).delete()
+        db_session.query(MessageRevision).filter(MessageRevision.message_id == message_id_to_delete).delete()
+        # Delete the message (from whichever tier holds it)
+        deleted_count = sum(db_session.query(model).filter(model.message_id == message_id_to_delete).delete()
+                            for model in MESSAGE_TIERS)
         db_session.commit()
         return deleted_count > 0 # Return True if a message was deleted
     except Exception as e:
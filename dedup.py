@@ -0,0 +1,117 @@
+# Content-hash backfill and duplicate report for messages and attachments
+import argparse
+import os
+import sys
+from sqlalchemy import func, select, update
+from database import SessionLocal, Attachment, MESSAGE_TIERS, init_db, message_content_hash, attachment_content_hash, tiered_messages
+
+DEDUP_BATCH_SIZE = int(os.getenv('DEDUP_BATCH_SIZE', 10000))
+
+
+def _backfill(db_session, model, columns, hash_row, batch_size):
+    last_id = 0
+    updated = 0
+    while True:
+        rows = db_session.execute(
+            select(model.id, *columns)
+            .where(model.content_hash.is_(None), model.id > last_id)
+            .order_by(model.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return updated
+        # Bulk UPDATE by primary key, one statement per batch
+        db_session.execute(update(model), [{"id": row.id, "content_hash": hash_row(row)} for row in rows])
+        db_session.commit()
+        last_id = rows[-1].id
+        updated += len(rows)
+
+
+def backfill_hashes(db_session, batch_size=DEDUP_BATCH_SIZE):
+    """
+    Fills in content_hash for rows stored before hashing was added (or bulk
+    imported without one), in id order and committing each batch.
+    Returns (messages_updated, attachments_updated).
+    """
+    messages = sum(_backfill(db_session, model, [model.content], lambda row: message_content_hash(row.content), batch_size)
+                   for model in MESSAGE_TIERS)
+    attachments = _backfill(db_session, Attachment, [Attachment.filename, Attachment.size, Attachment.content_type, Attachment.url],
+                            lambda row: attachment_content_hash(row.filename, row.size, row.content_type, row.url), batch_size)
+    return messages, attachments
+
+
+def duplicate_report(db_session, top=10):
+    """
+    Summarises duplicate content and the space removing the extra copies would
+    free. Text bytes are character counts; attachment bytes only cover rows
+    with a known size.
+    """
+    messages = tiered_messages('id', 'content', 'content_hash')
+    copies = func.count(messages.c.id)
+    text_bytes = func.sum(func.length(messages.c.content))
+    message_groups = db_session.execute(
+        select(messages.c.content_hash, copies, text_bytes, func.min(messages.c.content))
+        .where(messages.c.content_hash.is_not(None))
+        .group_by(messages.c.content_hash)
+        .having(copies > 1)
+    ).all()
+
+    att_copies = func.count(Attachment.id)
+    attachment_groups = db_session.execute(
+        select(Attachment.content_hash, att_copies, func.sum(Attachment.size), func.min(Attachment.filename))
+        .where(Attachment.content_hash.is_not(None))
+        .group_by(Attachment.content_hash)
+        .having(att_copies > 1)
+    ).all()
+
+    def reclaimable(count, total):
+        # Every copy but one could go
+        return int((total or 0) * (count - 1) / count)
+
+    message_groups.sort(key=lambda g: g[1], reverse=True)
+    attachment_groups.sort(key=lambda g: g[1], reverse=True)
+    return {
+        "messages": {
+            "total": sum(db_session.query(func.count(model.id)).scalar() for model in MESSAGE_TIERS),
+            "duplicate_groups": len(message_groups),
+            "duplicate_rows": sum(g[1] - 1 for g in message_groups),
+            "reclaimable_bytes": sum(reclaimable(g[1], g[2]) for g in message_groups),
+            "top": [{"content": g[3][:80], "copies": g[1]} for g in message_groups[:top]],
+        },
+        "attachments": {
+            "total": db_session.query(func.count(Attachment.id)).scalar(),
+            "duplicate_groups": len(attachment_groups),
+            "duplicate_rows": sum(g[1] - 1 for g in attachment_groups),
+            "reclaimable_bytes": sum(reclaimable(g[1], g[2]) for g in attachment_groups),
+            "top": [{"filename": g[3], "copies": g[1]} for g in attachment_groups[:top]],
+        },
+    }
+
+
+def print_report(report):
+    for table, label in (("messages", "content"), ("attachments", "filename")):
+        stats = report[table]
+        print(f"{table.capitalize()}: {stats['total']:,} rows, {stats['duplicate_rows']:,} duplicate rows "
+              f"in {stats['duplicate_groups']:,} groups, ~{stats['reclaimable_bytes'] / 1024 / 1024:.1f} MB reclaimable")
+        for entry in stats["top"]:
+            print(f"  {entry['copies']:>7,}x  {entry[label]!r}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill content hashes and report duplicate messages/attachments.")
+    parser.add_argument('--no-backfill', action='store_true', help="Only print the report.")
+    parser.add_argument('--batch-size', type=int, default=DEDUP_BATCH_SIZE)
+    parser.add_argument('--top', type=int, default=10, help="Most repeated entries to list per table.")
+    args = parser.parse_args(argv)
+
+    init_db()
+    with SessionLocal() as db_session:
+        if not args.no_backfill:
+            messages, attachments = backfill_hashes(db_session, batch_size=args.batch_size)
+            print(f"Hashed {messages:,} messages and {attachments:,} attachments.")
+        print_report(duplicate_report(db_session, top=args.top))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
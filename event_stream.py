@@ -0,0 +1,101 @@
+# Server-Sent Events fan-out for the web dashboard
+import json
+import queue
+import threading
+
+
+class EventBroadcaster:
+    """
+    Runs one background poller thread per process and pushes its events to every
+    connected SSE client.
+
+    Pollers are callables returning an iterable of (event_name, data) tuples. They
+    only run while at least one client is connected, so idle dashboards cost nothing.
+    The latest event of each name listed in `replay` is sent to clients as they
+    connect, so a new tab shows current state without waiting for a change.
+    """
+
+    def __init__(self, interval=5.0, keepalive=15.0, max_queue=200, replay=()):
+        self.interval = interval
+        self.keepalive = keepalive
+        self.max_queue = max_queue
+        self.replay = set(replay)
+        self._pollers = []
+        self._subscribers = set()
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add_poller(self, poller):
+        self._pollers.append(poller)
+
+    def publish(self, event, data):
+        """Sends an event to all connected clients. Clients that fall too far behind drop old events."""
+        payload = f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+        with self._lock:
+            if event in self.replay:
+                self._latest[event] = payload
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(payload)
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    q.put_nowait(payload)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def poll_now(self):
+        """Wakes the poller early (e.g. right after a control action)."""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                has_subscribers = bool(self._subscribers)
+            if has_subscribers:
+                for poller in self._pollers:
+                    try:
+                        for event, data in poller():
+                            self.publish(event, data)
+                    except Exception as e:
+                        print(f"Error in event poller {getattr(poller, '__name__', poller)}: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="event-poller", daemon=True)
+            self._thread.start()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            for payload in self._latest.values():
+                q.put_nowait(payload)
+            self._subscribers.add(q)
+        self._ensure_started()
+        # Run the pollers promptly for the first client after an idle period
+        self.poll_now()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def stream(self):
+        """Generator for a Flask streaming response (mimetype text/event-stream)."""
+        q = self.subscribe()
+        try:
+            # Tell the browser how long to wait before reconnecting
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    yield q.get(timeout=self.keepalive)
+                except queue.Empty:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(q)
@@ -0,0 +1,247 @@
+# Streaming export of the archive (messages, attachments, app logs) to NDJSON or Parquet
+import argparse
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+import zlib
+from sqlalchemy import select
+from database import SessionLocal, Message, Attachment, AppLog, MessageRevision, tiered_messages
+
+EXPORT_TABLES = {
+    'messages': Message,
+    'attachments': Attachment,
+    'message_revisions': MessageRevision,
+    'app_logs': AppLog,
+}
+# JSON columns, written to Parquet as text
+EXPORT_JSON_COLUMNS = ('extra', 'diff')
+EXPORT_COMPRESSIONS = ('gzip', 'zstd', 'none')
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 5000))
+# Bytes of NDJSON to buffer before compressing/yielding a chunk
+EXPORT_FLUSH_BYTES = 256 * 1024
+
+
+def build_export_query(table, guild_id=None, channel_id=None, since=None, until=None):
+    """
+    Builds a column-only SELECT for an export, ordered by id.
+
+    Messages come from both tiers; attachments and message revisions are
+    filtered through their parent message. App logs have no guild/channel columns, so only the
+    time range applies to them.
+    """
+    model = EXPORT_TABLES[table]
+    messages = tiered_messages()
+    if table == 'messages':
+        stmt = select(messages).order_by(messages.c.id)
+    else:
+        stmt = select(*model.__table__.columns).order_by(model.id)
+
+    if table == 'app_logs':
+        if guild_id is not None or channel_id is not None:
+            raise ValueError("app_logs can only be filtered by time range.")
+        if since is not None:
+            stmt = stmt.where(AppLog.timestamp >= since)
+        if until is not None:
+            stmt = stmt.where(AppLog.timestamp < until)
+        return stmt
+
+    if table != 'messages' and any(v is not None for v in (guild_id, channel_id, since, until)):
+        stmt = stmt.join(messages, messages.c.message_id == model.message_id)
+    if guild_id is not None:
+        stmt = stmt.where(messages.c.guild_id == guild_id)
+    if channel_id is not None:
+        stmt = stmt.where(messages.c.channel_id == channel_id)
+    if since is not None:
+        stmt = stmt.where(messages.c.timestamp >= since)
+    if until is not None:
+        stmt = stmt.where(messages.c.timestamp < until)
+    return stmt
+
+
+def iter_export_rows(db_session, stmt, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields rows as dicts using a server-side cursor, chunk_size rows at a time.
+
+    No ORM objects are created and only one chunk is held in memory.
+    """
+    result = db_session.execute(stmt.execution_options(yield_per=chunk_size))
+    for row in result.mappings():
+        yield dict(row)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def iter_ndjson(rows, flush_bytes=EXPORT_FLUSH_BYTES):
+    """Encodes rows as NDJSON, yielding byte chunks of roughly flush_bytes."""
+    buffer = []
+    size = 0
+    for row in rows:
+        line = json.dumps(row, ensure_ascii=False, default=_json_default).encode('utf-8') + b'\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= flush_bytes:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def check_compression(compression):
+    """Raises ValueError for an unknown compression, or zstd without the zstandard package."""
+    if compression not in EXPORT_COMPRESSIONS:
+        raise ValueError(f"Unknown compression '{compression}'.")
+    if compression == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise ValueError("zstd export requires the 'zstandard' package (pip install zstandard).")
+
+
+def iter_compressed(chunks, compression):
+    """
+    Compresses a stream of byte chunks incrementally ('gzip', 'zstd' or 'none').
+    Call check_compression() first when a failure must not happen mid-stream.
+    """
+    check_compression(compression)
+    if compression == 'none':
+        yield from chunks
+        return
+    if compression == 'gzip':
+        # wbits=31 writes a gzip header/trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        finish = compressor.flush
+    else:
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        finish = compressor.flush
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def stream_export(table, compression='gzip', chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """
+    Generator of compressed NDJSON bytes for an export. Opens and closes its own
+    session, so it can be handed straight to a streaming HTTP response.
+    """
+    stmt = build_export_query(table, **filters)
+    db_session = SessionLocal()
+    try:
+        rows = iter_export_rows(db_session, stmt, chunk_size=chunk_size)
+        yield from iter_compressed(iter_ndjson(rows), compression)
+    finally:
+        db_session.close()
+
+
+def export_file_extension(compression):
+    return {'gzip': '.ndjson.gz', 'zstd': '.ndjson.zst', 'none': '.ndjson'}[compression]
+
+
+def write_parquet(table, path, chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """Writes an export to a Parquet file one row group per chunk. Returns the row count."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Parquet export requires the 'pyarrow' package (pip install pyarrow).")
+
+    stmt = build_export_query(table, **filters)
+    writer = None
+    count = 0
+    with SessionLocal() as db_session:
+        result = db_session.execute(stmt.execution_options(yield_per=chunk_size))
+        try:
+            for partition in result.mappings().partitions():
+                rows = [dict(row) for row in partition]
+                for row in rows:
+                    # JSON columns (app_logs.extra, message_revisions.diff) are stored as text
+                    for column in EXPORT_JSON_COLUMNS:
+                        if row.get(column) is not None:
+                            row[column] = json.dumps(row[column], ensure_ascii=False, default=_json_default)
+                batch = pa.Table.from_pylist(rows)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, batch.schema, compression='zstd')
+                writer.write_table(batch.cast(writer.schema))
+                count += len(rows)
+        finally:
+            if writer is not None:
+                writer.close()
+    return count
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _parse_datetime(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export archive tables to compressed NDJSON or Parquet.")
+    parser.add_argument('table', choices=sorted(EXPORT_TABLES))
+    parser.add_argument('-o', '--output', help="Output file ('-' for stdout). Defaults to <table><ext> in the current directory.")
+    parser.add_argument('--format', choices=('ndjson', 'parquet'), default='ndjson')
+    parser.add_argument('--compression', choices=EXPORT_COMPRESSIONS, default='gzip', help="NDJSON compression (default gzip).")
+    parser.add_argument('--guild-id', type=int)
+    parser.add_argument('--channel-id', type=int)
+    parser.add_argument('--since', type=_parse_datetime, help="Inclusive start, ISO format (e.g. 2023-01-01).")
+    parser.add_argument('--until', type=_parse_datetime, help="Exclusive end, ISO format.")
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    parser.add_argument('--benchmark', action='store_true', help="Print rows/sec and peak RSS when done.")
+    args = parser.parse_args(argv)
+
+    filters = {'guild_id': args.guild_id, 'channel_id': args.channel_id, 'since': args.since, 'until': args.until}
+    start_time = time.perf_counter()
+
+    try:
+        if args.format == 'parquet':
+            output = args.output or f"{args.table}.parquet"
+            rows_written = write_parquet(args.table, output, chunk_size=args.chunk_size, **filters)
+        else:
+            output = args.output or f"{args.table}{export_file_extension(args.compression)}"
+            counter = {'rows': 0}
+
+            def counted(rows):
+                for row in rows:
+                    counter['rows'] += 1
+                    yield row
+
+            # Before the output file is created
+            check_compression(args.compression)
+            stmt = build_export_query(args.table, **filters)
+            out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+            try:
+                with SessionLocal() as db_session:
+                    rows = counted(iter_export_rows(db_session, stmt, chunk_size=args.chunk_size))
+                    for chunk in iter_compressed(iter_ndjson(rows), args.compression):
+                        out.write(chunk)
+            finally:
+                if out is not sys.stdout.buffer:
+                    out.close()
+            rows_written = counter['rows']
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    duration = time.perf_counter() - start_time
+    print(f"Exported {rows_written} {args.table} rows to {output} in {duration:.1f}s", file=sys.stderr)
+    if args.benchmark:
+        rate = rows_written / duration if duration > 0 else 0
+        print(f"Benchmark: {rate:,.0f} rows/sec, peak RSS {peak_rss_mb():.1f} MB", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
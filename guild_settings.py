@@ -0,0 +1,58 @@
+# Per-guild bot settings: .env defaults overridden by rows in guild_settings
+from sqlalchemy import select
+from database import GuildSettings
+
+# Columns a guild can override; NULL means "use the default"
+GUILD_SETTING_FIELDS = ('prob_archive_reply', 'prob_relevant_reply', 'prob_ai_reply', 'archive_guild_id')
+PROBABILITY_FIELDS = ('prob_archive_reply', 'prob_relevant_reply', 'prob_ai_reply')
+
+
+def validate_guild_settings(values, defaults):
+    """Raises ValueError if the overrides (merged with defaults) are not usable."""
+    merged = {**defaults, **{k: v for k, v in values.items() if v is not None}}
+    for field in PROBABILITY_FIELDS:
+        if not 0.0 <= merged[field] <= 1.0:
+            raise ValueError(f"{field} must be between 0.0 and 1.0.")
+    if sum(merged[field] for field in PROBABILITY_FIELDS) > 1.0:
+        raise ValueError("The reply probabilities cannot add up to more than 1.0.")
+
+
+def save_guild_settings(db_session, guild_id, guild_name=None, **values):
+    """Creates or updates a guild's overrides. Commit happens in the calling scope."""
+    row = db_session.get(GuildSettings, guild_id)
+    if row is None:
+        row = GuildSettings(guild_id=guild_id)
+        db_session.add(row)
+    row.guild_name = guild_name
+    for field in GUILD_SETTING_FIELDS:
+        setattr(row, field, values.get(field))
+    return row
+
+
+class GuildSettingsCache:
+    """
+    All guild overrides held in memory, so per-message lookups never hit the
+    database. load() rereads the (small) table; the bot calls it periodically
+    so changes made from the web UI apply without a restart.
+    """
+
+    def __init__(self, defaults):
+        self.defaults = dict(defaults)
+        self._settings = {}
+
+    def load(self, db_session):
+        """Rereads all overrides. Returns True if anything changed."""
+        settings = {}
+        columns = [getattr(GuildSettings, field) for field in GUILD_SETTING_FIELDS]
+        for guild_id, *values in db_session.execute(select(GuildSettings.guild_id, *columns)):
+            merged = dict(self.defaults)
+            merged.update((field, value) for field, value in zip(GUILD_SETTING_FIELDS, values) if value is not None)
+            settings[guild_id] = merged
+        changed = settings != self._settings
+        # Swap in one assignment so readers never see a half-built dict
+        self._settings = settings
+        return changed
+
+    def get(self, guild_id):
+        """Effective settings for a guild (the defaults for DMs and guilds without overrides)."""
+        return self._settings.get(guild_id, self.defaults)
@@ -0,0 +1,27 @@
+# Gunicorn settings for the web dashboard: gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+
+wsgi_app = "web_app:create_app()"
+bind = os.getenv('WEB_BIND', '0.0.0.0:8080')
+
+# Pages are mostly database and cache reads, so a few processes go a long way;
+# threads matter more because every open dashboard tab holds one for its SSE stream
+workers = int(os.getenv('WEB_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 4)))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 16))
+timeout = int(os.getenv('WEB_TIMEOUT', 60))
+keepalive = 5
+# Recycle workers now and then to cap slow memory growth
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 2000))
+max_requests_jitter = 200
+
+# Import the app (settings, .env discovery, templates) once in the master; workers fork from it
+preload_app = True
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    # Connections opened before the fork must not be shared; each worker starts its own pool
+    from database import engine
+    engine.dispose(close=False)
@@ -0,0 +1,144 @@
+# Bot health sampling and heartbeat file (read by the web dashboard)
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+
+logger = logging.getLogger('bot.health')
+
+HEALTH_SAMPLE_INTERVAL = float(os.getenv('HEALTH_SAMPLE_INTERVAL', 5))
+HEALTH_HISTORY_SIZE = int(os.getenv('HEALTH_HISTORY_SIZE', 60))
+HEARTBEAT_FILE = os.getenv('BOT_HEARTBEAT_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot_heartbeat.json'))
+# The dashboard treats the bot as down once the heartbeat is this old
+HEARTBEAT_STALE_SECONDS = float(os.getenv('HEARTBEAT_STALE_SECONDS', HEALTH_SAMPLE_INTERVAL * 3))
+
+
+def _ms(seconds):
+    if seconds is None or seconds != seconds or seconds == float('inf'):  # latency is inf/nan before the first heartbeat ack
+        return None
+    return round(seconds * 1000, 1)
+
+
+class HealthMonitor:
+    """
+    Samples gateway latency, event loop lag, reconnects and in-flight message
+    handlers every few seconds into a ring buffer, and writes the latest sample
+    plus the buffer to a small JSON heartbeat file.
+    """
+
+    def __init__(self, client, loop_monitor, interval=HEALTH_SAMPLE_INTERVAL, path=HEARTBEAT_FILE, history_size=HEALTH_HISTORY_SIZE):
+        self.client = client
+        self.loop_monitor = loop_monitor
+        self.interval = interval
+        self.path = path
+        self.history = deque(maxlen=history_size)
+        self.started_at = time.time()
+        self.in_flight = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.resumes = 0
+        self._task = None
+
+    # --- Event hooks (called from bot.py) ---
+
+    def record_connect(self):
+        self.connects += 1
+
+    def record_disconnect(self):
+        self.disconnects += 1
+
+    def record_resume(self):
+        self.resumes += 1
+
+    def handler_started(self):
+        self.in_flight += 1
+
+    def handler_finished(self):
+        self.in_flight -= 1
+
+    # --- Sampling ---
+
+    def sample(self):
+        """Takes one sample, appends it to the ring buffer and returns it."""
+        entry = {
+            "ts": round(time.time(), 1),
+            "latency_ms": _ms(self.client.latency),
+            "loop_lag_ms": _ms(self.loop_monitor.pop_max_lag()),
+            "in_flight": self.in_flight,
+        }
+        self.history.append(entry)
+        return entry
+
+    def snapshot(self, state="running"):
+        latest = self.history[-1] if self.history else {}
+        return {
+            "state": state,
+            "pid": os.getpid(),
+            "started_at": round(self.started_at, 1),
+            "ts": round(time.time(), 1),
+            "ready": self.client.is_ready(),
+            "guilds": len(self.client.guilds),
+            "latency_ms": latest.get("latency_ms"),
+            "loop_lag_ms": latest.get("loop_lag_ms"),
+            "in_flight": self.in_flight,
+            # The first connect is not a reconnect
+            "reconnects": max(self.connects - 1, 0) + self.resumes,
+            "disconnects": self.disconnects,
+            "history": [[s["ts"], s["latency_ms"], s["loop_lag_ms"], s["in_flight"]] for s in self.history],
+        }
+
+    def _write_file(self, data):
+        # Write then rename so readers never see a partial file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def write_heartbeat(self, state="running"):
+        """Atomically replaces the heartbeat file with the current snapshot."""
+        self._write_file(json.dumps(self.snapshot(state), separators=(',', ':')))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.sample()
+            # Snapshot on the loop, write the file off it
+            data = json.dumps(self.snapshot(), separators=(',', ':'))
+            try:
+                await loop.run_in_executor(None, self._write_file, data)
+            except OSError as e:
+                logger.warning("Failed to write heartbeat file %s: %s", self.path, e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """Stops sampling and marks the heartbeat as stopped so the dashboard updates immediately."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            self.write_heartbeat(state="stopped")
+        except OSError as e:
+            logger.warning("Failed to write final heartbeat: %s", e)
+
+
+def read_heartbeat(path=HEARTBEAT_FILE, stale_after=HEARTBEAT_STALE_SECONDS):
+    """
+    Reads the heartbeat file written by the bot.
+
+    Returns a dict with an added 'age' (seconds) and 'alive' flag, or None if
+    the file is missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    data['age'] = round(max(time.time() - data.get('ts', 0), 0), 1)
+    data['alive'] = data.get('state') == 'running' and data['age'] <= stale_after
+    return data
@@ -0,0 +1,139 @@
+# Conditional responses, compression and a short-lived render cache for the web UI
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, make_response, request, session
+
+try:
+    import brotli  # optional; gzip is used without it
+except ImportError:
+    brotli = None
+
+HTTP_COMPRESS_MIN_SIZE = int(os.getenv('HTTP_COMPRESS_MIN_SIZE', 1024))
+HTTP_RENDER_CACHE_TTL = float(os.getenv('HTTP_RENDER_CACHE_TTL', 10))
+HTTP_RENDER_CACHE_SIZE = int(os.getenv('HTTP_RENDER_CACHE_SIZE', 128))
+COMPRESSIBLE_TYPES = {'text/html', 'text/plain', 'text/css', 'text/javascript', 'application/javascript', 'application/json'}
+
+
+def choose_encoding():
+    """Best content coding the client accepts: 'br', 'gzip' or None."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def encode_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def compress_response(response):
+    """after_request hook: compresses large text responses (streams and files are left alone)."""
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    body = response.get_data()
+    if encoding is None or len(body) < HTTP_COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(encode_body(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class RenderCache:
+    """
+    Rendered response bodies keyed by ETag, per process, for a few seconds.
+    Compressed copies are kept next to the body so repeat hits skip both
+    rendering and compression.
+    """
+
+    def __init__(self, ttl=HTTP_RENDER_CACHE_TTL, max_entries=HTTP_RENDER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # etag -> (stored_at, mimetype, {encoding: body})
+        self._lock = threading.Lock()
+
+    def get(self, etag):
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[etag]
+                return None
+            self._entries.move_to_end(etag)
+            return entry
+
+    def put(self, etag, mimetype, body):
+        entry = (time.monotonic(), mimetype, {None: body})
+        with self._lock:
+            self._entries[etag] = entry
+            self._entries.move_to_end(etag)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
+render_cache = RenderCache()
+
+
+def make_etag(*parts):
+    data = json.dumps(parts, default=str, sort_keys=True).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _cached_response(etag, entry):
+    _, mimetype, bodies = entry
+    encoding = choose_encoding() if len(bodies[None]) >= HTTP_COMPRESS_MIN_SIZE and mimetype in COMPRESSIBLE_TYPES else None
+    body = bodies.get(encoding)
+    if body is None:
+        # Racing threads may both compress; either result is fine to keep
+        body = bodies[encoding] = encode_body(bodies[None], encoding)
+    response = Response(body, mimetype=mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def conditional(version):
+    """
+    Decorator for read-only views. `version()` must be cheap (e.g. max ids)
+    and change whenever the page would; together with the view name and query
+    string it forms a weak ETag. Matching If-None-Match gets a 304, and other
+    requests for the same ETag within the TTL reuse the rendered body.
+    Requests with pending flash messages always render.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if '_flashes' in session:
+                return view(*args, **kwargs)
+            etag = make_etag(view.__name__, request.full_path, version())
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                entry = render_cache.get(etag)
+                if entry is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    entry = render_cache.put(etag, response.mimetype, response.get_data())
+                response = _cached_response(etag, entry)
+            response.set_etag(etag, weak=True)
+            # Browsers keep the page but revalidate on every use
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,359 @@
+# Bulk import of exported archives (NDJSON or CSV) into messages/attachments via COPY
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from sqlalchemy import select
+from database import engine, init_db, SessionLocal, Message, ColdMessage, Attachment, MessageRevision
+from rollups import update_rollups
+from style_profiles import update_style_profiles
+from dedup import backfill_hashes
+
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 50000))
+
+# Columns loaded per table, in staging/COPY order. `id` from an export is not kept;
+# rows get new ids and are matched on their Discord IDs instead. Edit/soft delete
+# state and the revision history come along, so deleted messages stay deleted.
+IMPORT_COLUMNS = {
+    'messages': ['message_id', 'guild_id', 'channel_id', 'author_id', 'author_name', 'content', 'timestamp', 'created_at',
+                 'edited_at', 'deleted_at'],
+    'attachments': ['message_id', 'attachment_id', 'url', 'filename', 'content_type', 'size', 'created_at', 'deleted_at'],
+    'message_revisions': ['message_id', 'revision', 'event', 'occurred_at', 'diff'],
+}
+IMPORT_CONFLICT_COLUMNS = {'messages': ('message_id',), 'attachments': ('attachment_id',), 'message_revisions': ('message_id', 'revision')}
+IMPORT_MODELS = {'messages': Message, 'attachments': Attachment, 'message_revisions': MessageRevision}
+# Messages already moved to cold storage (see tiering.py) are not imported again
+IMPORT_COLD_MODELS = {'messages': ColdMessage}
+_INTEGER_COLUMNS = {'message_id', 'guild_id', 'channel_id', 'author_id', 'attachment_id', 'size', 'revision'}
+_DATETIME_COLUMNS = ('timestamp', 'created_at', 'edited_at', 'deleted_at', 'occurred_at')
+_JSON_COLUMNS = {'diff'}
+
+STAGING_DDL = {
+    'messages': """
+        CREATE TEMP TABLE IF NOT EXISTS import_messages (
+            message_id BIGINT, guild_id BIGINT, channel_id BIGINT, author_id BIGINT,
+            author_name VARCHAR(255), content TEXT, timestamp TIMESTAMP, created_at TIMESTAMPTZ,
+            edited_at TIMESTAMP, deleted_at TIMESTAMP
+        ) ON COMMIT DELETE ROWS
+    """,
+    'attachments': """
+        CREATE TEMP TABLE IF NOT EXISTS import_attachments (
+            message_id BIGINT, attachment_id BIGINT, url TEXT, filename VARCHAR(255),
+            content_type VARCHAR(100), size BIGINT, created_at TIMESTAMPTZ, deleted_at TIMESTAMP
+        ) ON COMMIT DELETE ROWS
+    """,
+    'message_revisions': """
+        CREATE TEMP TABLE IF NOT EXISTS import_message_revisions (
+            message_id BIGINT, revision INTEGER, event VARCHAR(10), occurred_at TIMESTAMP, diff JSON
+        ) ON COMMIT DELETE ROWS
+    """,
+}
+
+
+def open_input(path):
+    """Opens a plain, .gz or .zst file for binary reading."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("Reading .zst files requires the 'zstandard' package (pip install zstandard).")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+def _skip_to(f, offset):
+    """Moves to an uncompressed byte offset, reading forward if the stream cannot seek."""
+    try:
+        f.seek(offset)
+    except (OSError, io.UnsupportedOperation, ValueError):
+        remaining = offset
+        while remaining > 0:
+            data = f.read(min(remaining, 1 << 20))
+            if not data:
+                break
+            remaining -= len(data)
+
+
+class _LineReader:
+    """Iterates decoded lines from a binary stream, counting bytes consumed."""
+
+    def __init__(self, f, offset):
+        self.f = f
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')
+
+
+def iter_records(reader, file_format, columns):
+    """Yields dicts from NDJSON lines or CSV records (columns = CSV header)."""
+    if file_format == 'ndjson':
+        for line in reader:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        for values in csv.reader(reader):
+            yield dict(zip(columns, values))
+
+
+def _clean(value, column):
+    # Normalise values so they survive a CSV round trip into COPY
+    if value is None or value == '':
+        return None if column != 'content' else ''
+    if column in _INTEGER_COLUMNS:
+        return int(value)
+    if column in _JSON_COLUMNS and isinstance(value, str):
+        # CSV carries JSON as text
+        return json.loads(value)
+    return value
+
+
+def _copy_field(value):
+    # COPY CSV reads an unquoted empty field as NULL and a quoted one as a string
+    if value is None:
+        return ''
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value, ensure_ascii=False)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _state_path(path):
+    return f"{path}.import-state.json"
+
+
+def load_state(path):
+    try:
+        with open(_state_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(path, state):
+    tmp_path = _state_path(path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, _state_path(path))
+
+
+class PostgresCopyLoader:
+    """Loads chunks with COPY into a temp staging table, then merges with ON CONFLICT DO NOTHING."""
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = IMPORT_COLUMNS[table]
+        self.conn = engine.raw_connection()
+        with self.conn.cursor() as cur:
+            cur.execute(STAGING_DDL[table])
+        self.conn.commit()
+
+    def load(self, rows):
+        """Loads one chunk in a single transaction. Returns the number of rows inserted."""
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(','.join(_copy_field(row.get(c)) for c in self.columns))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        columns = ', '.join(self.columns)
+        staging = f"import_{self.table}"
+        # created_at falls back to now() like the column default
+        select_columns = ', '.join('COALESCE(created_at, now())' if c == 'created_at' else c for c in self.columns)
+        conflict_columns = ', '.join(IMPORT_CONFLICT_COLUMNS[self.table])
+        where = ""
+        if self.table in IMPORT_COLD_MODELS:
+            cold_table = IMPORT_COLD_MODELS[self.table].__tablename__
+            conflict_column = IMPORT_CONFLICT_COLUMNS[self.table][0]
+            where = (f" WHERE NOT EXISTS (SELECT 1 FROM {cold_table} "
+                     f"WHERE {cold_table}.{conflict_column} = {staging}.{conflict_column})")
+        with self.conn.cursor() as cur:
+            cur.copy_expert(f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+            cur.execute(
+                f"INSERT INTO {self.table} ({columns}) SELECT {select_columns} FROM {staging}{where} "
+                f"ON CONFLICT ({conflict_columns}) DO NOTHING"
+            )
+            inserted = cur.rowcount
+        # ON COMMIT DELETE ROWS empties the staging table
+        self.conn.commit()
+        return inserted
+
+    def close(self):
+        self.conn.close()
+
+
+class InsertLoader:
+    """Fallback for SQLite (local testing): batched INSERT ... ON CONFLICT DO NOTHING."""
+
+    def __init__(self, table):
+        from sqlalchemy.dialects.sqlite import insert
+        self.table = table
+        self.model = IMPORT_MODELS[table]
+        self.stmt = insert(self.model).on_conflict_do_nothing(index_elements=list(IMPORT_CONFLICT_COLUMNS[table]))
+
+    def load(self, rows):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self.table in IMPORT_COLD_MODELS:
+            rows = self._skip_cold(rows)
+            if not rows:
+                return 0
+        for row in rows:
+            for column in _DATETIME_COLUMNS:
+                if isinstance(row.get(column), str):
+                    row[column] = datetime.datetime.fromisoformat(row[column])
+            if 'created_at' in row and row['created_at'] is None:
+                row['created_at'] = now
+        with engine.begin() as conn:
+            return conn.execute(self.stmt, rows).rowcount
+
+    def _skip_cold(self, rows, lookup_size=500):
+        column = getattr(IMPORT_COLD_MODELS[self.table], IMPORT_CONFLICT_COLUMNS[self.table][0])
+        keys = [row.get(column.key) for row in rows]
+        cold = set()
+        with engine.connect() as conn:
+            # Chunked to stay under SQLite's bound parameter limit
+            for start in range(0, len(keys), lookup_size):
+                cold.update(conn.scalars(select(column).where(column.in_(keys[start:start + lookup_size]))))
+        return [row for row in rows if row.get(column.key) not in cold]
+
+    def close(self):
+        pass
+
+
+def make_loader(table):
+    if engine.dialect.name == 'postgresql':
+        return PostgresCopyLoader(table)
+    if engine.dialect.name == 'sqlite':
+        return InsertLoader(table)
+    raise ValueError(f"Bulk import is not supported for the '{engine.dialect.name}' database.")
+
+
+def import_file(path, table, file_format=None, chunk_size=IMPORT_CHUNK_SIZE, restart=False):
+    """
+    Imports one file, committing and checkpointing after every chunk so an
+    interrupted run resumes from the last committed file offset.
+
+    Returns (rows_read, rows_inserted, rows_read_this_run); the first two
+    include rows committed by earlier, interrupted runs.
+    """
+    if file_format is None:
+        file_format = 'csv' if '.csv' in os.path.basename(path) else 'ndjson'
+    columns = IMPORT_COLUMNS[table]
+
+    state = None if restart else load_state(path)
+    if state and state.get('table') != table:
+        raise ValueError(f"Checkpoint for {path} belongs to table '{state.get('table')}'; use --restart to start over.")
+    offset = state['offset'] if state else 0
+    rows_read = state['rows_read'] if state else 0
+    rows_inserted = state['rows_inserted'] if state else 0
+    csv_header = state.get('csv_header') if state else None
+    if state:
+        print(f"Resuming {path} at byte {offset} ({rows_read} rows already read).")
+
+    loader = make_loader(table)
+    start_time = time.perf_counter()
+    session_rows = 0
+    try:
+        with open_input(path) as f:
+            if offset:
+                _skip_to(f, offset)
+            reader = _LineReader(f, offset)
+            if file_format == 'csv' and csv_header is None:
+                csv_header = next(csv.reader([next(reader)]))
+            records = iter_records(reader, file_format, csv_header)
+
+            done = False
+            while not done:
+                chunk = []
+                for record in records:
+                    chunk.append({c: _clean(record.get(c), c) for c in columns})
+                    if len(chunk) >= chunk_size:
+                        break
+                else:
+                    done = True
+                if not chunk:
+                    break
+
+                rows_inserted += loader.load(chunk)
+                rows_read += len(chunk)
+                session_rows += len(chunk)
+                save_state(path, {
+                    'table': table,
+                    'offset': reader.offset,
+                    'rows_read': rows_read,
+                    'rows_inserted': rows_inserted,
+                    'csv_header': csv_header,
+                })
+
+                elapsed = time.perf_counter() - start_time
+                rate = session_rows / elapsed if elapsed > 0 else 0
+                print(f"  ... {rows_read:,} rows read, {rows_inserted:,} inserted ({rate:,.0f} rows/sec)", flush=True)
+    finally:
+        loader.close()
+
+    # Finished cleanly: a later run of the same file should start from the beginning
+    try:
+        os.remove(_state_path(path))
+    except OSError:
+        pass
+    return rows_read, rows_inserted, session_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import exported NDJSON/CSV files into the archive.")
+    parser.add_argument('table', choices=sorted(IMPORT_COLUMNS))
+    parser.add_argument('files', nargs='+', help="Input files (.ndjson, .csv, optionally .gz or .zst).")
+    parser.add_argument('--format', choices=('ndjson', 'csv'), help="Input format (default: from the file name).")
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+    parser.add_argument('--restart', action='store_true', help="Ignore saved checkpoints and start each file from the beginning.")
+    args = parser.parse_args(argv)
+
+    init_db()
+    start_time = time.perf_counter()
+    total_read = total_inserted = run_rows = 0
+    for path in args.files:
+        print(f"Importing {path} into {args.table}...")
+        try:
+            rows_read, rows_inserted, rows_this_run = import_file(path, args.table, file_format=args.format, chunk_size=args.chunk_size, restart=args.restart)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        total_read += rows_read
+        total_inserted += rows_inserted
+        run_rows += rows_this_run
+        print(f"Finished {path}: {rows_read:,} rows read, {rows_inserted:,} inserted, {rows_read - rows_inserted:,} skipped (duplicates).")
+
+    # Fold the imported rows into the dashboard analytics rollups
+    with SessionLocal() as db_session:
+        backfill_hashes(db_session)
+        rolled_up = update_rollups(db_session)
+        profiled = update_style_profiles(db_session)
+    print(f"Analytics rollups updated with {rolled_up:,} rows.")
+    print(f"Style profiles updated from {profiled:,} messages.")
+
+    duration = time.perf_counter() - start_time
+    rate = run_rows / duration if duration > 0 else 0
+    print("\n--- Import Complete ---")
+    print(f"Total rows read: {total_read:,}")
+    print(f"Total rows inserted: {total_inserted:,}")
+    print(f"Duration: {duration:.1f}s ({rate:,.0f} rows/sec)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+# Bot service log reader: journalctl, or a plain log file (JOURNAL_FILE) on systems without systemd
+import json
+import os
+import re
+import subprocess
+import threading
+from datetime import datetime, timedelta
+
+BOT_SERVICE_NAME = os.getenv('BOT_SERVICE_NAME', 'discord-bot.service')
+# When set, logs are tailed from this file instead of the journal (e.g. `python bot.py >> bot.log`)
+JOURNAL_FILE = os.getenv('JOURNAL_FILE')
+JOURNAL_MAX_LINES = int(os.getenv('JOURNAL_MAX_LINES', 500))
+
+# syslog priorities, most severe first; a priority filter keeps that level and everything above it
+PRIORITIES = ('emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info', 'debug')
+# Python logging level names (as written by log_config) -> syslog priority
+_LEVEL_PRIORITIES = {'CRITICAL': 2, 'ERROR': 3, 'WARNING': 4, 'INFO': 6, 'DEBUG': 7}
+_TEXT_LEVEL = re.compile(r'\b(CRITICAL|ERROR|WARNING|INFO|DEBUG)\b')
+_RELATIVE_SINCE = re.compile(r'^-(\d+)\s*(s|m|h|d)$')
+_FILE_BLOCK_SIZE = 64 * 1024
+
+
+def parse_priority(value):
+    """Accepts a syslog priority name or number (0-7). Returns the number; raises ValueError."""
+    value = value.strip().lower()
+    if value.isdigit() and int(value) < len(PRIORITIES):
+        return int(value)
+    if value in PRIORITIES:
+        return PRIORITIES.index(value)
+    raise ValueError(f"Unknown priority '{value}'. Use 0-7 or one of: {', '.join(PRIORITIES)}.")
+
+
+def _format_entry(record):
+    """Converts a journalctl JSON record into the {'timestamp', 'message', 'cursor'} shape the UI uses."""
+    message = record.get('MESSAGE', '')
+    if isinstance(message, list):
+        # Non-UTF-8 messages are exported as a byte array
+        message = bytes(message).decode('utf-8', errors='replace')
+    timestamp = ''
+    if record.get('__REALTIME_TIMESTAMP'):
+        # Same layout as `--output short-iso`
+        timestamp = datetime.fromtimestamp(int(record['__REALTIME_TIMESTAMP']) / 1_000_000).astimezone().strftime('%Y-%m-%dT%H:%M:%S%z')
+    identifier = record.get('SYSLOG_IDENTIFIER', '')
+    pid = record.get('_PID')
+    prefix = f"{record.get('_HOSTNAME', '')} {identifier}[{pid}]:" if pid else f"{record.get('_HOSTNAME', '')} {identifier}:"
+    return {"timestamp": timestamp, "message": f"{prefix.strip()} {message}", "cursor": record.get('__CURSOR')}
+
+
+# --- journalctl ---
+
+def _journalctl(args, limit, timeout):
+    """
+    Runs journalctl with JSON output and returns at most `limit` records. Stops
+    reading (and kills journalctl) once the limit is reached, so a stale cursor
+    never pulls the whole journal into memory.
+    """
+    command = ["journalctl", "-u", BOT_SERVICE_NAME, "--no-pager", "--output", "json", "--quiet", *args]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    records = []
+    try:
+        for line in process.stdout:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+            if len(records) >= limit:
+                process.kill()
+                break
+        stderr = process.stderr.read()
+        returncode = process.wait()
+    finally:
+        timer.cancel()
+        process.stdout.close()
+        process.stderr.close()
+    if len(records) >= limit:
+        return records
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(command, timeout)
+    # --grep exits with 1 when nothing matched
+    if returncode and not (returncode == 1 and not stderr.strip()):
+        raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+    return records
+
+
+def _journalctl_filters(grep, priority, since):
+    # `--option=value` so user input can never be read as another option
+    args = []
+    if grep:
+        args.append(f"--grep={grep}")
+    if priority is not None:
+        args.append(f"--priority={priority}")
+    if since:
+        args.append(f"--since={since}")
+    return args
+
+
+# --- log file ---
+
+def _parse_since(value):
+    """ISO timestamps, 'today', 'yesterday' or relative '-30m' / '-2h' / '-1d' (the journalctl forms the file reader supports)."""
+    value = value.strip()
+    now = datetime.now()
+    if value == 'today':
+        return now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if value == 'yesterday':
+        return now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    match = _RELATIVE_SINCE.match(value)
+    if match:
+        unit = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+        return now - timedelta(**{unit: int(match.group(1))})
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid since value '{value}'.")
+
+
+def _file_entry(line, offset):
+    """Parses a log_config line (JSON or text). Returns (entry, priority, time or None)."""
+    timestamp, priority, created = '', 6, None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        record = None
+    message = line
+    if isinstance(record, dict):
+        timestamp = record.get('time', '')
+        priority = _LEVEL_PRIORITIES.get(record.get('level'), 6)
+        message = f"{record.get('level', '')} {record.get('logger', '')}: {record.get('message', '')}"
+        if record.get('exc'):
+            message += f"\n{record['exc']}"
+    else:
+        timestamp = line[:23] if line[:4].isdigit() else ''
+        level = _TEXT_LEVEL.search(line[:60])
+        if level:
+            priority = _LEVEL_PRIORITIES[level.group(1)]
+    if timestamp:
+        try:
+            created = datetime.fromisoformat(timestamp.replace(',', '.'))
+        except ValueError:
+            pass
+    return {"timestamp": timestamp, "message": message, "cursor": f"file:{offset}"}, priority, created
+
+
+class _FileFilter:
+    """The file reader's equivalent of journalctl's --grep (smart case), --priority and --since."""
+
+    def __init__(self, grep, priority, since):
+        if grep:
+            try:
+                self.grep = re.compile(grep, 0 if any(c.isupper() for c in grep) else re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"Invalid grep pattern: {e}.")
+        else:
+            self.grep = None
+        self.priority = priority
+        self.since = _parse_since(since) if since else None
+
+    def __call__(self, line, offset):
+        entry, priority, created = _file_entry(line, offset)
+        if self.priority is not None and priority > self.priority:
+            return None
+        if self.since and created and created.replace(tzinfo=None) < self.since:
+            return None
+        if self.grep and not self.grep.search(line):
+            return None
+        return entry
+
+
+def _file_offset(cursor, size):
+    if not cursor.startswith('file:'):
+        raise ValueError("Invalid cursor.")
+    try:
+        offset = int(cursor[5:])
+    except ValueError:
+        raise ValueError("Invalid cursor.")
+    # The file was truncated or replaced: start over from the beginning
+    return offset if 0 <= offset <= size else 0
+
+
+def _last_line_end(f, size):
+    """Offset just past the last newline: a line still being written is left for the next read."""
+    position = size
+    while position > 0:
+        start = max(0, position - _FILE_BLOCK_SIZE)
+        f.seek(start)
+        newline = f.read(position - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        position = start
+    return 0
+
+
+def _lines_before(f, end):
+    """Yields (offset, line) for the lines before `end` (a line start), newest first, reading backwards in blocks."""
+    pending = b''
+    position = end
+    while position > 0:
+        start = max(0, position - _FILE_BLOCK_SIZE)
+        f.seek(start)
+        pending = f.read(position - start) + pending
+        position = start
+        lines = pending.split(b'\n')[:-1]
+        # Unless this is the start of the file, the first piece may be the end of an earlier line
+        pending = lines.pop(0) + b'\n' if position > 0 else b''
+        offset = position + len(pending)
+        starts = []
+        for line in lines:
+            starts.append(offset)
+            offset += len(line) + 1
+        for line_start, line in zip(reversed(starts), reversed(lines)):
+            if line.strip():
+                yield line_start, line.decode('utf-8', errors='replace').rstrip('\r')
+
+
+def _read_file(after_cursor, before_cursor, lines, filters):
+    with open(JOURNAL_FILE, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if after_cursor:
+            offset = _file_offset(after_cursor, size)
+            f.seek(offset)
+            entries = []
+            while len(entries) < lines:
+                line = f.readline()
+                # Only complete lines; a line still being written is picked up next time
+                if not line.endswith(b'\n'):
+                    break
+                entry = filters(line.decode('utf-8', errors='replace').rstrip('\r\n'), offset)
+                offset += len(line)
+                if entry:
+                    entries.append(entry)
+            return entries, f"file:{offset}"
+        end = _last_line_end(f, size)
+        cursor = None if before_cursor else f"file:{end}"
+        if before_cursor:
+            end = _file_offset(before_cursor, size)
+        entries = []
+        for offset, line in _lines_before(f, end):
+            entry = filters(line, offset)
+            if entry:
+                entries.append(entry)
+                if len(entries) >= lines:
+                    break
+        entries.reverse()
+        return entries, cursor
+
+
+# --- public API ---
+
+def read_journal(after_cursor=None, lines=100, grep=None, priority=None, since=None, before_cursor=None, timeout=15):
+    """
+    Reads bot service log entries, oldest first, at most `lines` of them.
+
+    With after_cursor, returns entries written after that cursor (the oldest
+    ones first, so polling in a loop never skips lines); with before_cursor,
+    the `lines` entries just before it (paging backwards); otherwise the last
+    `lines` entries. grep (regex, case-insensitive unless it has capitals),
+    priority (0-7 or a name; that level and more severe) and since are applied
+    by journalctl. Every entry carries its own cursor.
+
+    Returns (entries, cursor): the cursor to poll from next (the newest entry
+    returned, or after_cursor unchanged if there was nothing new; None for
+    backward pages). Raises
+    ValueError for bad filters and the same subprocess errors as
+    subprocess.run(check=True).
+    """
+    lines = max(1, min(lines, JOURNAL_MAX_LINES))
+    priority = parse_priority(str(priority)) if priority not in (None, '') else None
+    if JOURNAL_FILE:
+        return _read_file(after_cursor, before_cursor, lines, _FileFilter(grep, priority, since))
+
+    filters = _journalctl_filters(grep, priority, since)
+    if after_cursor:
+        records = _journalctl(["--after-cursor", after_cursor, *filters], lines, timeout)
+        cursor = records[-1].get('__CURSOR', after_cursor) if records else after_cursor
+    elif before_cursor:
+        # --cursor includes the entry itself, so ask for one more and drop it
+        records = _journalctl(["--cursor", before_cursor, "--reverse", "-n", str(lines + 1), *filters], lines + 1, timeout)
+        records = [record for record in records if record.get('__CURSOR') != before_cursor][:lines]
+        records.reverse()
+        cursor = None
+    else:
+        records = _journalctl(["-n", str(lines), *filters], lines, timeout)
+        cursor = records[-1].get('__CURSOR') if records else None
+    return [_format_entry(record) for record in records], cursor
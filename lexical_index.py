@@ -0,0 +1,444 @@
+# Local BM25 index over archived message content, stored as memory-mapped segments
+import argparse
+import fcntl
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from array import array
+from sqlalchemy import select
+from database import SessionLocal, init_db, get_messages_by_id, tiered_messages
+from revisions import last_revision_id, revised_messages
+
+# Next to the code by default, so the bot, the web app and the CLI share one index whatever their working directory
+LEXICAL_INDEX_DIR = os.getenv('LEXICAL_INDEX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lexical_index'))
+LEXICAL_INDEX_BATCH_SIZE = int(os.getenv('LEXICAL_INDEX_BATCH_SIZE', 20000))
+# Segments fall into size levels (powers of this number of docs); once the newest
+# segments include this many of one level in a row, they are merged into one of the
+# next level, so each message is rewritten about log(archive size) times in all
+LEXICAL_MAX_SEGMENTS = int(os.getenv('LEXICAL_MAX_SEGMENTS', 8))
+# Seconds merged-away segments stay on disk for processes still loading an older manifest
+RETIRED_SEGMENT_GRACE = 60
+# Terms found in more than this fraction of messages are skipped at query time
+# (they barely change the ranking but have the longest posting lists)
+LEXICAL_MAX_DF = float(os.getenv('LEXICAL_MAX_DF', 0.01))
+# Only the rarest query terms are scored, and only the newest postings of each
+LEXICAL_MAX_QUERY_TERMS = 8
+LEXICAL_MAX_POSTINGS = int(os.getenv('LEXICAL_MAX_POSTINGS', 5000))
+# Most hits one guild-filtered search_messages() call asks the index for
+LEXICAL_MAX_CANDIDATES = int(os.getenv('LEXICAL_MAX_CANDIDATES', 2000))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MANIFEST = 'manifest.json'
+
+# Segment files: ids.bin (message row ids), lengths.bin (tokens per message),
+# docs.bin/tfs.bin (posting lists of local doc numbers and term frequencies,
+# concatenated term by term), vocab.json ({term: [offset, count]}) and meta.json.
+# An edited or deleted message gets a tombstone in the manifest: its docs in
+# segments of an older generation are dead, and an edit is indexed again in
+# the next segment. Merges drop dead docs.
+
+
+def tokenize(text):
+    """Lowercased word tokens of at least two characters (drops most punctuation-only noise)."""
+    return [token for token in _TOKEN_RE.findall((text or '').casefold()) if len(token) > 1]
+
+
+def _map_array(path, typecode):
+    # Zero-copy view of an on-disk array; empty files cannot be mapped
+    size = os.path.getsize(path)
+    if size == 0:
+        return array(typecode)
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+class Segment:
+    """One immutable, memory-mapped part of the index."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'vocab.json'), encoding='utf-8') as f:
+            self.vocab = json.load(f)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.doc_count = meta['doc_count']
+        self.total_length = meta['total_length']
+        # Merged segments keep the newest generation they were built from
+        self.generation = meta.get('generation', int(os.path.basename(path).rpartition('-')[2]))
+        self.ids = _map_array(os.path.join(path, 'ids.bin'), 'q')
+        self.lengths = _map_array(os.path.join(path, 'lengths.bin'), 'H')
+        self.docs = _map_array(os.path.join(path, 'docs.bin'), 'I')
+        self.tfs = _map_array(os.path.join(path, 'tfs.bin'), 'H')
+
+    def df(self, term):
+        entry = self.vocab.get(term)
+        return entry[1] if entry else 0
+
+    def postings(self, term):
+        entry = self.vocab.get(term)
+        if not entry:
+            return (), ()
+        start, count = entry
+        return self.docs[start:start + count], self.tfs[start:start + count]
+
+
+def _write_segment(path, ids, lengths, postings, generation):
+    """Writes a segment from message ids, token counts and {term: (doc numbers, tfs)}."""
+    os.makedirs(path)
+    docs = array('I')
+    tfs = array('H')
+    vocab = {}
+    for term in sorted(postings):
+        term_docs, term_tfs = postings[term]
+        vocab[term] = [len(docs), len(term_docs)]
+        docs.extend(term_docs)
+        tfs.extend(term_tfs)
+    for name, data in (('ids.bin', ids), ('lengths.bin', lengths), ('docs.bin', docs), ('tfs.bin', tfs)):
+        with open(os.path.join(path, name), 'wb') as f:
+            data.tofile(f)
+    with open(os.path.join(path, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocab, f, ensure_ascii=False, separators=(',', ':'))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'doc_count': len(ids), 'total_length': sum(lengths), 'generation': generation}, f)
+
+
+class LexicalIndex:
+    """
+    BM25 search over Message.content without any external service.
+
+    The index is a list of immutable segments under `path`. update() indexes
+    messages above the last indexed id, and the current text of messages edited
+    since, into a new segment and merges runs of similar-size segments; readers
+    keep using the previous segment list until the new one is swapped in, and
+    merged-away segments are only deleted a while after the swap. Searching only touches the posting lists of the
+    query terms, so it costs milliseconds rather than a table scan.
+    """
+
+    def __init__(self, path=LEXICAL_INDEX_DIR):
+        self.path = path
+        self._segments = []
+        self._last_id = 0
+        self._last_revision_id = 0
+        self._next_segment = 1
+        self._deleted = {}       # message row id -> generation its older docs are dead below
+        self._retired = []       # [segment name, time it was merged away]
+        self._update_lock = threading.Lock()
+        self._loaded = False
+
+    @property
+    def doc_count(self):
+        return sum(segment.doc_count for segment in self._segments)
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'segments': [], 'last_id': 0, 'next_segment': 1}
+
+    def load(self, attempts=3):
+        """Opens the segments listed in the manifest (no-op if the index does not exist yet)."""
+        # Segments are immutable, so ones already open are reused
+        open_segments = {os.path.basename(segment.path): segment for segment in self._segments}
+        for attempt in range(attempts):
+            manifest = self._read_manifest()
+            try:
+                segments = [open_segments.get(name) or Segment(os.path.join(self.path, name)) for name in manifest['segments']]
+                break
+            except FileNotFoundError:
+                # Merged away and deleted since this manifest was read: a newer one no longer lists it
+                if attempt == attempts - 1:
+                    raise
+        self._deleted = dict(manifest.get('deleted', []))
+        self._retired = manifest.get('retired', [])
+        self._segments = segments
+        self._last_id = manifest['last_id']
+        self._last_revision_id = manifest.get('last_revision_id', 0)
+        self._next_segment = manifest['next_segment']
+        self._loaded = True
+
+    def _save_manifest(self, segments, deleted, retired):
+        tmp_path = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'segments': [os.path.basename(segment.path) for segment in segments],
+                'last_id': self._last_id,
+                'last_revision_id': self._last_revision_id,
+                'next_segment': self._next_segment,
+                'deleted': list(deleted.items()),
+                'retired': retired,
+            }, f)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def _new_segment_path(self):
+        path = os.path.join(self.path, f"seg-{self._next_segment:06d}")
+        self._next_segment += 1
+        return path
+
+    def update(self, db_session, batch_size=LEXICAL_INDEX_BATCH_SIZE):
+        """Indexes messages added since the last update. Returns the number of messages indexed."""
+        with self._update_lock:
+            os.makedirs(self.path, exist_ok=True)
+            # Only one process may write the index (the bot, or the CLI when the bot is stopped)
+            with open(os.path.join(self.path, 'write.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Another process may have updated the index since we loaded it
+                self.load()
+                return self._update_locked(db_session, batch_size)
+
+    def _update_locked(self, db_session, batch_size):
+        ids = array('q')
+        lengths = array('H')
+        postings = {}
+
+        def add(row_id, content):
+            tokens = tokenize(content)
+            if not tokens:
+                return
+            doc = len(ids)
+            ids.append(row_id)
+            lengths.append(min(len(tokens), 65535))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                entry = postings.get(token)
+                if entry is None:
+                    entry = postings[token] = (array('I'), array('H'))
+                entry[0].append(doc)
+                entry[1].append(min(tf, 65535))
+
+        # Edits and deletes first: they only concern messages that are indexed already
+        generation = self._next_segment
+        deleted = dict(self._deleted)
+        revision_id = self._last_revision_id
+        if self._last_id == 0:
+            revision_id = last_revision_id(db_session)
+        else:
+            revised = {}
+            for revision_id, rows in revised_messages(db_session, revision_id, 'id', 'content'):
+                revised.update((row.id, row.content if row.deleted_at is None else None)
+                               for row in rows if row.id <= self._last_id)
+            for row_id, content in revised.items():
+                deleted[row_id] = generation
+                if content is not None:
+                    add(row_id, content)
+
+        last_id = self._last_id
+        messages = tiered_messages('id', 'content', live_only=True)
+        while True:
+            rows = db_session.execute(
+                select(messages.c.id, messages.c.content)
+                .where(messages.c.id > last_id)
+                .order_by(messages.c.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            for row_id, content in rows:
+                add(row_id, content)
+            last_id = rows[-1].id
+
+        if last_id == self._last_id and revision_id == self._last_revision_id:
+            return 0
+        segments = list(self._segments)
+        if ids:
+            path = self._new_segment_path()
+            _write_segment(path, ids, lengths, postings, generation)
+            segments.append(Segment(path))
+        self._last_id = last_id
+        self._last_revision_id = revision_id
+        merged_away = []
+        while True:
+            run = self._merge_run(segments)
+            if not run:
+                break
+            merged_away += run
+            segments = segments[:-len(run)] + [self._merge(run, deleted)]
+        # A tombstone is only needed while a segment older than it remains
+        oldest = min((segment.generation for segment in segments), default=generation)
+        deleted = {row_id: dead_below for row_id, dead_below in deleted.items() if dead_below > oldest}
+        # Other processes may be loading the previous manifest, so segments it lists
+        # are deleted only on a later update, once the grace period is over
+        now = time.time()
+        expired = [name for name, retired_at in self._retired if now - retired_at >= RETIRED_SEGMENT_GRACE]
+        retired = [[name, retired_at] for name, retired_at in self._retired if now - retired_at < RETIRED_SEGMENT_GRACE]
+        retired += [[os.path.basename(segment.path), now] for segment in merged_away]
+        self._save_manifest(segments, deleted, retired)
+        # Tombstones first: a search that sees them with the old segments only misses an edit's new text
+        self._deleted = deleted
+        self._segments = segments
+        self._retired = retired
+        for name in expired:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        return len(ids)
+
+    @staticmethod
+    def _merge_run(segments):
+        """The newest segments if at least LEXICAL_MAX_SEGMENTS of them in a row share a size level, else []."""
+        def level(segment):
+            return int(math.log(max(segment.doc_count, 1), LEXICAL_MAX_SEGMENTS))
+        if len(segments) < LEXICAL_MAX_SEGMENTS:
+            return []
+        newest = level(segments[-1])
+        run = 0
+        # Older segments of a lower level (e.g. shrunk by dropped docs) join the run
+        while run < len(segments) and level(segments[-run - 1]) <= newest:
+            run += 1
+        return segments[-run:] if run >= LEXICAL_MAX_SEGMENTS else []
+
+    def _merge(self, segments, deleted):
+        """Combines segments into a new one, renumbering local doc numbers and dropping dead docs."""
+        ids = array('q')
+        lengths = array('H')
+        # Per segment: an offset to add, or (with dead docs) a list of new doc numbers (-1 = dropped)
+        remaps = []
+        for segment in segments:
+            alive = [deleted.get(row_id, 0) <= segment.generation for row_id in segment.ids] if deleted else None
+            if alive is None or all(alive):
+                remaps.append(len(ids))
+                ids.extend(segment.ids)
+                lengths.extend(segment.lengths)
+                continue
+            remap = []
+            for doc, keep in enumerate(alive):
+                if keep:
+                    remap.append(len(ids))
+                    ids.append(segment.ids[doc])
+                    lengths.append(segment.lengths[doc])
+                else:
+                    remap.append(-1)
+            remaps.append(remap)
+        terms = set()
+        for segment in segments:
+            terms.update(segment.vocab)
+        postings = {}
+        for term in terms:
+            term_docs = array('I')
+            term_tfs = array('H')
+            for segment, remap in zip(segments, remaps):
+                docs, tfs = segment.postings(term)
+                if isinstance(remap, int):
+                    term_docs.extend(doc + remap for doc in docs)
+                    term_tfs.extend(tfs)
+                    continue
+                for doc, tf in zip(docs, tfs):
+                    if remap[doc] >= 0:
+                        term_docs.append(remap[doc])
+                        term_tfs.append(tf)
+            if term_docs:
+                postings[term] = (term_docs, term_tfs)
+        path = self._new_segment_path()
+        _write_segment(path, ids, lengths, postings, max(segment.generation for segment in segments))
+        return Segment(path)
+
+    def search(self, text, k=10):
+        """Returns up to k (message row id, score) pairs, best first."""
+        if not self._loaded:
+            self.load()
+        segments = self._segments  # Snapshot; update() swaps the list, never mutates it
+        deleted = self._deleted
+        terms = set(tokenize(text))
+        doc_count = sum(segment.doc_count for segment in segments)
+        if not terms or not doc_count:
+            return []
+        avg_length = sum(segment.total_length for segment in segments) / doc_count
+
+        df = {term: sum(segment.df(term) for segment in segments) for term in terms}
+        present = sorted((term for term in terms if df[term]), key=df.get)
+        if not present:
+            return []
+        max_df = max(1, int(doc_count * LEXICAL_MAX_DF))
+        # If every term is common, fall back to the rarest one
+        query_terms = [term for term in present if df[term] <= max_df][:LEXICAL_MAX_QUERY_TERMS] or present[:1]
+
+        scores = {}
+        norm_base = BM25_K1 * (1 - BM25_B)
+        norm_per_token = BM25_K1 * BM25_B / avg_length
+        for number, segment in enumerate(segments):
+            lengths = segment.lengths
+            for term in query_terms:
+                docs, tfs = segment.postings(term)
+                if not len(docs):
+                    continue
+                # Doc numbers follow message ids, so the tail holds the newest matches
+                docs = docs[-LEXICAL_MAX_POSTINGS:]
+                tfs = tfs[-LEXICAL_MAX_POSTINGS:]
+                weight = math.log(1 + (doc_count - df[term] + 0.5) / (df[term] + 0.5)) * (BM25_K1 + 1)
+                for doc, tf in zip(docs, tfs):
+                    key = (number, doc)
+                    scores[key] = scores.get(key, 0.0) + weight * tf / (tf + norm_base + norm_per_token * lengths[doc])
+        candidates = scores.items()
+        if deleted:
+            candidates = [((number, doc), score) for (number, doc), score in candidates
+                          if deleted.get(segments[number].ids[doc], 0) <= segments[number].generation]
+        best = heapq.nlargest(k, candidates, key=lambda item: item[1])
+        return [(segments[number].ids[doc], score) for (number, doc), score in best]
+
+
+def fetch_messages(db_session, row_ids, guild_id=None):
+    """Loads messages by row id from either tier (only from guild_id if given), keeping the given order and skipping deleted ones."""
+    if not row_ids:
+        return []
+    by_id = {message.id: message for message in get_messages_by_id(db_session, row_ids, guild_id=guild_id)}
+    return [by_id[row_id] for row_id in row_ids if row_id in by_id]
+
+
+def search_messages(db_session, index, text, k, guild_id=None, oversample=4, max_candidates=LEXICAL_MAX_CANDIDATES):
+    """
+    The k best matching messages (from guild_id only, if given), best first.
+
+    The index ranks the whole archive and other guilds' hits are dropped
+    afterwards, so a guild-filtered search asks for `oversample` times more
+    hits, and again as many times more, until k are left, the index has no
+    more matches or max_candidates is reached.
+    """
+    wanted = k if guild_id is None else min(k * oversample, max_candidates)
+    while True:
+        results = index.search(text, k=wanted)
+        messages = fetch_messages(db_session, [row_id for row_id, _ in results], guild_id=guild_id)
+        if len(messages) >= k or len(results) < wanted or wanted >= max_candidates:
+            return messages[:k]
+        wanted = min(wanted * oversample, max_candidates)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build/update the local lexical index or query it.")
+    parser.add_argument('query', nargs='?', help="Search text (omit to only update the index).")
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--path', default=LEXICAL_INDEX_DIR)
+    parser.add_argument('--rebuild', action='store_true', help="Delete the index and build it from scratch.")
+    args = parser.parse_args(argv)
+
+    init_db()
+    if args.rebuild:
+        shutil.rmtree(args.path, ignore_errors=True)
+    index = LexicalIndex(args.path)
+    with SessionLocal() as db_session:
+        start_time = time.perf_counter()
+        added = index.update(db_session)
+        print(f"Indexed {added:,} new messages in {time.perf_counter() - start_time:.1f}s ({index.doc_count:,} total).")
+        if args.query:
+            start_time = time.perf_counter()
+            results = index.search(args.query, k=args.k)
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+            scores = dict(results)
+            for message in fetch_messages(db_session, [row_id for row_id, _ in results]):
+                print(f"{scores[message.id]:6.2f}  {message.author_name}: {message.content[:100]}")
+            print(f"Search took {elapsed_ms:.1f} ms.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
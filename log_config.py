@@ -0,0 +1,155 @@
+# Logging setup shared by the bot and the archiver: JSON lines written off the event loop
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# LogRecord attributes that are not user supplied `extra` fields
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+
+def parse_levels(value):
+    """Parses "name=LEVEL,name=LEVEL" into {name: level}. Raises ValueError on bad input."""
+    levels = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, level = item.partition('=')
+        if not sep:
+            raise ValueError(f"Expected logger=level, got '{item}'.")
+        levels[name.strip()] = level.strip()
+    return levels
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, extra fields and the traceback."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SyslogPrefixFormatter(logging.Formatter):
+    """Prefixes lines with the syslog priority ("<3>") so journald records the level and `journalctl -p` can filter on it."""
+
+    PRIORITIES = {logging.CRITICAL: 2, logging.ERROR: 3, logging.WARNING: 4, logging.INFO: 6, logging.DEBUG: 7}
+
+    def __init__(self, formatter):
+        super().__init__()
+        self.formatter = formatter
+
+    def format(self, record):
+        return f"<{self.PRIORITIES.get(record.levelno, 6)}>{self.formatter.format(record)}"
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one in every 1/rate DEBUG records per (logger, message template)
+    for the configured loggers; the kept record carries the rate so readers
+    can scale counts back up. Other levels always pass.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG:
+            return True
+        rate = self.rates.get(record.name)
+        if rate is None or rate >= 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counters.get(key, 0)
+            self._counters[key] = count + 1
+        if count % max(1, round(1 / rate)):
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Merge the arguments now (they may change after the call) but keep the traceback apart from the message
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def setup_logging(level=None, levels=None, fmt=None, sample=None, stream=None):
+    """
+    Routes all logging through a queue to a background thread that formats and
+    writes to stdout, so callers never block on I/O. Safe to call more than
+    once; later calls only change levels.
+
+    Settings default to the environment (read at call time, after .env is loaded):
+    LOG_LEVEL (root level, default INFO), LOG_LEVELS (per logger, e.g.
+    "bot.dispatch=DEBUG,discord=WARNING"), LOG_FORMAT ('json' or 'text') and
+    LOG_SAMPLE (fraction of DEBUG records kept per logger, e.g. "bot.dispatch=0.01").
+    """
+    global _listener
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    levels = os.getenv('LOG_LEVELS', '') if levels is None else levels
+    fmt = fmt or os.getenv('LOG_FORMAT', 'json')
+    sample = os.getenv('LOG_SAMPLE', '') if sample is None else sample
+    root = logging.getLogger()
+    root.setLevel(level)
+    for name, logger_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(logger_level.upper())
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    formatter = JsonFormatter() if fmt == 'json' else logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # systemd sets JOURNAL_STREAM when stdout is connected to the journal
+    if stream is None and os.getenv('JOURNAL_STREAM'):
+        formatter = SyslogPrefixFormatter(formatter)
+    output.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    rates = {name: float(rate) for name, rate in parse_levels(sample).items()}
+    if rates:
+        handler.addFilter(SamplingFilter(rates))
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flushes queued records. Called automatically at exit."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
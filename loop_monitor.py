@@ -0,0 +1,51 @@
+# Event loop lag monitor for the bot process
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger('bot.loop')
+
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.5))
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.25))
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up from a fixed sleep. Anything beyond
+    the requested interval is time the loop spent blocked by synchronous code.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._window_max_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self._window_max_lag = max(self._window_max_lag, lag)
+            if lag > self.threshold:
+                logger.warning("Event loop was blocked for %.0f ms (threshold %.0f ms)", lag * 1000, self.threshold * 1000)
+
+    def pop_max_lag(self):
+        """Returns the worst lag seen since the previous call and resets it."""
+        lag, self._window_max_lag = self._window_max_lag, 0.0
+        return lag
+
+    def start(self):
+        """Starts the monitor on the running loop. Safe to call more than once."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
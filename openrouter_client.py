@@ -2,10 +2,12 @@
 import os
 import requests
 import json
+import logging
 from dotenv import load_dotenv
 from threading import Lock
 
 load_dotenv()
+logger = logging.getLogger('openrouter')
 
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
 OPENROUTER_API_BASE = "https://openrouter.ai/api/v1"
@@ -16,7 +18,7 @@ TEMPERATURE = float(os.getenv('OPENROUTER_TEMPERATURE', 0.4))
 YOUR_SITE_URL = os.getenv('YOUR_SITE_URL', 'http://localhost:8000')
 YOUR_APP_NAME = os.getenv('YOUR_APP_NAME', 'DiscordBot')
 
-def get_ai_response(user_prompt, conversation_history=None, context_messages=None, model_override=None, system_prompt_override=None):
+def get_ai_response(user_prompt, conversation_history=None, context_messages=None, model_override=None, system_prompt_override=None, retrieved_context=None):
     """
     Sends a prompt to the configured OpenRouter model and returns the response.
 
@@ -27,12 +29,14 @@ def get_ai_response(user_prompt, conversation_history=None, context_messages=Non
         context_messages (str, optional): A string containing recent archived messages
                                           to provide context for tone and style.
         system_prompt_override (str, optional): If provided, use this as the system prompt instead of the default.
+        retrieved_context (str, optional): Archived messages relevant to the prompt (see retrieval.py),
+                                           added to either system prompt to ground the answer.
 
     Returns:
         str: The AI's response, or None if an error occurred.
     """
     if not OPENROUTER_API_KEY:
-        print("Error: OPENROUTER_API_KEY not found in .env file.")
+        logger.error("OPENROUTER_API_KEY not found in .env file.")
         return None
 
     headers = {
@@ -51,6 +55,8 @@ def get_ai_response(user_prompt, conversation_history=None, context_messages=Non
         system_prompt = "### Sistem\nSen bir discord botusun. Aşağıdaki kurallara uy:\n Yardımcı, nazik ve saygılı ol.  \n Kullanıcının ihtiyaçlarını anlamaya çalış, açık ve anlaşılır yanıtlar ver.  \n Teknik açıklamalar gerektiğinde örnek kod ve madde işaretleri kullan.  \n Mümkün olduğunca kısa ve özlü cevaplar üret.  \n Teknik terimleri İngilizce bırakabilirsin."
         if context_messages:
             system_prompt += "\n\nÖrnek mesajlar (stilini kopyala):\n" + context_messages
+    if retrieved_context:
+        system_prompt += "\n\nSunucu geçmişinden ilgili mesajlar (cevabını bunlara dayandır):\n" + retrieved_context
     messages.append({"role": "system", "content": system_prompt})
 
     if conversation_history:
@@ -78,7 +84,8 @@ def get_ai_response(user_prompt, conversation_history=None, context_messages=Non
         response.raise_for_status()
 
         result = response.json()
-        print(f"[DEBUG] OpenRouter raw response: {result}")  # Added debug log for raw response
+        # Only the metadata; the full payload is large and the reply is logged by the caller
+        logger.debug("OpenRouter response: model=%s usage=%s", result.get('model'), result.get('usage'))
         ai_message = result['choices'][0]['message']['content'].strip()
 
         # Trim to max 3 sentences
@@ -94,8 +101,8 @@ def get_ai_response(user_prompt, conversation_history=None, context_messages=Non
         return ai_message
 
     except requests.exceptions.RequestException as e:
-        print(f"Error calling OpenRouter API: {e}")
+        logger.error("Error calling OpenRouter API: %s", e)
         return None
     except (KeyError, IndexError) as e:
-        print(f"Error parsing OpenRouter response: {e} - Response: {response.text}")
+        logger.error("Error parsing OpenRouter response: %s - Response: %s", e, response.text[:500])
         return None
@@ -0,0 +1,67 @@
+# Retrieval of relevant archived messages for AI prompts, packed under a token budget
+import os
+import time
+from lexical_index import search_messages
+
+RAG_TOKEN_BUDGET = int(os.getenv('RAG_TOKEN_BUDGET', 600))
+RAG_CANDIDATES = int(os.getenv('RAG_CANDIDATES', 20))
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token); good enough for budgeting."""
+    return (len(text) + 3) // 4
+
+
+def pack_context(messages, token_budget=RAG_TOKEN_BUDGET):
+    """
+    Formats messages (best first) as "name: message" lines until the budget is
+    spent, skipping repeated content and lines that would not fit.
+    Returns (context, tokens_used, lines_used).
+    """
+    picked = []
+    seen = set()
+    used = 0
+    for message in messages:
+        content = (message.content or '').strip()
+        if not content:
+            continue
+        key = message.content_hash or content
+        if key in seen:
+            continue
+        line = f"{message.author_name}: {content}"
+        cost = estimate_tokens(line) + 1  # + newline
+        if used + cost > token_budget:
+            continue
+        seen.add(key)
+        picked.append((message.timestamp, line))
+        used += cost
+    # Chronological order reads like a conversation
+    picked.sort(key=lambda item: item[0])
+    return "\n".join(line for _, line in picked), used, len(picked)
+
+
+def retrieve_context(db_session, index, query, guild_id=None, token_budget=RAG_TOKEN_BUDGET, candidates=RAG_CANDIDATES, baseline_messages=50):
+    """
+    Finds the archived messages most relevant to `query` (from guild_id only,
+    if given) and packs them under token_budget. Returns (context or None,
+    stats) where stats estimates the prompt size of sending the last
+    `baseline_messages` messages instead.
+    """
+    start_time = time.perf_counter()
+    messages = search_messages(db_session, index, query, candidates, guild_id=guild_id)
+    search_ms = (time.perf_counter() - start_time) * 1000
+    context, tokens, lines = pack_context(messages, token_budget)
+
+    # Only an estimate: the baseline is extrapolated from the candidates' average line size
+    sizes = [estimate_tokens(f"{m.author_name}: {m.content}") + 1 for m in messages]
+    baseline_tokens = int(sum(sizes) / len(sizes) * baseline_messages) if sizes else 0
+    stats = {
+        "retrieval_ms": round((time.perf_counter() - start_time) * 1000, 1),
+        "search_ms": round(search_ms, 1),
+        "candidates": len(messages),
+        "messages_used": lines,
+        "context_tokens": tokens,
+        "estimated_baseline_tokens": baseline_tokens,
+        "estimated_saved_tokens": max(0, baseline_tokens - tokens),
+    }
+    return context or None, stats
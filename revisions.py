@@ -0,0 +1,260 @@
+# Edit/delete tracking for archived messages: compact reverse diffs, soft deletes and a batched writer
+import argparse
+import asyncio
+import difflib
+import logging
+import os
+import sys
+from sqlalchemy import func, insert, select, update
+from database import SessionLocal, Attachment, MessageRevision, MESSAGE_TIERS, init_db, tiered_messages, message_content_hash
+from async_db import run_db
+
+logger = logging.getLogger('bot.revisions')
+
+REVISION_BATCH_SIZE = int(os.getenv('REVISION_BATCH_SIZE', 200))
+REVISION_FLUSH_INTERVAL = float(os.getenv('REVISION_FLUSH_INTERVAL', 5))
+# Revisions read per batch when the derived stores catch up (revised_messages())
+REVISION_SCAN_BATCH_SIZE = int(os.getenv('REVISION_SCAN_BATCH_SIZE', 5000))
+
+
+def content_diff(new, old):
+    """
+    Opcodes that rebuild `old` from `new`: [[start, end, text], ...] meaning
+    new[start:end] is replaced by text. Small edits of long messages store only
+    the changed spans; when that is not smaller, the whole old text is stored.
+    """
+    ops = [[i1, i2, old[j1:j2]]
+           for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, new, old, autojunk=False).get_opcodes()
+           if tag != 'equal']
+    # Each op costs a few bytes of JSON beyond its text
+    if sum(len(text) + 12 for _, _, text in ops) >= len(old):
+        return [[0, len(new), old]]
+    return ops
+
+
+def apply_diff(new, ops):
+    """Inverse of content_diff(): returns the old text."""
+    for start, end, text in reversed(ops):
+        new = new[:start] + text + new[end:]
+    return new
+
+
+def apply_revisions(db_session, events):
+    """
+    Applies a batch of ("edit", message_id, content, time) / ("delete",
+    message_id, None, time) events in order, in whichever tier holds each
+    message. Messages that are not archived are ignored; an edit stores a
+    revision with the diff back to the previous content and updates the
+    message; a delete soft deletes the message and its attachments. Returns
+    (edits, deletes) applied.
+    """
+    message_ids = {event[1] for event in events}
+    rows = []
+    tiers = {}
+    # Locked until commit: tiering.py skips locked rows, and a move that is already
+    # running makes this wait, so the UPDATEs below hit the tier that holds the row.
+    # Hot first, so a row moved while waiting is then found in the cold tier.
+    for model in MESSAGE_TIERS:
+        tier_rows = db_session.execute(
+            select(model.id, model.message_id, model.content, model.deleted_at)
+            .where(model.message_id.in_(message_ids))
+            .with_for_update()
+        ).all()
+        tiers.update((row.message_id, model) for row in tier_rows)
+        rows += tier_rows
+    if not rows:
+        return 0, 0
+    row_ids = {row.message_id: row.id for row in rows}
+    content = {row.message_id: row.content for row in rows}
+    deleted = {row.message_id: row.deleted_at for row in rows}
+    last_revision = dict(db_session.execute(
+        select(MessageRevision.message_id, func.max(MessageRevision.revision))
+        .where(MessageRevision.message_id.in_(list(row_ids)))
+        .group_by(MessageRevision.message_id)
+    ).all())
+
+    revisions = []
+    edited = {}
+    deleted_now = {}
+    for event, message_id, new_content, occurred_at in events:
+        # Not archived, or already deleted (a late edit)
+        if message_id not in content or deleted[message_id] is not None:
+            continue
+        if event == 'edit':
+            previous = content[message_id]
+            if new_content == previous:
+                continue
+            diff = content_diff(new_content, previous)
+            content[message_id] = new_content
+            edited[message_id] = occurred_at
+        else:
+            diff = None
+            deleted[message_id] = deleted_now[message_id] = occurred_at
+        last_revision[message_id] = last_revision.get(message_id, 0) + 1
+        revisions.append({"message_id": message_id, "revision": last_revision[message_id], "event": event,
+                          "occurred_at": occurred_at, "diff": diff})
+
+    if revisions:
+        db_session.execute(insert(MessageRevision), revisions)
+    # Bulk UPDATEs by primary key, one statement per tier and batch
+    for model in MESSAGE_TIERS:
+        edit_rows = [{
+            "id": row_ids[message_id],
+            "content": content[message_id],
+            "content_hash": message_content_hash(content[message_id]),
+            "edited_at": edited_at,
+        } for message_id, edited_at in edited.items() if tiers[message_id] is model]
+        if edit_rows:
+            db_session.execute(update(model), edit_rows)
+        delete_rows = [{"id": row_ids[message_id], "deleted_at": deleted_at}
+                       for message_id, deleted_at in deleted_now.items() if tiers[message_id] is model]
+        if delete_rows:
+            db_session.execute(update(model), delete_rows)
+    if deleted_now:
+        by_time = {}
+        for message_id, deleted_at in deleted_now.items():
+            by_time.setdefault(deleted_at, []).append(message_id)
+        for deleted_at, ids in by_time.items():
+            db_session.execute(update(Attachment)
+                               .where(Attachment.message_id.in_(ids), Attachment.deleted_at.is_(None))
+                               .values(deleted_at=deleted_at))
+    db_session.commit()
+    edits = sum(1 for revision in revisions if revision['event'] == 'edit')
+    return edits, len(deleted_now)
+
+
+def last_revision_id(db_session):
+    """The newest MessageRevision id (0 if there is none)."""
+    return db_session.scalar(select(func.max(MessageRevision.id))) or 0
+
+
+def revised_messages(db_session, after_id, *names, batch_size=REVISION_SCAN_BATCH_SIZE):
+    """
+    Catches a derived store (style profiles, lexical index, archive sampler) up
+    on edits and deletes. Yields (revision id, rows) per batch of revisions
+    after `after_id`, where rows are the current versions of the messages they
+    touched, with the named columns plus deleted_at. Store the revision id once
+    the rows are handled.
+    """
+    messages = tiered_messages(*dict.fromkeys(names + ('message_id', 'deleted_at')))
+    while True:
+        revisions = db_session.execute(
+            select(MessageRevision.id, MessageRevision.message_id)
+            .where(MessageRevision.id > after_id)
+            .order_by(MessageRevision.id)
+            .limit(batch_size)
+        ).all()
+        if not revisions:
+            return
+        after_id = revisions[-1].id
+        message_ids = {revision.message_id for revision in revisions}
+        yield after_id, db_session.execute(select(messages).where(messages.c.message_id.in_(message_ids))).all()
+
+
+def message_history(db_session, message_id):
+    """
+    Every known version of an archived message, newest first, rebuilt from the
+    current content and the stored diffs. Entries are {"revision", "event",
+    "occurred_at", "content"}; the last one (revision 0) is the archived original.
+    Returns None if the message is not archived.
+    """
+    messages = tiered_messages('message_id', 'content', 'timestamp')
+    message = db_session.execute(
+        select(messages.c.content, messages.c.timestamp).where(messages.c.message_id == message_id)
+    ).first()
+    if message is None:
+        return None
+    content = message.content
+    history = []
+    for revision in db_session.scalars(
+            select(MessageRevision).where(MessageRevision.message_id == message_id).order_by(MessageRevision.revision.desc())):
+        history.append({"revision": revision.revision, "event": revision.event, "occurred_at": revision.occurred_at, "content": content})
+        if revision.event == 'edit':
+            content = apply_diff(content, revision.diff)
+    history.append({"revision": 0, "event": "archived", "occurred_at": message.timestamp, "content": content})
+    return history
+
+
+class RevisionWriter:
+    """
+    Buffers edit/delete events from the gateway (cheap to record on the event
+    loop) and applies them with apply_revisions() on the DB thread pool: every
+    `interval` seconds, or as soon as `batch_size` events are waiting. After a
+    batch that changed anything, on_applied(db_session) runs on the pool too, so
+    the derived stores can drop deleted and pre-edit text right away.
+    """
+
+    def __init__(self, batch_size=REVISION_BATCH_SIZE, interval=REVISION_FLUSH_INTERVAL, on_applied=None):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.on_applied = on_applied
+        self._pending = []
+        self._full = asyncio.Event()
+        # Batches are applied one at a time so revision numbers stay in order
+        self._flush_lock = asyncio.Lock()
+        self.stats = {"edits": 0, "deletes": 0, "batches": 0, "failed": 0}
+
+    def _add(self, event):
+        self._pending.append(event)
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    def edit(self, message_id, content, edited_at):
+        self._add(("edit", message_id, content, edited_at))
+
+    def delete(self, message_id, deleted_at):
+        self._add(("delete", message_id, None, deleted_at))
+
+    async def flush(self):
+        """Applies everything buffered so far."""
+        async with self._flush_lock:
+            self._full.clear()
+            if not self._pending:
+                return
+            events, self._pending = self._pending, []
+            try:
+                edits, deletes = await run_db(apply_revisions, events)
+            except Exception as e:
+                self.stats["failed"] += len(events)
+                logger.error("Error applying %s message edit/delete events: %s", len(events), e)
+                return
+            self.stats["batches"] += 1
+            self.stats["edits"] += edits
+            self.stats["deletes"] += deletes
+            if edits or deletes:
+                logger.info("Applied %s edits and %s deletes to the archive (%s events)", edits, deletes, len(events))
+                if self.on_applied is not None:
+                    try:
+                        await run_db(self.on_applied)
+                    except Exception as e:
+                        logger.error("Error refreshing after message edits/deletes: %s", e)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show the edit/delete history of an archived message.")
+    parser.add_argument('message_id', type=int)
+    args = parser.parse_args(argv)
+
+    init_db()
+    with SessionLocal() as db_session:
+        history = message_history(db_session, args.message_id)
+    if history is None:
+        print(f"Message {args.message_id} is not archived.")
+        return 1
+    for entry in history:
+        print(f"#{entry['revision']} {entry['event']} at {entry['occurred_at']}:")
+        if entry['event'] != 'delete':
+            print(f"  {entry['content']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+# Incremental daily rollups of the archive for dashboard analytics
+import datetime
+import os
+import sys
+from sqlalchemy import func, select
+from database import SessionLocal, Attachment, MessageDailyRollup, AttachmentDailyRollup, RollupWatermark, init_db, tiered_messages
+
+ROLLUP_BATCH_SIZE = int(os.getenv('ROLLUP_BATCH_SIZE', 50000))
+
+
+def _dialect_insert(db_session, table):
+    # Both dialects support INSERT ... ON CONFLICT DO UPDATE
+    if db_session.bind.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def _upsert(db_session, model, rows, set_fn, chunk_size=1000):
+    """Adds rows to a rollup table, combining with existing keys via set_fn(excluded)."""
+    index_elements = [column.name for column in model.__table__.primary_key.columns]
+    # Chunked to stay under SQLite's bound parameter limit
+    for start in range(0, len(rows), chunk_size):
+        stmt = _dialect_insert(db_session, model).values(rows[start:start + chunk_size])
+        db_session.execute(stmt.on_conflict_do_update(index_elements=index_elements, set_=set_fn(stmt.excluded)))
+
+
+def _as_date(value):
+    # SQLite returns DATE() as a string
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+def _get_watermark(db_session, name):
+    watermark = db_session.get(RollupWatermark, name)
+    if watermark is None:
+        watermark = RollupWatermark(name=name, last_id=0)
+        db_session.add(watermark)
+        db_session.flush()
+    return watermark
+
+
+def _next_batch_end(db_session, id_column, after_id, batch_size):
+    """Returns the id of the last row in the next batch after after_id, or None if there are no new rows."""
+    batch = select(id_column.label('id')).where(id_column > after_id).order_by(id_column).limit(batch_size).subquery()
+    return db_session.execute(select(func.max(batch.c.id))).scalar()
+
+
+# Both message tiers: rows keep their id when tiering.py moves them to cold storage
+_MESSAGES = tiered_messages('id', 'message_id', 'guild_id', 'channel_id', 'author_id', 'author_name', 'timestamp')
+
+
+def _rollup_messages(db_session, after_id, upto_id):
+    day = func.date(_MESSAGES.c.timestamp)
+    rows = db_session.execute(
+        select(day, _MESSAGES.c.guild_id, _MESSAGES.c.channel_id, _MESSAGES.c.author_id,
+               func.max(_MESSAGES.c.author_name), func.count())
+        .where(_MESSAGES.c.id > after_id, _MESSAGES.c.id <= upto_id)
+        .group_by(day, _MESSAGES.c.guild_id, _MESSAGES.c.channel_id, _MESSAGES.c.author_id)
+    ).all()
+    if not rows:
+        return 0
+    _upsert(db_session, MessageDailyRollup, [
+        {"day": _as_date(r[0]), "guild_id": r[1], "channel_id": r[2], "author_id": r[3], "author_name": r[4], "message_count": r[5]}
+        for r in rows
+    ], lambda excluded: {
+        "message_count": MessageDailyRollup.message_count + excluded.message_count,
+        "author_name": excluded.author_name,
+    })
+    return sum(r[5] for r in rows)
+
+
+def _rollup_attachments(db_session, after_id, upto_id):
+    day = func.date(_MESSAGES.c.timestamp)
+    content_type = func.coalesce(Attachment.content_type, '')
+    rows = db_session.execute(
+        select(day, _MESSAGES.c.guild_id, _MESSAGES.c.channel_id, content_type, func.count())
+        .join(_MESSAGES, _MESSAGES.c.message_id == Attachment.message_id)
+        .where(Attachment.id > after_id, Attachment.id <= upto_id)
+        .group_by(day, _MESSAGES.c.guild_id, _MESSAGES.c.channel_id, content_type)
+    ).all()
+    if not rows:
+        return 0
+    _upsert(db_session, AttachmentDailyRollup, [
+        {"day": _as_date(r[0]), "guild_id": r[1], "channel_id": r[2], "content_type": r[3][:100], "attachment_count": r[4]}
+        for r in rows
+    ], lambda excluded: {
+        "attachment_count": AttachmentDailyRollup.attachment_count + excluded.attachment_count,
+    })
+    return sum(r[4] for r in rows)
+
+
+_ROLLUPS = (
+    ('messages', _MESSAGES.c.id, _rollup_messages),
+    ('attachments', Attachment.id, _rollup_attachments),
+)
+
+
+def update_rollups(db_session, batch_size=ROLLUP_BATCH_SIZE):
+    """
+    Folds rows added since the last run into the daily rollup tables.
+
+    Each batch and its watermark are committed together, so a run can be
+    interrupted and repeated safely. Only rows above the watermark are read,
+    so the cost depends on how much is new, not on the archive size.
+    Deleted messages are not subtracted from existing rollups.
+    Returns the number of source rows folded in.
+    """
+    processed = 0
+    for name, id_column, rollup in _ROLLUPS:
+        while True:
+            watermark = _get_watermark(db_session, name)
+            after_id = watermark.last_id
+            upto_id = _next_batch_end(db_session, id_column, after_id, batch_size)
+            if upto_id is None:
+                db_session.commit()
+                break
+            processed += rollup(db_session, after_id, upto_id)
+            watermark.last_id = upto_id
+            db_session.commit()
+    return processed
+
+
+def get_analytics(db_session, days=90, top=10):
+    """Reads dashboard analytics from the rollup tables only."""
+    latest_day = db_session.execute(select(func.max(MessageDailyRollup.day))).scalar()
+    per_day = []
+    if latest_day is not None:
+        latest_day = _as_date(latest_day)
+        since = latest_day - datetime.timedelta(days=days - 1)
+        per_day = [
+            {"day": _as_date(day).isoformat(), "messages": count}
+            for day, count in db_session.execute(
+                select(MessageDailyRollup.day, func.sum(MessageDailyRollup.message_count))
+                .where(MessageDailyRollup.day >= since)
+                .group_by(MessageDailyRollup.day)
+                .order_by(MessageDailyRollup.day)
+            )
+        ]
+
+    total = func.sum(MessageDailyRollup.message_count)
+    top_channels = [
+        {"channel_id": str(channel_id), "messages": count}
+        for channel_id, count in db_session.execute(
+            select(MessageDailyRollup.channel_id, total).group_by(MessageDailyRollup.channel_id).order_by(total.desc()).limit(top)
+        )
+    ]
+    top_authors = [
+        {"author_id": str(author_id), "author_name": name, "messages": count}
+        for author_id, name, count in db_session.execute(
+            select(MessageDailyRollup.author_id, func.max(MessageDailyRollup.author_name), total)
+            .group_by(MessageDailyRollup.author_id).order_by(total.desc()).limit(top)
+        )
+    ]
+
+    # Group by major type (image, video, ...) for the mix chart
+    type_mix = {}
+    for content_type, count in db_session.execute(
+        select(AttachmentDailyRollup.content_type, func.sum(AttachmentDailyRollup.attachment_count))
+        .group_by(AttachmentDailyRollup.content_type)
+    ):
+        major = content_type.split('/', 1)[0] if content_type else 'unknown'
+        type_mix[major] = type_mix.get(major, 0) + count
+
+    return {
+        "per_day": per_day,
+        "top_channels": top_channels,
+        "top_authors": top_authors,
+        "attachment_types": [{"type": t, "attachments": c} for t, c in sorted(type_mix.items(), key=lambda item: -item[1])],
+    }
+
+
+# Run directly (e.g. from cron) to catch the rollups up with the archive
+if __name__ == "__main__":
+    init_db()
+    with SessionLocal() as db_session:
+        count = update_rollups(db_session)
+    print(f"Rollups updated: {count} new rows processed.")
+    sys.exit(0)
@@ -0,0 +1,204 @@
+# Per-channel outgoing message queues that pace sends under Discord's rate limits
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import deque
+import discord
+
+logger = logging.getLogger('bot.send')
+
+DISCORD_MESSAGE_LIMIT = 2000
+# Discord allows about 5 messages per 5 seconds per channel; stay at or under that
+SEND_RATE_MESSAGES = int(os.getenv('SEND_RATE_MESSAGES', 5))
+SEND_RATE_PERIOD = float(os.getenv('SEND_RATE_PERIOD', 5))
+# Random/archive replies older than this are dropped instead of sent late
+SEND_STALE_AFTER = float(os.getenv('SEND_STALE_AFTER', 20))
+SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', 3))
+
+_SENTENCE_END = re.compile(r'[.!?…](?:["\')\]]*)\s+')
+
+
+def _split_point(text, limit):
+    """Index to cut `text` at, preferring paragraph, line, sentence, then word boundaries."""
+    window = text[:limit]
+    for separator in ('\n\n', '\n'):
+        cut = window.rfind(separator)
+        if cut >= limit // 2:
+            return cut + len(separator)
+    sentence_ends = [m.end() for m in _SENTENCE_END.finditer(window)]
+    if sentence_ends and sentence_ends[-1] >= limit // 2:
+        return sentence_ends[-1]
+    cut = window.rfind(' ')
+    if cut >= limit // 2:
+        return cut + 1
+    return limit
+
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Splits text into chunks of at most `limit` characters along natural boundaries."""
+    chunks = []
+    text = text.strip()
+    while len(text) > limit:
+        cut = _split_point(text, limit)
+        chunk = text[:cut].rstrip()
+        if chunk:
+            chunks.append(chunk)
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class _Outgoing:
+    __slots__ = ('channel', 'chunks', 'droppable', 'queued_at', 'future')
+
+    def __init__(self, channel, chunks, droppable, future):
+        self.channel = channel
+        self.chunks = chunks
+        self.droppable = droppable
+        self.queued_at = time.monotonic()
+        self.future = future
+
+
+class SendQueue:
+    """
+    Serializes bot messages per channel and paces them with a sliding window of
+    SEND_RATE_MESSAGES per SEND_RATE_PERIOD, so bursts queue up locally instead
+    of hitting 429s.
+
+    Replies marked droppable (random archive replies) are coalesced: a channel
+    keeps at most one waiting droppable reply, a newer one replaces it, and one
+    that waited longer than stale_after is dropped. Long messages are split into
+    2000-character chunks. 429s block the channel (and every channel sharing
+    the rate limit bucket) for the advertised retry-after.
+    """
+
+    def __init__(self, rate=SEND_RATE_MESSAGES, period=SEND_RATE_PERIOD, stale_after=SEND_STALE_AFTER):
+        self.rate = rate
+        self.period = period
+        self.stale_after = stale_after
+        self._queues = {}       # channel_id -> deque of _Outgoing
+        self._workers = {}      # channel_id -> Task, only while the queue has work
+        self._sent_at = {}      # channel_id -> deque of recent send times
+        self._buckets = {}      # channel_id -> rate limit bucket reported by Discord
+        self._blocked_until = {}  # bucket or channel_id -> monotonic time
+        self.stats = {"sent": 0, "dropped": 0, "coalesced": 0, "rate_limited": 0, "failed": 0}
+
+    def pending(self, channel_id):
+        return len(self._queues.get(channel_id, ()))
+
+    async def send(self, channel, content, droppable=False):
+        """
+        Queues content for channel and waits until it is sent. Returns the sent
+        messages, or None if a droppable reply was coalesced or went stale.
+        Raises the Discord error if sending failed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = _Outgoing(channel, split_message(content), droppable, future)
+        if not item.chunks:
+            return []
+        queue = self._queues.setdefault(channel.id, deque())
+        if droppable:
+            # queue[0] may already be sending, so only replies behind it are replaced
+            for index in range(1, len(queue)):
+                waiting = queue[index]
+                if waiting.droppable:
+                    # Channel is busy: the newer reply replaces the one still waiting
+                    queue[index] = item
+                    self._finish(waiting, None)
+                    self.stats["coalesced"] += 1
+                    break
+            else:
+                queue.append(item)
+        else:
+            queue.append(item)
+        worker = self._workers.get(channel.id)
+        if worker is None or worker.done():
+            self._workers[channel.id] = asyncio.create_task(self._run(channel.id))
+        return await future
+
+    def _finish(self, item, result=None, error=None):
+        if item.future.done():
+            return
+        if error is not None:
+            item.future.set_exception(error)
+        else:
+            item.future.set_result(result)
+        if result is None and error is None:
+            self.stats["dropped"] += 1
+
+    def _delay(self, channel_id):
+        """Seconds until the channel may send again."""
+        now = time.monotonic()
+        blocked = max(self._blocked_until.get(channel_id, 0), self._blocked_until.get(self._buckets.get(channel_id), 0))
+        delay = blocked - now
+        sent_at = self._sent_at.setdefault(channel_id, deque())
+        while sent_at and now - sent_at[0] >= self.period:
+            sent_at.popleft()
+        if len(sent_at) >= self.rate:
+            delay = max(delay, sent_at[0] + self.period - now)
+        return max(0.0, delay)
+
+    def _record_rate_limit(self, channel_id, error):
+        self.stats["rate_limited"] += 1
+        retry_after = getattr(error, 'retry_after', None)
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        if retry_after is None:
+            retry_after = float(headers.get('Retry-After') or 1)
+        bucket = headers.get('X-RateLimit-Bucket')
+        until = time.monotonic() + retry_after
+        if bucket:
+            self._buckets[channel_id] = bucket
+            self._blocked_until[bucket] = max(self._blocked_until.get(bucket, 0), until)
+        self._blocked_until[channel_id] = max(self._blocked_until.get(channel_id, 0), until)
+        logger.warning("Rate limited sending to channel %s; retrying in %.1fs", channel_id, retry_after)
+
+    async def _send_chunk(self, item, chunk):
+        """Sends one chunk, waiting out local pacing and 429s. Returns the message, or None if the reply went stale."""
+        channel_id = item.channel.id
+        for attempt in range(SEND_MAX_ATTEMPTS):
+            delay = self._delay(channel_id)
+            if delay:
+                await asyncio.sleep(delay)
+            if item.droppable and time.monotonic() - item.queued_at > self.stale_after:
+                return None
+            try:
+                message = await item.channel.send(chunk)
+            except discord.RateLimited as e:
+                if attempt == SEND_MAX_ATTEMPTS - 1:
+                    raise
+                self._record_rate_limit(channel_id, e)
+                continue
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == SEND_MAX_ATTEMPTS - 1:
+                    raise
+                self._record_rate_limit(channel_id, e)
+                continue
+            self._sent_at[channel_id].append(time.monotonic())
+            self.stats["sent"] += 1
+            return message
+
+    async def _run(self, channel_id):
+        queue = self._queues[channel_id]
+        while queue:
+            item = queue[0]
+            sent = []
+            try:
+                for chunk in item.chunks:
+                    message = await self._send_chunk(item, chunk)
+                    if message is None:
+                        break
+                    sent.append(message)
+            except Exception as e:
+                queue.popleft()
+                self.stats["failed"] += 1
+                self._finish(item, error=e)
+                continue
+            queue.popleft()
+            # Stale droppable replies finish with None
+            self._finish(item, sent or None)
+        del self._workers[channel_id]
+        del self._queues[channel_id]
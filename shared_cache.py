@@ -0,0 +1,130 @@
+# Cache shared by all web worker processes, kept in a small local SQLite file
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+WEB_CACHE_FILE = os.getenv('WEB_CACHE_FILE', os.path.join(tempfile.gettempdir(), 'discord-archive-web-cache.sqlite'))
+
+
+class SharedStore:
+    """
+    JSON values in one SQLite table, visible to every process on the host.
+
+    Besides the value, each key keeps when it was loaded, when it was last
+    invalidated and a short lease, so only one process reloads a key at a time.
+    Connections are per thread and per process (safe across gunicorn's fork).
+    """
+
+    def __init__(self, path=WEB_CACHE_FILE):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT, loaded_at REAL NOT NULL DEFAULT 0, "
+                "invalidated_at REAL NOT NULL DEFAULT 0, lease_until REAL NOT NULL DEFAULT 0)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        """Returns (value, loaded_at), or None if the key has no value newer than its last invalidation."""
+        row = self._connect().execute(
+            "SELECT value, loaded_at, invalidated_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[0] is None or row[1] < row[2]:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, started_at):
+        """Stores a value loaded at `started_at`, unless a newer load or an invalidation came after it."""
+        conn = self._connect()
+        conn.execute("INSERT OR IGNORE INTO cache (key) VALUES (?)", (key,))
+        conn.execute(
+            "UPDATE cache SET value = ?, loaded_at = ?, lease_until = 0 "
+            "WHERE key = ? AND loaded_at <= ? AND invalidated_at <= ?",
+            (json.dumps(value, default=str), started_at, key, started_at, started_at),
+        )
+
+    def invalidate(self, key):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("INSERT OR IGNORE INTO cache (key) VALUES (?)", (key,))
+        conn.execute("UPDATE cache SET invalidated_at = ?, lease_until = 0 WHERE key = ?", (now, key))
+
+    def acquire(self, key, seconds):
+        """Takes the reload lease for `seconds`. Returns False if another process holds it."""
+        now = time.time()
+        conn = self._connect()
+        conn.execute("INSERT OR IGNORE INTO cache (key) VALUES (?)", (key,))
+        cursor = conn.execute(
+            "UPDATE cache SET lease_until = ? WHERE key = ? AND lease_until < ?", (now + seconds, key, now)
+        )
+        return cursor.rowcount == 1
+
+    def release(self, key):
+        self._connect().execute("UPDATE cache SET lease_until = 0 WHERE key = ?", (key,))
+
+
+class SharedRefreshingCache:
+    """
+    Holds one value produced by `loader` for multiple processes: the value
+    lives in a SharedStore, so however many workers run, the loader runs about
+    once per `ttl`. Stale values are served while one process reloads in the
+    background; after invalidate() (from any process) the next get() waits for
+    a fresh value. Values must be JSON serializable.
+    """
+
+    def __init__(self, store, key, loader, ttl=5.0, lease=30.0):
+        self.store = store
+        self.key = key
+        self.loader = loader
+        self.ttl = ttl
+        self.lease = lease
+
+    def _load(self):
+        started_at = time.time()
+        try:
+            value = self.loader()
+            self.store.set(self.key, value, started_at)
+            return value
+        finally:
+            self.store.release(self.key)
+
+    def _refresh_in_background(self):
+        try:
+            self._load()
+        except Exception as e:
+            print(f"Error refreshing {self.key}: {e}")
+
+    def get(self):
+        entry = self.store.get(self.key)
+        if entry is not None:
+            value, loaded_at = entry
+            if time.time() - loaded_at > self.ttl and self.store.acquire(self.key, self.lease):
+                threading.Thread(target=self._refresh_in_background, name=f"{self.key}-refresh", daemon=True).start()
+            return value
+        # No value yet or just invalidated: wait for the process holding the lease, or load here
+        deadline = time.time() + self.lease
+        while not self.store.acquire(self.key, self.lease):
+            time.sleep(0.05)
+            entry = self.store.get(self.key)
+            if entry is not None:
+                return entry[0]
+            if time.time() > deadline:
+                break
+        return self._load()
+
+    def invalidate(self):
+        """Forces the next get() in every process to load a fresh value."""
+        self.store.invalidate(self.key)
@@ -0,0 +1,255 @@
+# Per-author/channel style profiles for the AI "copy the style" mode
+import argparse
+import datetime
+import os
+import re
+import sys
+import threading
+from sqlalchemy import select, tuple_
+from database import SessionLocal, StyleProfile, RollupWatermark, init_db, tiered_messages
+from revisions import last_revision_id, revised_messages
+
+STYLE_PROFILE_SIZE = int(os.getenv('STYLE_PROFILE_SIZE', 20))
+STYLE_PROFILE_BATCH_SIZE = int(os.getenv('STYLE_PROFILE_BATCH_SIZE', 20000))
+# Shortest/longest message worth using as a style sample
+STYLE_MIN_LENGTH = 3
+STYLE_MAX_LENGTH = 400
+# Samples sharing more than this fraction of words are treated as near-duplicates
+STYLE_MAX_SIMILARITY = 0.5
+WATERMARK_NAME = 'style_profiles'
+# Last MessageRevision folded into the profiles
+REVISIONS_WATERMARK_NAME = 'style_profiles_revisions'
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_URL_ONLY_RE = re.compile(r'^\s*<?https?://\S+>?\s*$')
+# The bot refreshes after edits as well as on its timer
+_update_lock = threading.Lock()
+
+
+def is_style_candidate(content):
+    """Filters out messages that say nothing about writing style (empty, commands, bare links, huge pastes)."""
+    if not content:
+        return False
+    text = content.strip()
+    if len(text) < STYLE_MIN_LENGTH or len(text) > STYLE_MAX_LENGTH:
+        return False
+    if text.startswith('!') or _URL_ONLY_RE.match(text):
+        return False
+    return True
+
+
+def _score(sample, oldest, newest):
+    # Medium-length messages carry the most style; newer ones reflect current tone
+    length = len(sample['content'])
+    length_score = min(length, 80) / 80 if length <= 200 else max(0.3, 1 - (length - 200) / 400)
+    span = (newest - oldest).total_seconds()
+    recency = (sample['_ts'] - oldest).total_seconds() / span if span > 0 else 1.0
+    return 0.6 * length_score + 0.4 * recency
+
+
+def select_representative(samples, k=STYLE_PROFILE_SIZE):
+    """
+    Picks up to k samples, best length/recency score first, skipping any that
+    are too similar (word Jaccard) to one already picked.
+    """
+    if not samples:
+        return []
+    for sample in samples:
+        if '_ts' not in sample:
+            sample['_ts'] = datetime.datetime.fromisoformat(sample['timestamp'])
+    oldest = min(s['_ts'] for s in samples)
+    newest = max(s['_ts'] for s in samples)
+    ranked = sorted(samples, key=lambda s: _score(s, oldest, newest), reverse=True)
+
+    picked = []
+    picked_words = []
+    for sample in ranked:
+        words = set(_WORD_RE.findall(sample['content'].lower()))
+        if any(len(words & other) / max(len(words | other), 1) > STYLE_MAX_SIMILARITY for other in picked_words):
+            continue
+        picked.append(sample)
+        picked_words.append(words)
+        if len(picked) >= k:
+            break
+    # Chronological order reads more naturally in the prompt
+    picked.sort(key=lambda s: s['_ts'])
+    return [{key: value for key, value in s.items() if key != '_ts'} for s in picked]
+
+
+def _scope_keys(row):
+    return (('author', row.author_id), ('channel', row.channel_id), ('guild', row.guild_id), ('global', 0))
+
+
+def _sample(row):
+    return {
+        "message_id": row.message_id,
+        "author_name": row.author_name,
+        "content": row.content.strip(),
+        "timestamp": row.timestamp.isoformat(),
+    }
+
+
+def _watermark(db_session, name):
+    watermark = db_session.get(RollupWatermark, name)
+    if watermark is None:
+        watermark = RollupWatermark(name=name, last_id=0)
+        db_session.add(watermark)
+        db_session.flush()
+    return watermark
+
+
+def _apply_revisions(db_session, watermark, revisions_watermark, k):
+    """Drops samples of deleted messages and replaces those of edited ones with the current text."""
+    if watermark.last_id == 0:
+        # Nothing built yet: the build reads the current text anyway
+        revisions_watermark.last_id = last_revision_id(db_session)
+        return
+    names = ('id', 'author_id', 'author_name', 'guild_id', 'channel_id', 'content', 'timestamp')
+    for revision_id, rows in revised_messages(db_session, revisions_watermark.last_id, *names):
+        # Messages above the watermark are picked up in their current state later
+        rows = [row for row in rows if row.id <= watermark.last_id]
+        revised = {row.message_id for row in rows}
+        candidates = {}
+        for row in rows:
+            for key in _scope_keys(row):
+                candidates.setdefault(key, [])
+                if row.deleted_at is None and is_style_candidate(row.content):
+                    candidates[key].append(_sample(row))
+        if candidates:
+            for profile in db_session.query(StyleProfile).filter(tuple_(StyleProfile.scope, StyleProfile.scope_id).in_(list(candidates))):
+                kept = [sample for sample in profile.samples if sample['message_id'] not in revised]
+                if len(kept) < len(profile.samples) or candidates[(profile.scope, profile.scope_id)]:
+                    profile.samples = select_representative(kept + candidates[(profile.scope, profile.scope_id)], k)
+        revisions_watermark.last_id = revision_id
+        db_session.commit()
+
+
+def update_style_profiles(db_session, batch_size=STYLE_PROFILE_BATCH_SIZE, k=STYLE_PROFILE_SIZE):
+    """
+    Merges messages added since the last run into the affected profiles, after
+    applying edits and deletes since then to the existing samples.
+
+    Each batch re-selects samples from (current samples + new candidates) for
+    every author/channel it touches, so a full build and an incremental update
+    use the same code path. Returns the number of messages processed.
+    """
+    with _update_lock:
+        watermark = _watermark(db_session, WATERMARK_NAME)
+        _apply_revisions(db_session, watermark, _watermark(db_session, REVISIONS_WATERMARK_NAME), k)
+        return _add_messages(db_session, watermark, batch_size, k)
+
+
+def _add_messages(db_session, watermark, batch_size, k):
+    processed = 0
+    # Both tiers, so a rebuild also sees messages already moved to cold storage
+    messages = tiered_messages('id', 'message_id', 'author_id', 'author_name', 'guild_id', 'channel_id', 'content', 'timestamp',
+                               live_only=True)
+    while True:
+        rows = db_session.execute(
+            select(messages)
+            .where(messages.c.id > watermark.last_id)
+            .order_by(messages.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            db_session.commit()
+            return processed
+
+        # Group new candidates by scope
+        counts = {}
+        candidates = {}
+        for row in rows:
+            keep = is_style_candidate(row.content)
+            for key in _scope_keys(row):
+                counts[key] = counts.get(key, 0) + 1
+                if keep:
+                    candidates.setdefault(key, []).append(_sample(row))
+
+        existing = {
+            (p.scope, p.scope_id): p
+            for p in db_session.query(StyleProfile).filter(tuple_(StyleProfile.scope, StyleProfile.scope_id).in_(list(counts)))
+        }
+        for key, count in counts.items():
+            profile = existing.get(key)
+            if profile is None:
+                profile = StyleProfile(scope=key[0], scope_id=key[1], samples=[], message_count=0)
+                db_session.add(profile)
+            new_candidates = candidates.get(key)
+            if new_candidates:
+                profile.samples = select_representative(list(profile.samples) + new_candidates, k)
+            profile.message_count = (profile.message_count or 0) + count
+
+        watermark.last_id = rows[-1].id
+        db_session.commit()
+        processed += len(rows)
+
+
+def format_samples(samples):
+    """Formats samples like get_recent_messages_for_context ("name: message" lines)."""
+    return "\n".join(f"{s['author_name']}: {s['content']}" for s in samples)
+
+
+class StyleProfileCache:
+    """
+    In-memory copy of the style profiles with the prompt text preformatted, so
+    a lookup is a dict access. load() only rereads the table when the profile
+    builder has processed new messages or revisions since the previous load.
+    """
+
+    def __init__(self):
+        self._contexts = {}
+        self._loaded_watermark = None
+
+    def load(self, db_session):
+        """Reloads the profiles if they changed. Returns True if a reload happened."""
+        current = tuple(
+            db_session.scalar(select(RollupWatermark.last_id).where(RollupWatermark.name == name)) or 0
+            for name in (WATERMARK_NAME, REVISIONS_WATERMARK_NAME)
+        )
+        if current == self._loaded_watermark:
+            return False
+        contexts = {}
+        for scope, scope_id, samples in db_session.execute(select(StyleProfile.scope, StyleProfile.scope_id, StyleProfile.samples)):
+            if samples:
+                contexts[(scope, scope_id)] = format_samples(samples)
+        # Swap in one assignment so readers never see a half-built dict
+        self._contexts = contexts
+        self._loaded_watermark = current
+        return True
+
+    def get_context(self, scope, scope_id):
+        return self._contexts.get((scope, scope_id))
+
+    def get_context_for(self, preferred_scope, author_id, channel_id, guild_id=None):
+        """
+        Returns the profile for the preferred scope, falling back to channel,
+        then guild when guild_id is given (so other guilds' messages are never
+        used), otherwise global.
+        """
+        ids = {'author': author_id, 'channel': channel_id, 'guild': guild_id, 'global': 0}
+        fallback = ('channel', 'guild') if guild_id is not None else ('channel', 'global')
+        for scope in (preferred_scope,) + fallback:
+            context = self._contexts.get((scope, ids.get(scope)))
+            if context:
+                return context
+        return None
+
+
+def rebuild_style_profiles(db_session):
+    """Drops all profiles and rebuilds them from the whole archive."""
+    db_session.query(StyleProfile).delete()
+    db_session.query(RollupWatermark).filter(RollupWatermark.name.in_((WATERMARK_NAME, REVISIONS_WATERMARK_NAME))).delete()
+    db_session.commit()
+    return update_style_profiles(db_session)
+
+
+# Run directly to build (or catch up) the profiles from the archive
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or catch up the AI style profiles.")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild every profile from scratch (e.g. after new profile scopes were added).")
+    args = parser.parse_args()
+    init_db()
+    with SessionLocal() as db_session:
+        count = rebuild_style_profiles(db_session) if args.rebuild else update_style_profiles(db_session)
+    print(f"Style profiles updated from {count} messages.")
+    sys.exit(0)
@@ -0,0 +1,26 @@
+# Shared test setup: the modules read their configuration at import time
+import base64
+import os
+import sys
+import tempfile
+import pytest
+
+_TEST_DIR = tempfile.mkdtemp(prefix='discord-archive-bot-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_TEST_DIR, 'archive.db')}"
+os.environ['WEB_CACHE_FILE'] = os.path.join(_TEST_DIR, 'web_cache.sqlite')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+AUTH_HEADER = "Basic " + base64.b64encode(b"admin:password").decode()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Web UI test client, logged in."""
+    import web_app
+    from database import init_db
+    init_db()
+    monkeypatch.setattr(web_app, 'ADMIN_USERNAME', 'admin')
+    monkeypatch.setattr(web_app, 'ADMIN_PASSWORD', 'password')
+    test_client = web_app.create_app().test_client()
+    test_client.environ_base['HTTP_AUTHORIZATION'] = AUTH_HEADER
+    return test_client
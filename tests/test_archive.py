@@ -0,0 +1,45 @@
+import asyncio
+import datetime
+import os
+from types import SimpleNamespace
+import pytest
+
+# archive.py exits at import without these
+os.environ.setdefault('ARCHIVE_BOT_TOKEN', 'test-token')
+os.environ.setdefault('OLD_GUILD_ID', '48')
+import archive
+from database import init_db
+
+BASE_ID = 48_000_000
+
+
+def _record(i, content='archived text'):
+    return archive.ArchivedMessage(BASE_ID + i, 48, 1, 1, 'a', content, datetime.datetime(2024, 1, 1), ())
+
+
+class FakeChannel:
+    name = 'general'
+    id = 1
+
+    async def history(self, limit=None, oldest_first=True):
+        for i in range(100, 120):
+            yield SimpleNamespace(id=BASE_ID + i, author=SimpleNamespace(bot=False, id=1, __str__=lambda self: 'a'),
+                                  guild=SimpleNamespace(id=48), channel=self, content='x',
+                                  created_at=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc), attachments=[])
+
+
+def test_failed_batch_is_retried_so_only_bad_rows_fail():
+    init_db()
+    assert archive.write_batch([_record(0)]) == (1, 0, 0)
+    # content is NOT NULL: that one row fails, the duplicate is skipped, the rest is written
+    records = [_record(0)] + [_record(i) for i in range(1, 6)] + [_record(6, content=None)] + [_record(i) for i in range(7, 10)]
+    assert archive.write_batch(records) == (8, 1, 1)
+
+
+def test_fetcher_stops_when_the_writer_dies(monkeypatch):
+    def broken_write(records):
+        raise RuntimeError("writer broke")
+    monkeypatch.setattr(archive, 'write_batch', broken_write)
+    # One batch of room: without the fix the fetcher waits on the full queue forever
+    result = asyncio.run(asyncio.wait_for(archive.archive_channel(FakeChannel(), batch_size=1, queue_batches=1), 5))
+    assert result == (0, 0, 0)
@@ -0,0 +1,76 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+from audit_log_cache import AuditLogCache
+
+OWNER_ID = 1
+ACTION = 'member_update'
+
+
+def _entry(moderator_id, created_at, entry_id=None, count=None):
+    return SimpleNamespace(id=entry_id or moderator_id, target=SimpleNamespace(id=OWNER_ID), user=SimpleNamespace(id=moderator_id),
+                           created_at=created_at, extra=SimpleNamespace(count=count) if count else None)
+
+
+class FakeGuild:
+    """Serves one audit log page per fetch, newest entry first."""
+
+    def __init__(self, pages):
+        self.id = 10
+        self.pages = list(pages)
+        self.fetches = 0
+
+    async def audit_logs(self, limit, action):
+        page = self.pages[min(self.fetches, len(self.pages) - 1)]
+        self.fetches += 1
+        for entry in page[:limit]:
+            yield entry
+
+
+def test_older_entry_by_another_moderator_is_not_blamed():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    earlier = _entry(moderator_id=2, created_at=now - datetime.timedelta(seconds=4))
+    current = _entry(moderator_id=3, created_at=now)
+    guild = FakeGuild([[earlier], [current, earlier]])
+    cache = AuditLogCache(ttl=5, skew=2)
+
+    async def scenario():
+        # The earlier action is attributed and cached
+        first = await cache.find_perpetrator(guild, ACTION, OWNER_ID, event_time=earlier.created_at)
+        # A new action within the TTL must not reuse that cached entry
+        second = await cache.find_perpetrator(guild, ACTION, OWNER_ID, event_time=now)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.id == 2
+    assert second.id == 3
+    assert guild.fetches == 2
+
+
+def test_no_matching_recent_entry_returns_none():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    guild = FakeGuild([[_entry(moderator_id=2, created_at=now - datetime.timedelta(seconds=30))]])
+    cache = AuditLogCache(ttl=5, skew=2)
+    assert asyncio.run(cache.find_perpetrator(guild, ACTION, OWNER_ID, event_time=now)) is None
+
+
+def test_aggregated_entry_is_blamed_again_when_its_count_goes_up():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    first_move = now - datetime.timedelta(seconds=60)
+    # Discord updates the entry in place: same id and created_at, higher count
+    before = _entry(moderator_id=2, created_at=first_move, entry_id=77, count=1)
+    after = _entry(moderator_id=2, created_at=first_move, entry_id=77, count=2)
+    guild = FakeGuild([[before], [after], [after]])
+    cache = AuditLogCache(ttl=5, skew=2)
+
+    async def scenario():
+        first = await cache.find_perpetrator(guild, 'member_move', OWNER_ID, event_time=first_move)
+        repeat = await cache.find_perpetrator(guild, 'member_move', OWNER_ID, event_time=now)
+        # Nothing new happened: the entry (and its count) is unchanged
+        again = await cache.find_perpetrator(guild, 'member_move', OWNER_ID, event_time=now)
+        return first, repeat, again
+
+    first, repeat, again = asyncio.run(scenario())
+    assert first.id == 2
+    assert repeat.id == 2
+    assert again is None
@@ -0,0 +1,29 @@
+import sys
+import pytest
+from export_archive import check_compression, iter_compressed
+
+
+def test_zstd_without_package_is_rejected_up_front(monkeypatch):
+    # A None entry makes `import zstandard` raise ImportError
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    with pytest.raises(ValueError):
+        check_compression('zstd')
+    check_compression('gzip')
+
+
+def test_zstd_export_without_package_returns_400(client, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    response = client.get('/export/messages?compression=zstd')
+    assert response.status_code == 400
+    assert 'zstandard' in response.get_json()['error']
+
+
+def test_gzip_export_streams(client):
+    response = client.get('/export/messages?compression=gzip')
+    assert response.status_code == 200
+    assert response.data[:2] == b'\x1f\x8b'
+
+
+def test_unknown_compression_is_rejected():
+    with pytest.raises(ValueError):
+        list(iter_compressed([b'x'], 'lz4'))
@@ -0,0 +1,75 @@
+import datetime
+from sqlalchemy import delete, insert, select
+from database import SessionLocal, Attachment, Message, init_db
+from export_archive import build_export_query, iter_compressed, iter_export_rows, iter_ndjson
+from import_archive import import_file
+
+MESSAGE_ID = 35_000_001
+
+
+def _export(table, path, **filters):
+    with SessionLocal() as db_session, open(path, 'wb') as f:
+        for chunk in iter_compressed(iter_ndjson(iter_export_rows(db_session, build_export_query(table, **filters))), 'none'):
+            f.write(chunk)
+
+
+def test_attachment_round_trip_keeps_size(tmp_path):
+    init_db()
+    with SessionLocal() as db_session:
+        db_session.execute(insert(Message), [{
+            'message_id': MESSAGE_ID, 'guild_id': 35, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+            'content': 'with a file', 'timestamp': datetime.datetime(2024, 1, 1),
+        }])
+        db_session.execute(insert(Attachment), [{
+            'message_id': MESSAGE_ID, 'attachment_id': MESSAGE_ID, 'url': 'https://cdn.example/a.png',
+            'filename': 'a.png', 'content_type': 'image/png', 'size': 123456,
+        }])
+        db_session.commit()
+
+    path = tmp_path / 'attachments.ndjson'
+    _export('attachments', path, guild_id=35)
+    with SessionLocal() as db_session:
+        db_session.execute(delete(Attachment).where(Attachment.attachment_id == MESSAGE_ID))
+        db_session.commit()
+
+    rows_read, rows_inserted, _ = import_file(str(path), 'attachments')
+    assert (rows_read, rows_inserted) == (1, 1)
+    with SessionLocal() as db_session:
+        size = db_session.scalar(select(Attachment.size).where(Attachment.attachment_id == MESSAGE_ID))
+    assert size == 123456
+
+
+REVISED_ID = 49_100_001
+DELETED_ID = 49_100_002
+
+
+def test_message_round_trip_keeps_edits_soft_deletes_and_revisions(tmp_path):
+    from revisions import apply_revisions, message_history
+    from database import MessageRevision
+    init_db()
+    with SessionLocal() as db_session:
+        db_session.execute(insert(Message), [{
+            'message_id': message_id, 'guild_id': 4910, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+            'content': 'first version', 'timestamp': datetime.datetime(2024, 1, 1),
+        } for message_id in (REVISED_ID, DELETED_ID)])
+        db_session.commit()
+        apply_revisions(db_session, [
+            ('edit', REVISED_ID, 'second version', datetime.datetime(2024, 1, 2)),
+            ('delete', DELETED_ID, None, datetime.datetime(2024, 1, 3)),
+        ])
+
+    for table in ('messages', 'message_revisions'):
+        _export(table, tmp_path / f'{table}.ndjson', guild_id=4910)
+    with SessionLocal() as db_session:
+        db_session.execute(delete(MessageRevision).where(MessageRevision.message_id.in_([REVISED_ID, DELETED_ID])))
+        db_session.execute(delete(Message).where(Message.message_id.in_([REVISED_ID, DELETED_ID])))
+        db_session.commit()
+
+    assert import_file(str(tmp_path / 'messages.ndjson'), 'messages')[:2] == (2, 2)
+    assert import_file(str(tmp_path / 'message_revisions.ndjson'), 'message_revisions')[:2] == (2, 2)
+    with SessionLocal() as db_session:
+        revised = db_session.scalars(select(Message).where(Message.message_id == REVISED_ID)).one()
+        deleted = db_session.scalars(select(Message).where(Message.message_id == DELETED_ID)).one()
+        assert revised.edited_at == datetime.datetime(2024, 1, 2)
+        assert deleted.deleted_at == datetime.datetime(2024, 1, 3)
+        assert [entry['content'] for entry in message_history(db_session, REVISED_ID)] == ['second version', 'first version']
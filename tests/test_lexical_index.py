@@ -0,0 +1,55 @@
+import datetime
+import json
+import os
+from sqlalchemy import insert
+import lexical_index
+from database import SessionLocal, Message, init_db
+from lexical_index import LexicalIndex
+
+BASE_ID = 37_000_000
+
+
+def _add_message(db_session, i):
+    db_session.execute(insert(Message), [{
+        'message_id': BASE_ID + i, 'guild_id': 37, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+        'content': f'segment word{i}', 'timestamp': datetime.datetime(2024, 1, 1),
+    }])
+    db_session.commit()
+
+
+def test_default_index_dir_does_not_depend_on_the_working_directory():
+    assert 'LEXICAL_INDEX_DIR' in os.environ or os.path.isabs(lexical_index.LEXICAL_INDEX_DIR)
+
+
+def test_merges_only_runs_of_similar_size_and_deletes_old_segments_later(tmp_path, monkeypatch):
+    init_db()
+    monkeypatch.setattr(lexical_index, 'LEXICAL_MAX_SEGMENTS', 3)
+    index = LexicalIndex(str(tmp_path / 'index'))
+    with SessionLocal() as db_session:
+        _add_message(db_session, 0)
+        index.update(db_session)
+        first = index._segments[0]
+        stale_manifest = index._read_manifest()
+        for i in range(1, 10):
+            _add_message(db_session, i)
+            index.update(db_session)
+        # 1+1+1 -> 3, three times, then 3+3+3 -> 9; the oldest segment is never rewritten
+        assert index._segments[0] is first
+        assert [segment.doc_count for segment in index._segments[1:]] == [9]
+        assert [row_id for row_id, _ in index.search('word7')]
+
+        # Merged-away segments outlive the manifest swap for other processes
+        retired = [name for name, _ in index._retired]
+        assert retired and all(os.path.isdir(os.path.join(index.path, name)) for name in retired)
+        monkeypatch.setattr(lexical_index, 'RETIRED_SEGMENT_GRACE', 0)
+        _add_message(db_session, 10)
+        index.update(db_session)
+        assert not any(os.path.isdir(os.path.join(index.path, name)) for name in retired)
+
+    # A reader that read the manifest before the deletion retries with the current one
+    stale_manifest['segments'].append(retired[0])
+    reader = LexicalIndex(index.path)
+    manifests = iter([stale_manifest, json.load(open(os.path.join(index.path, lexical_index.MANIFEST)))])
+    monkeypatch.setattr(reader, '_read_manifest', lambda: next(manifests))
+    reader.load()
+    assert reader.doc_count == index.doc_count
@@ -0,0 +1,62 @@
+import datetime
+from collections import Counter
+from sqlalchemy import event, insert
+from database import SessionLocal, Attachment, Message, engine, init_db, _random_row_by_id
+
+SMALL_GUILD = 39_001
+BIG_GUILD = 39_002
+BASE_ID = 39_000_000
+
+
+def _message(message_id, guild_id):
+    return {'message_id': message_id, 'guild_id': guild_id, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+            'content': f'message {message_id}', 'timestamp': datetime.datetime(2024, 1, 1)}
+
+
+def _seed():
+    # The small guild owns a narrow slice in the middle of a much larger id range
+    messages = [_message(BASE_ID + i, BIG_GUILD) for i in range(400)]
+    messages += [_message(BASE_ID + 1000 + i, SMALL_GUILD) for i in range(20)]
+    messages += [_message(BASE_ID + 2000 + i, BIG_GUILD) for i in range(400)]
+    with SessionLocal() as db_session:
+        db_session.execute(insert(Message), messages)
+        db_session.execute(insert(Attachment), [{
+            'message_id': message['message_id'], 'attachment_id': message['message_id'], 'url': 'u',
+            'filename': 'f.png', 'content_type': 'image/png',
+        } for message in messages])
+        db_session.commit()
+
+
+def _assert_roughly_uniform(picks, expected_rows):
+    counts = Counter(picks)
+    assert set(counts) <= expected_rows
+    # Uniform over 20 rows: ~25 picks each; a pivot bug puts almost all on one row
+    assert len(counts) >= 15
+    assert max(counts.values()) < 0.2 * len(picks)
+
+
+def test_guild_scoped_picks_are_spread_over_the_guild():
+    init_db()
+    _seed()
+    small_guild = {BASE_ID + 1000 + i for i in range(20)}
+    with SessionLocal() as db_session:
+        messages = [_random_row_by_id(db_session, Message, SMALL_GUILD).message_id for _ in range(500)]
+        attachments = [_random_row_by_id(db_session, Attachment, SMALL_GUILD).message_id for _ in range(500)]
+    _assert_roughly_uniform(messages, small_guild)
+    _assert_roughly_uniform(attachments, small_guild)
+
+
+def test_guild_id_range_is_computed_once_per_ttl():
+    init_db()
+    statements = []
+
+    def capture(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        with SessionLocal() as db_session:
+            for _ in range(20):
+                _random_row_by_id(db_session, Attachment, SMALL_GUILD)
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    assert sum('max(' in statement for statement in statements) <= 1
@@ -0,0 +1,35 @@
+import datetime
+from sqlalchemy import insert
+from database import SessionLocal, Message, init_db
+from lexical_index import LexicalIndex, search_messages
+from retrieval import retrieve_context
+
+BIG_GUILD = 41_001
+SMALL_GUILD = 41_002
+BASE_ID = 41_000_000
+
+
+def _message(message_id, guild_id, content):
+    return {'message_id': message_id, 'guild_id': guild_id, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+            'content': content, 'timestamp': datetime.datetime(2024, 1, 1)}
+
+
+def test_guild_filtered_search_oversamples_until_k_hits(tmp_path):
+    init_db()
+    # The big guild's hits all outrank the small guild's longer messages
+    messages = [_message(BASE_ID + i, BIG_GUILD, 'zeppelin') for i in range(300)]
+    messages += [_message(BASE_ID + 1000 + i, SMALL_GUILD, 'a zeppelin story with many other words in it') for i in range(3)]
+    with SessionLocal() as db_session:
+        db_session.execute(insert(Message), messages)
+        db_session.commit()
+        index = LexicalIndex(str(tmp_path / 'index'))
+        index.update(db_session)
+
+        found = search_messages(db_session, index, 'zeppelin', 3, guild_id=SMALL_GUILD)
+        assert sorted(m.message_id for m in found) == [BASE_ID + 1000 + i for i in range(3)]
+        assert len(search_messages(db_session, index, 'zeppelin', 3)) == 3
+
+        context, stats = retrieve_context(db_session, index, 'zeppelin', guild_id=SMALL_GUILD, candidates=3)
+    assert context is not None and 'zeppelin story' in context
+    assert stats['candidates'] == 3
+    assert 'estimated_saved_tokens' in stats
@@ -0,0 +1,56 @@
+import asyncio
+import datetime
+from sqlalchemy import insert, select
+from archive_sampler import ArchiveSampler, SampleConfig
+from database import SessionLocal, Message, StyleProfile, init_db
+from lexical_index import LexicalIndex, search_messages
+from revisions import RevisionWriter
+from style_profiles import update_style_profiles
+
+BASE_ID = 49_200_000
+AUTHOR_ID = 49_201
+
+
+def _samples(db_session):
+    profile = db_session.scalars(select(StyleProfile).where(StyleProfile.scope == 'author', StyleProfile.scope_id == AUTHOR_ID)).one()
+    return [sample['content'] for sample in profile.samples]
+
+
+def test_deleted_and_edited_text_leaves_search_and_prompt_samples(client, tmp_path):
+    init_db()
+    with SessionLocal() as db_session:
+        db_session.execute(insert(Message), [{
+            'message_id': BASE_ID + i, 'guild_id': 49, 'channel_id': 1, 'author_id': AUTHOR_ID, 'author_name': 'a',
+            'content': content, 'timestamp': datetime.datetime(2024, 1, 1 + i),
+        } for i, content in enumerate(['quokka sighting by the river', 'quokka photos from the trip'])])
+        db_session.commit()
+        deleted_id, edited_id = db_session.scalars(select(Message.id).where(Message.message_id >= BASE_ID).order_by(Message.id)).all()
+    index = LexicalIndex(str(tmp_path / 'index'))
+    sampler = ArchiveSampler(SampleConfig())
+
+    def refresh(db_session):
+        update_style_profiles(db_session)
+        index.update(db_session)
+        sampler.refresh(db_session)
+
+    with SessionLocal() as db_session:
+        refresh(db_session)
+        assert _samples(db_session) == ['quokka sighting by the river', 'quokka photos from the trip']
+        assert {m.id for m in search_messages(db_session, index, 'quokka', 5)} == {deleted_id, edited_id}
+    assert b'quokka sighting' in client.get('/messages?q=quokka').data
+
+    async def revise():
+        writer = RevisionWriter(on_applied=refresh)
+        writer.delete(BASE_ID, datetime.datetime(2024, 2, 1))
+        writer.edit(BASE_ID + 1, 'wombat photos from the trip', datetime.datetime(2024, 2, 1))
+        await writer.flush()
+        return writer.stats
+    assert asyncio.run(revise())['failed'] == 0
+
+    assert b'quokka sighting' not in client.get('/messages?q=quokka').data
+    with SessionLocal() as db_session:
+        assert _samples(db_session) == ['wombat photos from the trip']
+        assert search_messages(db_session, index, 'quokka', 5) == []
+        assert [m.id for m in search_messages(db_session, index, 'wombat', 5)] == [edited_id]
+    assert index.search('sighting') == [] and [row_id for row_id, _ in index.search('quokka wombat')] == [edited_id]
+    assert sorted(row_id for ids in sampler._buckets.values() for row_id in ids if row_id in (deleted_id, edited_id)) == [edited_id]
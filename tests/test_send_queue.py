@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+from send_queue import SendQueue
+
+
+class SlowChannel:
+    def __init__(self, delay=0.1):
+        self.id = 43
+        self.delay = delay
+        self.sent = []
+
+    async def send(self, content):
+        await asyncio.sleep(self.delay)
+        self.sent.append(content)
+        return SimpleNamespace(content=content)
+
+
+def test_droppable_reply_arriving_while_another_is_in_flight_is_sent():
+    channel = SlowChannel()
+    queue = SendQueue(rate=100, period=1, stale_after=10)
+
+    async def scenario():
+        first = asyncio.create_task(queue.send(channel, 'first', droppable=True))
+        await asyncio.sleep(0.05)  # 'first' is being sent now
+        second = asyncio.create_task(queue.send(channel, 'second', droppable=True))
+        return await asyncio.wait_for(asyncio.gather(first, second), timeout=2)
+
+    first, second = asyncio.run(scenario())
+    assert [m.content for m in first] == ['first']
+    assert [m.content for m in second] == ['second']
+    assert channel.sent == ['first', 'second']
+    assert queue.stats['coalesced'] == 0
+
+
+def test_waiting_droppable_reply_is_replaced_by_a_newer_one():
+    channel = SlowChannel()
+    queue = SendQueue(rate=100, period=1, stale_after=10)
+
+    async def scenario():
+        first = asyncio.create_task(queue.send(channel, 'first', droppable=True))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(queue.send(channel, 'second', droppable=True))
+        await asyncio.sleep(0)
+        third = asyncio.create_task(queue.send(channel, 'third', droppable=True))
+        return await asyncio.wait_for(asyncio.gather(first, second, third), timeout=2)
+
+    first, second, third = asyncio.run(scenario())
+    assert second is None
+    assert channel.sent == ['first', 'third']
+    assert queue.stats['coalesced'] == 1
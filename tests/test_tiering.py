@@ -0,0 +1,51 @@
+import datetime
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql
+from database import SessionLocal, ColdMessage, Message, MessageRevision, init_db
+from revisions import apply_revisions, message_history
+from tiering import move_to_cold
+
+BASE_ID = 50_000_000
+
+
+def test_edits_and_deletes_apply_to_moved_messages():
+    init_db()
+    with SessionLocal() as db_session:
+        db_session.execute(insert(Message), [{
+            'message_id': BASE_ID + i, 'guild_id': 50, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+            'content': f'old message {i}', 'timestamp': datetime.datetime(1990, 1, 1 + i),
+        } for i in range(3)])
+        # The newest row always stays hot
+        db_session.execute(insert(Message), [{
+            'message_id': BASE_ID + 3, 'guild_id': 50, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+            'content': 'new message', 'timestamp': datetime.datetime(2099, 1, 1),
+        }])
+        db_session.commit()
+        assert move_to_cold(db_session, datetime.datetime(1991, 1, 1)) >= 3
+
+        edits, deletes = apply_revisions(db_session, [
+            ('edit', BASE_ID, 'old message 0, edited', datetime.datetime(2024, 1, 1)),
+            ('delete', BASE_ID + 1, None, datetime.datetime(2024, 1, 2)),
+        ])
+        assert (edits, deletes) == (1, 1)
+        edited = db_session.scalars(select(ColdMessage).where(ColdMessage.message_id == BASE_ID)).one()
+        deleted = db_session.scalars(select(ColdMessage).where(ColdMessage.message_id == BASE_ID + 1)).one()
+        assert edited.content == 'old message 0, edited'
+        assert deleted.deleted_at == datetime.datetime(2024, 1, 2)
+        assert [entry['content'] for entry in message_history(db_session, BASE_ID)] == ['old message 0, edited', 'old message 0']
+        assert db_session.scalar(select(MessageRevision.revision).where(MessageRevision.message_id == BASE_ID)) == 1
+
+
+def test_apply_revisions_locks_the_rows_it_reads(monkeypatch):
+    # SQLite has no row locks, so check the statements as PostgreSQL would run them
+    statements = []
+    with SessionLocal() as db_session:
+        execute = db_session.execute
+
+        def capture(statement, *args, **kwargs):
+            statements.append(statement)
+            return execute(statement, *args, **kwargs)
+        monkeypatch.setattr(db_session, 'execute', capture)
+        apply_revisions(db_session, [('edit', BASE_ID + 99, 'not archived', datetime.datetime(2024, 1, 1))])
+    reads = [str(statement.compile(dialect=postgresql.dialect())) for statement in statements[:2]]
+    assert len(reads) == 2 and all(sql.endswith('FOR UPDATE') for sql in reads)
@@ -0,0 +1,33 @@
+import datetime
+from sqlalchemy import insert
+from database import SessionLocal, Message, init_db
+from revisions import apply_revisions
+
+MESSAGE_ID = 49_000_001
+
+
+def test_edit_changes_the_etag(client):
+    init_db()
+    with SessionLocal() as db_session:
+        db_session.execute(insert(Message), [{
+            'message_id': MESSAGE_ID, 'guild_id': 49, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+            'content': 'original etag text', 'timestamp': datetime.datetime(2099, 1, 1),
+        }])
+        db_session.commit()
+
+    first = client.get('/messages')
+    etag = first.headers['ETag']
+    assert b'original etag text' in first.data
+    assert client.get('/messages', headers={'If-None-Match': etag}).status_code == 304
+
+    with SessionLocal() as db_session:
+        assert apply_revisions(db_session, [('edit', MESSAGE_ID, 'edited etag text', datetime.datetime(2099, 1, 2))]) == (1, 0)
+
+    after_edit = client.get('/messages', headers={'If-None-Match': etag})
+    assert after_edit.status_code == 200
+    assert after_edit.headers['ETag'] != etag
+    assert b'edited etag text' in after_edit.data
+
+    with SessionLocal() as db_session:
+        assert apply_revisions(db_session, [('delete', MESSAGE_ID, None, datetime.datetime(2099, 1, 3))]) == (0, 1)
+    assert client.get('/messages', headers={'If-None-Match': after_edit.headers['ETag']}).status_code == 200
@@ -0,0 +1,31 @@
+import datetime
+import re
+from sqlalchemy import insert
+import web_app
+from database import SessionLocal, ColdMessage, Message, init_db
+
+BASE_ID = 50_100_000
+
+
+def _message(i, day):
+    return {'message_id': BASE_ID + i, 'guild_id': 50, 'channel_id': 1, 'author_id': 1, 'author_name': 'a',
+            'content': f'platypus note {i:03d}', 'timestamp': datetime.datetime(2001, 1, 1) - datetime.timedelta(days=day)}
+
+
+def test_message_pages_read_hot_rows_then_fill_from_cold(client, monkeypatch):
+    init_db()
+    with SessionLocal() as db_session:
+        db_session.execute(insert(Message), [_message(i, i) for i in range(40)])
+        db_session.execute(insert(ColdMessage), [dict(_message(i, i), id=BASE_ID + i) for i in range(40, 70)])
+        db_session.commit()
+
+    def notes(page):
+        return [int(n) for n in re.findall(rb'platypus note (\d+)', client.get(f'/messages?q=platypus+note&page={page}').data)]
+
+    assert notes(1) == list(range(50))
+    assert notes(2) == list(range(50, 70))
+    assert b'Total: 70 messages' in client.get('/messages?q=platypus+note').data
+
+    monkeypatch.setattr(web_app, 'WEB_SEARCH_COUNT_CAP', 20)
+    # A different query: the rendered page above is cached
+    assert b'Total: 20+ messages' in client.get('/messages?q=platypus').data
@@ -0,0 +1,111 @@
+# Cold-storage tiering: moves old messages out of the hot table into messages_cold
+import argparse
+import datetime
+import os
+import sys
+import time
+from sqlalchemy import delete, func, insert, select, text
+from database import engine, SessionLocal, Message, ColdMessage, init_db
+
+TIER_COLD_AFTER_DAYS = int(os.getenv('TIER_COLD_AFTER_DAYS', 365))
+TIER_BATCH_SIZE = int(os.getenv('TIER_BATCH_SIZE', 2000))
+
+
+def _move(db_session, source, target, condition, batch_size, below_id=None):
+    """Moves rows matching condition from one tier to the other in id order, one transaction per batch."""
+    names = [column.name for column in ColdMessage.__table__.columns]
+    source_table = source.__table__
+    last_id = 0
+    moved = 0
+    while True:
+        query = select(source.id).where(source.id > last_id, condition)
+        if below_id is not None:
+            query = query.where(source.id < below_id)
+        # Locked until the batch commits, so an edit can not land between the copy and the delete;
+        # rows being edited right now are left for the next run
+        ids = db_session.scalars(query.order_by(source.id).limit(batch_size).with_for_update(skip_locked=True)).all()
+        if not ids:
+            return moved
+        db_session.execute(insert(target).from_select(names, select(*(source_table.c[name] for name in names)).where(source.id.in_(ids))))
+        db_session.execute(delete(source).where(source.id.in_(ids)))
+        db_session.commit()
+        last_id = ids[-1]
+        moved += len(ids)
+
+
+def move_to_cold(db_session, before, batch_size=TIER_BATCH_SIZE):
+    """
+    Moves messages with a timestamp before `before` (naive UTC, like the
+    column) to the cold table, keeping their ids. Returns the number moved.
+    """
+    # The newest row stays hot: SQLite hands out max(id) + 1, so moving it could reuse a cold id
+    newest_id = db_session.scalar(select(func.max(Message.id)))
+    if newest_id is None:
+        return 0
+    return _move(db_session, Message, ColdMessage, Message.timestamp < before, batch_size, below_id=newest_id)
+
+
+def restore_to_hot(db_session, since=None, batch_size=TIER_BATCH_SIZE):
+    """Moves cold messages (only those from `since` on, if given) back to the hot table. Returns the number moved."""
+    condition = ColdMessage.timestamp >= since if since is not None else ColdMessage.id.is_not(None)
+    return _move(db_session, ColdMessage, Message, condition, batch_size)
+
+
+def tier_stats(db_session):
+    """Row counts per tier, plus table sizes (with indexes) in bytes on PostgreSQL."""
+    stats = {}
+    for label, model in (('hot', Message), ('cold', ColdMessage)):
+        count, oldest, newest = db_session.execute(
+            select(func.count(model.id), func.min(model.timestamp), func.max(model.timestamp))
+        ).one()
+        stats[label] = {"messages": count, "oldest": oldest, "newest": newest}
+        if db_session.bind.dialect.name == 'postgresql':
+            stats[label]["bytes"] = db_session.scalar(text("SELECT pg_total_relation_size(:table)"), {"table": model.__tablename__})
+    return stats
+
+
+def vacuum():
+    """Gives the space of moved rows back (VACUUM can not run inside a transaction)."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if engine.dialect.name == 'postgresql':
+            conn.execute(text(f"VACUUM (ANALYZE) {Message.__tablename__}, {ColdMessage.__tablename__}"))
+        else:
+            conn.execute(text("VACUUM"))
+
+
+def print_stats(stats):
+    for label, tier in stats.items():
+        size = f", {tier['bytes'] / 1024 / 1024:.1f} MB" if 'bytes' in tier else ""
+        span = f" ({tier['oldest']:%Y-%m-%d} to {tier['newest']:%Y-%m-%d})" if tier['messages'] else ""
+        print(f"{label.capitalize()}: {tier['messages']:,} messages{span}{size}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move old messages to the cold table (or back) and report tier sizes.")
+    parser.add_argument('--older-than-days', type=int, default=TIER_COLD_AFTER_DAYS,
+                        help="Messages older than this many days are moved to the cold table.")
+    parser.add_argument('--restore', action='store_true', help="Move cold messages newer than --older-than-days back instead (0 = all).")
+    parser.add_argument('--batch-size', type=int, default=TIER_BATCH_SIZE)
+    parser.add_argument('--vacuum', action='store_true', help="VACUUM afterwards to reclaim the space of moved rows.")
+    parser.add_argument('--stats', action='store_true', help="Only print the tier sizes.")
+    args = parser.parse_args(argv)
+
+    init_db()
+    with SessionLocal() as db_session:
+        if not args.stats:
+            cutoff = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=args.older_than_days)
+            start_time = time.perf_counter()
+            if args.restore:
+                moved = restore_to_hot(db_session, since=cutoff if args.older_than_days else None, batch_size=args.batch_size)
+                print(f"Restored {moved:,} messages to the hot table in {time.perf_counter() - start_time:.1f}s.")
+            else:
+                moved = move_to_cold(db_session, cutoff, batch_size=args.batch_size)
+                print(f"Moved {moved:,} messages from before {cutoff:%Y-%m-%d} to the cold table in {time.perf_counter() - start_time:.1f}s.")
+            if args.vacuum and moved:
+                vacuum()
+        print_stats(tier_stats(db_session))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,13 +3,23 @@ import os
 import subprocess
 import shlex
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, Response, jsonify
-from sqlalchemy import create_engine, desc
-from sqlalchemy.orm import sessionmaker
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash, Response, jsonify
+from sqlalchemy import desc, func, select
 from dotenv import dotenv_values, set_key, find_dotenv
-from database import Base, Message, Attachment, AppLog, DATABASE_URL, log_app_event 
+from database import Base, Message, ColdMessage, Attachment, AppLog, GuildSettings, MessageRevision, MESSAGE_TIERS, DATABASE_URL, SessionLocal, log_app_event, get_message_by_id
+from health import read_heartbeat
+from journal import BOT_SERVICE_NAME, JOURNAL_MAX_LINES, PRIORITIES, read_journal
+from shared_cache import SharedStore, SharedRefreshingCache
+from http_cache import conditional, compress_response
+from rollups import update_rollups, get_analytics
+from archive_sampler import SampleConfig
+from guild_settings import validate_guild_settings, save_guild_settings
+from archive_api import API_RESOURCES, fetch_api_page
+from export_archive import EXPORT_TABLES, EXPORT_COMPRESSIONS, build_export_query, check_compression, stream_export, export_file_extension
+from event_stream import EventBroadcaster
 from dotenv import load_dotenv
 import json
+from datetime import datetime
 
 load_dotenv()
 import psutil
@@ -17,17 +27,30 @@ import psutil
 
 ADMIN_USERNAME = os.getenv('WEB_ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.getenv('WEB_ADMIN_PASSWORD', 'password') 
+# Message searches stop counting matches per tier here ("10,000+ messages")
+WEB_SEARCH_COUNT_CAP = int(os.getenv('WEB_SEARCH_COUNT_CAP', 10000))
 
-app = Flask(__name__)
-app.secret_key = os.getenv('FLASK_SECRET_KEY', 'a_very_secret_key') 
+# Routes live on a blueprint; create_app() builds the application (gunicorn: see gunicorn.conf.py)
+web = Blueprint('web', __name__)
 
-# Database setup for Flask app
-if not DATABASE_URL:
-    print("Error: DATABASE_URL not found in .env file for Flask app.")
-    exit()
+# Status, counts and filter options are cached here once for all worker processes
+shared_store = SharedStore()
 
-engine = create_engine(DATABASE_URL)
-SessionLocalWeb = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def create_app():
+    """Builds the Flask app. Uses the engine from database.py (one connection pool per process)."""
+    if not DATABASE_URL:
+        raise SystemExit("Error: DATABASE_URL not found in .env file for Flask app.")
+    app = Flask(__name__)
+    app.secret_key = os.getenv('FLASK_SECRET_KEY', 'a_very_secret_key') 
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.getenv('STATIC_MAX_AGE', 86400))
+    # Resolved once here rather than per request (or per worker, when gunicorn preloads the app)
+    app.config['DOTENV_PATH'] = os.getenv('DOTENV_PATH') or find_dotenv()
+    if not app.config['DOTENV_PATH']:
+        print("Warning: .env file not found. Settings page might not work correctly.")
+    app.register_blueprint(web)
+    app.after_request(compress_response)
+    return app
 
 
 def check_auth(username, password):
@@ -51,51 +74,86 @@ def requires_auth(f):
     return decorated
 
 # --- Routes ---
-@app.route('/')
+
+def load_dashboard_stats():
+    """Table counts and system health for the dashboard (uncached; the CPU sample takes a second)."""
+    with SessionLocal() as db:
+        message_count = sum(db.query(model).count() for model in MESSAGE_TIERS)
+        attachment_count = db.query(Attachment).count()
+    return {
+        "message_count": message_count,
+        "attachment_count": attachment_count,
+        "cpu_percent": psutil.cpu_percent(interval=1),
+        "mem_percent": psutil.virtual_memory().percent,
+    }
+
+dashboard_cache = SharedRefreshingCache(shared_store, "dashboard-stats", load_dashboard_stats, ttl=float(os.getenv('DASHBOARD_CACHE_TTL', 30)))
+
+def load_cold_message_count():
+    """Rows in the cold tier (a full count, so cached: only tiering runs change it much)."""
+    with SessionLocal() as db:
+        return db.query(ColdMessage).count()
+
+cold_count_cache = SharedRefreshingCache(shared_store, "cold-message-count", load_cold_message_count, ttl=float(os.getenv('COLD_COUNT_CACHE_TTL', 300)))
+
+def archive_version():
+    """
+    Max message/attachment/app log/revision ids: changes on new rows, on deletes
+    (every one is logged) and on edits and soft deletes (each adds a revision).
+    """
+    with SessionLocal() as db:
+        return tuple(db.execute(select(*(select(func.max(model.id)).scalar_subquery()
+                                         for model in (Message, Attachment, AppLog, MessageRevision)))).one())
+
+@web.route('/')
 @requires_auth
+@conditional(lambda: (archive_version(), dashboard_cache.get()))
 def index():
-    db = SessionLocalWeb()
+    db = SessionLocal()
     try:
-        # Get some basic stats
-        message_count = db.query(Message).count()
-        attachment_count = db.query(Attachment).count()
-        # Get last 10 messages
-        recent_messages = db.query(Message).order_by(desc(Message.timestamp)).limit(10).all()
+        # Get last 10 messages (the cold tier only tops up a short hot table)
+        recent_messages = []
+        for model in MESSAGE_TIERS:
+            recent_messages += db.query(model).order_by(desc(model.timestamp)).limit(10 - len(recent_messages)).all()
+            if len(recent_messages) >= 10:
+                break
     finally:
         db.close()
 
-    # Gather system health metrics
-    cpu_percent = psutil.cpu_percent(interval=1)
-    mem = psutil.virtual_memory()
-    mem_percent = mem.percent
-
-    return render_template('index.html',
-                           message_count=message_count,
-                           attachment_count=attachment_count,
-                           recent_messages=recent_messages,
-                           cpu_percent=cpu_percent,
-                           mem_percent=mem_percent)
+    return render_template('index.html', recent_messages=recent_messages, **dashboard_cache.get())
 
-@app.route('/messages')
+@web.route('/messages')
 @requires_auth
+@conditional(archive_version)
 def view_messages():
-    db = SessionLocalWeb()
+    db = SessionLocal()
     try:
         page = request.args.get('page', 1, type=int)
         per_page = 50 # Messages per page
         search_query = request.args.get('q', '')
         offset = (page - 1) * per_page
 
-        query = db.query(Message)
-        if search_query:
-            # Basic search in content and author name
-            search_term = f"%{search_query}%"
-            query = query.filter(Message.content.ilike(search_term) | Message.author_name.ilike(search_term))
-
-        # Get total count for pagination
-        total = query.count()
-        # Apply ordering, offset, and limit
-        messages = query.order_by(desc(Message.timestamp)).offset(offset).limit(per_page).all()
+        # Hot rows first, then cold ones (tiering moves the oldest messages), so
+        # recent pages never touch the cold table; neither does a count while browsing
+        messages = []
+        total = 0
+        total_capped = False
+        for model in MESSAGE_TIERS:
+            query = select(model)
+            if search_query:
+                # Basic search in content and author name, skipping soft deleted messages
+                search_term = f"%{search_query}%"
+                query = query.where(model.deleted_at.is_(None), model.content.ilike(search_term) | model.author_name.ilike(search_term))
+                count = db.scalar(select(func.count()).select_from(query.with_only_columns(model.id).limit(WEB_SEARCH_COUNT_CAP).subquery()))
+                total_capped = total_capped or count >= WEB_SEARCH_COUNT_CAP
+            else:
+                count = cold_count_cache.get() if model is ColdMessage else db.query(model).count()
+            if len(messages) < per_page and offset < total + count:
+                messages += db.scalars(query.order_by(desc(model.timestamp))
+                                       .offset(max(0, offset - total)).limit(per_page - len(messages))).all()
+            total += count
+        if total_capped:
+            total = min(total, WEB_SEARCH_COUNT_CAP)
 
     finally:
         db.close()
@@ -109,12 +167,14 @@ def view_messages():
                            per_page=per_page,
                            total=total,
                            total_pages=total_pages,
+                           total_capped=total_capped,
                            search_query=search_query)
 
-@app.route('/attachments')
+@web.route('/attachments')
 @requires_auth
+@conditional(archive_version)
 def view_attachments():
-    db = SessionLocalWeb()
+    db = SessionLocal()
     try:
         page = request.args.get('page', 1, type=int)
         per_page = 50 # Attachments per page
@@ -143,10 +203,11 @@ def view_attachments():
                            per_page=per_page,
                            total=total,
                            total_pages=total_pages,
+                           total_capped=total_capped,
                            search_query=search_query)
 
 # Add template context processor to inject variables into all templates
-@app.context_processor
+@web.app_context_processor
 def inject_template_globals():
     from datetime import datetime
     return {
@@ -155,9 +216,9 @@ def inject_template_globals():
 
 # --- Bot Service Control Routes ---
 
-    def run_systemctl_command(action):
-        """Helper function to run systemctl commands for the bot service."""
-        command = f"sudo systemctl {action} discord-bot.service"
+def run_systemctl_command(action):
+    """Helper function to run systemctl commands for the bot service."""
+    command = f"sudo systemctl {action} {BOT_SERVICE_NAME}"
     try:
         # Use shlex.split for better security if action contained spaces, though unlikely here
         result = subprocess.run(shlex.split(command), capture_output=True, text=True, check=True, timeout=15)
@@ -175,19 +236,33 @@ def inject_template_globals():
     except Exception as e:
         return False, f"An unexpected error occurred: {e}"
 
-@app.route('/bot/control/<action>', methods=['POST'])
+def read_unit_state():
+    """Returns the service's ActiveState and UnitFileState from a single `systemctl show` call."""
+    command = ["systemctl", "show", BOT_SERVICE_NAME, "--property=ActiveState,UnitFileState"]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=5)
+        props = dict(line.split("=", 1) for line in result.stdout.splitlines() if "=" in line)
+        return {"active_state": props.get("ActiveState") or "unknown", "unit_file_state": props.get("UnitFileState") or "unknown"}
+    except Exception as e:
+        print(f"Error getting bot unit state: {e}")
+        return {"active_state": "error", "unit_file_state": "error"}
+
+@web.route('/bot/control/<action>', methods=['POST'])
 @requires_auth
 def bot_control(action):
     allowed_actions = ['start', 'stop', 'enable', 'disable', 'restart']
     if action not in allowed_actions:
         flash('Invalid action requested.', 'danger')
-        return redirect(url_for('index')) # Or a dedicated control page
+        return redirect(url_for('web.index')) # Or a dedicated control page
 
     success, message_output = run_systemctl_command(action)
     flash(message_output, 'success' if success else 'danger')
+    # Drop the cached status and push the new state to connected dashboards right away
+    bot_status_cache.invalidate()
+    event_broadcaster.poll_now()
 
     # Log the action
-    with SessionLocalWeb() as db:
+    with SessionLocal() as db:
         log_app_event(
             db,
             level="INFO" if success else "ERROR",
@@ -197,129 +272,229 @@ def bot_control(action):
         )
 
     # Redirect back to index or a dedicated control page
-    return redirect(url_for('index'))
-
-@app.route('/bot/status')
+    return redirect(url_for('web.index'))
+
+def collect_bot_status():
+    """Collects the bot status, boot setting and health figures as a dict (uncached)."""
+    # Liveness and latency come from the bot itself (see health.py); systemd adds
+    # the states the bot cannot report itself and the boot setting
+    heartbeat = read_heartbeat()
+    unit = read_unit_state()
+    if heartbeat is not None and heartbeat['alive']:
+        status_text = "active"
+    elif unit["active_state"] in ("activating", "deactivating", "failed"):
+        status_text = unit["active_state"]
+    elif heartbeat is not None and heartbeat.get('state') == 'running':
+        # Process stopped writing heartbeats without shutting down cleanly
+        status_text = "unresponsive"
+    else:
+        status_text = "inactive"
+
+    if unit["unit_file_state"] in ("enabled", "enabled-runtime", "static", "alias", "indirect", "generated"):
+        is_enabled_text = unit["unit_file_state"]
+    elif unit["unit_file_state"] in ("error", "unknown"):
+        is_enabled_text = unit["unit_file_state"]
+    else:
+        is_enabled_text = "disabled"
+
+    health = None
+    if heartbeat is not None:
+        health = {key: heartbeat.get(key) for key in ('age', 'ready', 'guilds', 'latency_ms', 'loop_lag_ms', 'in_flight', 'reconnects', 'started_at', 'history')}
+
+    return {"status": status_text, "enabled": is_enabled_text, "health": health}
+
+# Every request and the SSE poller read this; one background thread refreshes it
+bot_status_cache = SharedRefreshingCache(shared_store, "bot-status", collect_bot_status, ttl=float(os.getenv('BOT_STATUS_CACHE_TTL', 2)))
+
+def get_bot_status():
+    """Returns the cached bot status (see collect_bot_status)."""
+    return bot_status_cache.get()
+
+@web.route('/bot/status')
 @requires_auth
+@conditional(get_bot_status)
 def bot_status():
-    """Returns the status of the bot service as JSON."""
-    # Use a slightly different command to get brief status
-    command = "systemctl is-active discord-bot.service"
-    status_text = "unknown"
-    is_enabled_text = "unknown"
-    try:
-        # Check active state
-        result_active = subprocess.run(shlex.split(command), capture_output=True, text=True, timeout=5)
-        # is-active returns exit code 0 if active, non-zero otherwise. Output is the state name.
-        if result_active.returncode == 0:
-             status_text = result_active.stdout.strip() # e.g., "active"
-        else:
-             # Could be inactive, failed, activating, etc. Get more detail.
-             status_command = "systemctl status discord-bot.service --no-pager -l"
-             result_status = subprocess.run(shlex.split(status_command), capture_output=True, text=True, timeout=10)
-             # Try to parse the status output for a better description
-             status_text = "inactive" # Default if parsing fails
-             for line in result_status.stdout.splitlines():
-                 if "Active:" in line:
-                     status_text = line.split("Active:")[1].strip().split(" ")[0] # e.g., "inactive", "failed"
-                     break
-
-        command_enabled = "systemctl is-enabled discord-bot.service"
-        result_enabled = subprocess.run(shlex.split(command_enabled), capture_output=True, text=True, timeout=5)
-        if result_enabled.returncode == 0:
-            is_enabled_text = result_enabled.stdout.strip() # "enabled"
-        else:
-            is_enabled_text = "disabled" 
+    """Returns the status of the bot as JSON, based on the heartbeat file the bot writes."""
+    return jsonify(get_bot_status())
 
-    except Exception as e:
-        print(f"Error getting bot status: {e}")
-        status_text = "error"
-        is_enabled_text = "error"
 
-    return jsonify(status=status_text, enabled=is_enabled_text)
+# --- Logs Route ---
 
+JOURNAL_PAGE_LINES = int(os.getenv('JOURNAL_PAGE_LINES', 100))
 
-# --- Logs Route ---
+def load_journal_tail():
+    """Last JOURNAL_PAGE_LINES bot service log entries (oldest first) and the cursor to poll from. Raises the subprocess errors."""
+    entries, cursor = read_journal(lines=JOURNAL_PAGE_LINES)
+    return {"entries": entries, "cursor": cursor}
+
+# The unfiltered first page is shared across workers and refreshed every few seconds
+journal_cache = SharedRefreshingCache(shared_store, "journal-tail", load_journal_tail, ttl=float(os.getenv('JOURNAL_CACHE_TTL', 3)))
+
+def journal_error_message(e):
+    """User-facing description of a journal read failure."""
+    if isinstance(e, FileNotFoundError):
+        return "Error: 'journalctl' command (or JOURNAL_FILE) not found."
+    if isinstance(e, subprocess.CalledProcessError):
+        message = f"Error fetching logs: {e.stderr.strip()}"
+        if "Failed to read journal" in e.stderr or "Permission denied" in e.stderr:
+            message += "\n\nHint: Ensure the 'eren' user is part of the 'systemd-journal' group (run 'sudo usermod -a -G systemd-journal eren' and log out/in) or has specific sudoers permission for journalctl."
+        return message
+    if isinstance(e, subprocess.TimeoutExpired):
+        return "Error: Command to fetch logs timed out."
+    return f"An unexpected error occurred fetching logs: {e}"
 
-@app.route('/bot/logs')
+@web.route('/bot/logs')
 @requires_auth
 def bot_logs():
-    """Displays recent logs for the bot service."""
-    log_lines = []
-    error_message = None
-    command = "journalctl -u discord-bot.service --no-pager -n 100 --output short-iso --quiet"
+    """Displays the bot service logs; entries are loaded (and filtered) through bot_logs_json."""
     try:
-        result = subprocess.run(shlex.split(command), capture_output=True, text=True, check=True, timeout=15)
-        log_lines = result.stdout.strip().splitlines()
-        log_lines.reverse() 
-    except FileNotFoundError:
-        error_message = "Error: 'sudo' or 'journalctl' command not found."
-    except subprocess.CalledProcessError as e:
-        error_message = f"Error fetching logs: {e.stderr.strip()}"
-        if "Failed to read journal" in e.stderr or "Permission denied" in e.stderr:
-             error_message += "\n\nHint: Ensure the 'eren' user is part of the 'systemd-journal' group (run 'sudo usermod -a -G systemd-journal eren' and log out/in) or has specific sudoers permission for journalctl."
-    except subprocess.TimeoutExpired:
-        error_message = "Error: Command to fetch logs timed out."
+        has_logs = bool(journal_cache.get()["entries"])
     except Exception as e:
-        error_message = f"An unexpected error occurred fetching logs: {e}"
-
-    if error_message:
-        flash(error_message, 'danger')
-
-    return render_template('logs.html', logs=log_lines)
+        has_logs = False
+        flash(journal_error_message(e), 'danger')
+    return render_template('logs.html', has_logs=has_logs, page_lines=JOURNAL_PAGE_LINES, priorities=PRIORITIES)
 
-@app.route('/bot/logs/json')
+@web.route('/bot/logs/json')
 @requires_auth
 def bot_logs_json():
-    """Returns recent logs for the bot service as JSON with timestamps."""
-    log_entries = []
-    error_message = None
-    command = "journalctl -u discord-bot.service --no-pager -n 100 --output short-iso --quiet"
+    """
+    Bot service log entries as JSON, newest first. Filters: q (regex), priority
+    (0-7 or name) and since, all run by journalctl. `after=<cursor>` returns
+    only entries newer than the cursor (for polling), `before=<cursor>` the page
+    before it. The response carries `cursor` (poll from here next) and `before`
+    (older page, or null once the start is reached); each client keeps its own.
+    """
+    after = request.args.get('after') or None
+    before = request.args.get('before') or None
+    filters = {
+        "grep": request.args.get('q', '').strip() or None,
+        "priority": request.args.get('priority', '').strip() or None,
+        "since": request.args.get('since', '').strip() or None,
+    }
     try:
-        result = subprocess.run(shlex.split(command), capture_output=True, text=True, check=True, timeout=15)
-        lines = result.stdout.strip().splitlines()
-        lines.reverse() 
-        for line in lines:
-            if " " in line:
-                timestamp, message = line.split(" ", 1)
-            else:
-                timestamp, message = "", line
-            log_entries.append({"timestamp": timestamp, "message": message})
+        lines = int(request.args.get('limit') or JOURNAL_PAGE_LINES)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer.", "logs": []}), 400
+    if after and before:
+        return jsonify({"error": "Use either after or before, not both.", "logs": []}), 400
+    try:
+        if not (after or before or any(filters.values())) and lines == JOURNAL_PAGE_LINES:
+            tail = journal_cache.get()
+            entries, cursor = tail["entries"], tail["cursor"]
+        else:
+            entries, cursor = read_journal(after_cursor=after, before_cursor=before, lines=lines, **filters)
+    except ValueError as e:
+        return jsonify({"error": str(e), "logs": []}), 400
     except Exception as e:
-        error_message = str(e)
-        return jsonify({"error": error_message, "logs": []}), 500
-
-    return jsonify({"logs": log_entries})
+        return jsonify({"error": journal_error_message(e), "logs": []}), 500
+
+    if after:
+        older = None
+    else:
+        # A short page means the start of the log (for these filters) was reached
+        older = entries[0]["cursor"] if len(entries) >= min(lines, JOURNAL_MAX_LINES) else None
+    return jsonify({"logs": entries[::-1], "cursor": cursor or after, "before": older})
+
+
+# --- Live Updates (Server-Sent Events) ---
+
+# One poller thread per process feeds every open dashboard tab
+event_broadcaster = EventBroadcaster(interval=float(os.getenv('EVENT_POLL_INTERVAL', 5)), replay=('status',))
+
+# Poller state: last status sent, journald cursor and app_logs id watermark
+_event_state = {"status": None, "journal_cursor": None, "app_log_id": None}
+
+def poll_status_events():
+    """Emits a 'status' event whenever the bot status or health figures change."""
+    status = get_bot_status()
+    if status != _event_state["status"]:
+        _event_state["status"] = status
+        yield 'status', status
+
+def poll_journal_events():
+    """Emits new journal lines since the last poll, following the journald cursor."""
+    if _event_state["journal_cursor"] is None:
+        # Start at the end of the journal; pages load their initial lines themselves
+        _, _event_state["journal_cursor"] = read_journal(lines=1)
+        return
+    entries, _event_state["journal_cursor"] = read_journal(after_cursor=_event_state["journal_cursor"])
+    if entries:
+        yield 'journal', {"logs": entries}
+
+def poll_app_log_events():
+    """Emits app_logs rows inserted since the last poll (by id watermark)."""
+    with SessionLocal() as db:
+        if _event_state["app_log_id"] is None:
+            _event_state["app_log_id"] = db.query(func.max(AppLog.id)).scalar() or 0
+            return
+        new_logs = db.query(AppLog).filter(AppLog.id > _event_state["app_log_id"]).order_by(AppLog.id).limit(200).all()
+        if not new_logs:
+            return
+        _event_state["app_log_id"] = new_logs[-1].id
+        rows = [{
+            "id": log.id,
+            "timestamp": log.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            "level": log.level,
+            "event_type": log.event_type,
+            "message": log.message,
+            "extra": log.extra,
+        } for log in new_logs]
+    yield 'app_logs', {"logs": rows}
+
+event_broadcaster.add_poller(poll_status_events)
+event_broadcaster.add_poller(poll_journal_events)
+event_broadcaster.add_poller(poll_app_log_events)
+
+@web.route('/events')
+@requires_auth
+def events():
+    """Server-Sent Events stream of status changes, new journal lines and new app logs."""
+    return Response(event_broadcaster.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 # --- Settings Route ---
 
-# Helper to find the .env file path
-dotenv_path = find_dotenv()
-if not dotenv_path:
-    print("Warning: .env file not found. Settings page might not work correctly.")
+# Archive reply weighting settings (see archive_sampler.SampleConfig); form fields use the lowercase names
+ARCHIVE_SAMPLE_KEYS = (
+    'ARCHIVE_SAMPLE_CHANNEL_WEIGHTS',
+    'ARCHIVE_SAMPLE_AUTHOR_WEIGHTS',
+    'ARCHIVE_SAMPLE_LENGTH_WEIGHTS',
+    'ARCHIVE_SAMPLE_RECENCY_HALF_LIFE',
+    'ARCHIVE_SAMPLE_MIN_LENGTH',
+)
+
+def archive_sample_values(current_values):
+    return {key.lower(): current_values.get(key, '') for key in ARCHIVE_SAMPLE_KEYS}
 
 
-@app.route('/settings', methods=['GET', 'POST'])
+@web.route('/settings', methods=['GET', 'POST'])
 @requires_auth
 def settings():
+    dotenv_path = current_app.config['DOTENV_PATH']
     if request.method == 'POST':
         try:
             prob_archive = float(request.form['prob_archive_reply'])
             prob_ai = float(request.form['prob_ai_reply'])
+            prob_relevant = float(request.form.get('prob_relevant_reply') or 0)
             ai_mention_cooldown = int(request.form['ai_mention_cooldown'])
             openrouter_chat_model = request.form['openrouter_chat_model'].strip()
             openrouter_mention_model = request.form['openrouter_mention_model'].strip() # New model
             mention_system_prompt = request.form.get('mention_system_prompt', '').strip()
             enable_voice_protection = 'enable_voice_protection' in request.form and request.form['enable_voice_protection'] == 'true'
+            # Archive reply weighting, validated by parsing it like the bot does
+            archive_sample = {key: request.form.get(key.lower(), '').strip() for key in ARCHIVE_SAMPLE_KEYS}
+            SampleConfig.from_values(archive_sample)
 
             # Validation
             if not (0.0 <= prob_archive <= 1.0):
                 flash('Archive Reply Probability must be between 0.0 and 1.0.', 'danger')
             elif not (0.0 <= prob_ai <= 1.0):
                 flash('AI Reply Probability must be between 0.0 and 1.0.', 'danger')
-            elif prob_archive + prob_ai > 1.0:
-                 flash('The sum of Archive and AI probabilities cannot exceed 1.0.', 'danger')
+            elif not (0.0 <= prob_relevant <= 1.0):
+                flash('Relevant Archive Reply Probability must be between 0.0 and 1.0.', 'danger')
+            elif prob_archive + prob_relevant + prob_ai > 1.0:
+                 flash('The sum of Archive, Relevant Archive and AI probabilities cannot exceed 1.0.', 'danger')
             elif ai_mention_cooldown < 0:
                 flash('AI Mention Cooldown must be 0 or greater.', 'danger')
             elif not openrouter_chat_model:
@@ -333,14 +508,17 @@ def settings():
                 else:
                     set_key(dotenv_path, "PROB_ARCHIVE_REPLY", str(prob_archive))
                     set_key(dotenv_path, "PROB_AI_REPLY", str(prob_ai))
+                    set_key(dotenv_path, "PROB_RELEVANT_REPLY", str(prob_relevant))
                     set_key(dotenv_path, "AI_MENTION_COOLDOWN", str(ai_mention_cooldown))
                     set_key(dotenv_path, "OPENROUTER_CHAT_MODEL", openrouter_chat_model)
                     set_key(dotenv_path, "OPENROUTER_MENTION_MODEL", openrouter_mention_model) # New save
                     set_key(dotenv_path, "MENTION_SYSTEM_PROMPT", mention_system_prompt) # New save
                     set_key(dotenv_path, "ENABLE_VOICE_PROTECTION", "true" if enable_voice_protection else "false")
+                    for key, value in archive_sample.items():
+                        set_key(dotenv_path, key, value)
 
                     # Log settings change
-                    with SessionLocalWeb() as db:
+                    with SessionLocal() as db:
                         log_app_event(
                             db,
                             level="INFO",
@@ -349,23 +527,27 @@ def settings():
                             extra={
                                 "prob_archive": prob_archive,
                                 "prob_ai": prob_ai,
+                                "prob_relevant": prob_relevant,
                                 "ai_mention_cooldown": ai_mention_cooldown,
                                 "openrouter_chat_model": openrouter_chat_model,
                                 "openrouter_mention_model": openrouter_mention_model, 
                                 "mention_system_prompt": mention_system_prompt, 
-                                "enable_voice_protection": enable_voice_protection
+                                "enable_voice_protection": enable_voice_protection,
+                                "archive_sample": archive_sample
                             }
                         )
                     flash('Settings saved successfully. Restarting bot service to apply changes...', 'info')
 
                     # Attempt to restart the bot service
                     success, message_output = run_systemctl_command('restart')
+                    bot_status_cache.invalidate()
+                    event_broadcaster.poll_now()
                     if success:
                         flash('Bot service restarted successfully.', 'success')
                     else:
                         flash(f'Failed to restart bot service automatically: {message_output}', 'danger')
                     # Log restart attempt
-                    with SessionLocalWeb() as db:
+                    with SessionLocal() as db:
                          log_app_event(
                             db,
                             level="INFO" if success else "ERROR",
@@ -374,25 +556,29 @@ def settings():
                             extra={"action": "restart", "success": success, "output": message_output}
                         )
 
-                return redirect(url_for('settings')) # Redirect to refresh page
+                return redirect(url_for('web.settings')) # Redirect to refresh page
 
-        except ValueError:
-            flash('Invalid input. Probabilities must be numbers.', 'danger')
+        except ValueError as e:
+            flash(f'Invalid input: {e}', 'danger')
         except Exception as e:
             flash(f'An error occurred saving settings: {e}', 'danger')
         current_values = dotenv_values(dotenv_path) if dotenv_path else {}
         prob_archive_current = current_values.get('PROB_ARCHIVE_REPLY', '0.4')
         prob_ai_current = current_values.get('PROB_AI_REPLY', '0.4')
+        prob_relevant_current = current_values.get('PROB_RELEVANT_REPLY', '0')
         mention_system_prompt_current = current_values.get('MENTION_SYSTEM_PROMPT', 'You are a helpful assistant responding to a user mention.')
         return render_template('settings.html',
                                prob_archive=prob_archive_current,
                                prob_ai=prob_ai_current,
-                               mention_system_prompt=mention_system_prompt_current)
+                               prob_relevant=prob_relevant_current,
+                               mention_system_prompt=mention_system_prompt_current,
+                               archive_sample=archive_sample_values(current_values))
 
     # GET request: Default values if no value exist
     current_values = dotenv_values(dotenv_path) if dotenv_path else {}
     prob_archive_current = current_values.get('PROB_ARCHIVE_REPLY', '0.4') 
     prob_ai_current = current_values.get('PROB_AI_REPLY', '0.4')
+    prob_relevant_current = current_values.get('PROB_RELEVANT_REPLY', '0')
     ai_mention_cooldown_current = current_values.get('AI_MENTION_COOLDOWN', '60')
     openrouter_chat_model_current = current_values.get('OPENROUTER_CHAT_MODEL', 'microsoft/mai-ds-r1:free')
     openrouter_mention_model_current = current_values.get('OPENROUTER_MENTION_MODEL', 'google/gemini-flash-1.5') # Default is gemini
@@ -401,25 +587,81 @@ def settings():
     return render_template('settings.html',
                            prob_archive=prob_archive_current,
                            prob_ai=prob_ai_current,
+                           prob_relevant=prob_relevant_current,
                            ai_mention_cooldown=ai_mention_cooldown_current,
                            openrouter_chat_model=openrouter_chat_model_current,
                            openrouter_mention_model=openrouter_mention_model_current,
                            mention_system_prompt=mention_system_prompt_current,
-                           enable_voice_protection=enable_voice_protection_current)
+                           enable_voice_protection=enable_voice_protection_current,
+                           archive_sample=archive_sample_values(current_values))
+
+
+# --- Per-guild settings (read by the bot every GUILD_SETTINGS_REFRESH seconds, no restart needed) ---
+
+def _optional(value, cast):
+    value = (value or '').strip()
+    return cast(value) if value else None
+
+@web.route('/guilds', methods=['GET', 'POST'])
+@requires_auth
+def guild_settings_view():
+    dotenv_path = current_app.config['DOTENV_PATH']
+    current_values = dotenv_values(dotenv_path) if dotenv_path else {}
+    defaults = {
+        'prob_archive_reply': float(current_values.get('PROB_ARCHIVE_REPLY', 0.4)),
+        'prob_relevant_reply': float(current_values.get('PROB_RELEVANT_REPLY', 0)),
+        'prob_ai_reply': float(current_values.get('PROB_AI_REPLY', 0.4)),
+        'archive_guild_id': None,
+    }
+    if request.method == 'POST':
+        try:
+            guild_id = int(request.form['guild_id'])
+            values = {
+                'prob_archive_reply': _optional(request.form.get('prob_archive_reply'), float),
+                'prob_relevant_reply': _optional(request.form.get('prob_relevant_reply'), float),
+                'prob_ai_reply': _optional(request.form.get('prob_ai_reply'), float),
+                'archive_guild_id': _optional(request.form.get('archive_guild_id'), int),
+            }
+            validate_guild_settings(values, defaults)
+            with SessionLocal() as db:
+                save_guild_settings(db, guild_id, request.form.get('guild_name', '').strip() or None, **values)
+                log_app_event(db, "INFO", "guild_settings_changed", f"Settings for guild {guild_id} updated via web UI.",
+                              extra={"guild_id": guild_id, **values})
+                db.commit()
+            flash(f'Settings for guild {guild_id} saved. The bot picks them up within a minute.', 'success')
+        except (KeyError, ValueError) as e:
+            flash(f'Invalid input: {e}', 'danger')
+        return redirect(url_for('web.guild_settings_view'))
+
+    with SessionLocal() as db:
+        rows = db.query(GuildSettings).order_by(GuildSettings.guild_id).all()
+    return render_template('guilds.html', rows=rows, defaults=defaults)
+
+@web.route('/guilds/<int:guild_id>/delete', methods=['POST'])
+@requires_auth
+def delete_guild_settings(guild_id):
+    with SessionLocal() as db:
+        deleted = db.query(GuildSettings).filter(GuildSettings.guild_id == guild_id).delete()
+        if deleted:
+            log_app_event(db, "INFO", "guild_settings_deleted", f"Settings for guild {guild_id} removed via web UI.", extra={"guild_id": guild_id})
+        db.commit()
+    flash(f'Guild {guild_id} now uses the default settings.' if deleted else 'Guild settings not found.', 'success' if deleted else 'error')
+    return redirect(url_for('web.guild_settings_view'))
 
 
-@app.route('/delete_message/<int:message_db_id>', methods=['POST'])
+@web.route('/delete_message/<int:message_db_id>', methods=['POST'])
 @requires_auth
 def delete_message_web(message_db_id):
-    db = SessionLocalWeb()
+    db = SessionLocal()
     try:
-        message_to_delete = db.query(Message).filter(Message.id == message_db_id).first()
+        message_to_delete = get_message_by_id(db, message_db_id)
         if message_to_delete:
             # We need the original message_id (discord's ID) to delete attachments correctly
             original_message_id = message_to_delete.message_id
 
             # Delete associated attachments
             db.query(Attachment).filter(Attachment.message_id == original_message_id).delete()
+            db.query(MessageRevision).filter(MessageRevision.message_id == original_message_id).delete()
             # Delete the message itself
             db.delete(message_to_delete)
             log_app_event(db, "INFO", "message_deleted_web", f"Message deleted via web UI.", extra={"message_db_id": message_db_id, "original_message_id": original_message_id})
@@ -434,12 +676,12 @@ def delete_message_web(message_db_id):
         flash(f'Error deleting message: {e}', 'error')
     finally:
         db.close()
-    return redirect(url_for('view_messages'))
+    return redirect(url_for('web.view_messages'))
 
-@app.route('/delete_attachment/<int:attachment_id>', methods=['POST'])
+@web.route('/delete_attachment/<int:attachment_id>', methods=['POST'])
 @requires_auth
 def delete_attachment_web(attachment_id):
-    db = SessionLocalWeb()
+    db = SessionLocal()
     try:
         attachment_to_delete = db.query(Attachment).filter(Attachment.id == attachment_id).first()
         if attachment_to_delete:
@@ -457,14 +699,91 @@ def delete_attachment_web(attachment_id):
         flash(f'Error deleting attachment: {e}', 'error')
     finally:
         db.close()
-    return redirect(url_for('view_attachments'))
+    return redirect(url_for('web.view_attachments'))
+
+# --- Analytics Route ---
+
+def load_analytics():
+    """Catches the rollups up with the archive, then reads the dashboard analytics from them."""
+    with SessionLocal() as db:
+        update_rollups(db)
+        return get_analytics(db)
+
+analytics_cache = SharedRefreshingCache(shared_store, "analytics", load_analytics, ttl=float(os.getenv('ANALYTICS_CACHE_TTL', 60)))
+
+@web.route('/analytics/json')
+@requires_auth
+@conditional(lambda: analytics_cache.get())
+def analytics_json():
+    """Returns messages per day, top channels/authors and the attachment type mix from the rollup tables."""
+    return jsonify(analytics_cache.get())
+
+# --- Export Route ---
+
+@web.route('/export/<table>')
+@requires_auth
+def export_table(table):
+    """Streams a table as compressed NDJSON. Optional filters: guild_id, channel_id, since, until."""
+    if table not in EXPORT_TABLES:
+        return jsonify({"error": f"Unknown table '{table}'."}), 404
+    compression = request.args.get('compression', 'gzip')
+    if compression not in EXPORT_COMPRESSIONS:
+        return jsonify({"error": f"compression must be one of {', '.join(EXPORT_COMPRESSIONS)}."}), 400
+    try:
+        # zstd needs an optional package; fail here rather than halfway through the download
+        check_compression(compression)
+        filters = {
+            'guild_id': request.args.get('guild_id', type=int),
+            'channel_id': request.args.get('channel_id', type=int),
+            'since': datetime.fromisoformat(request.args['since']) if request.args.get('since') else None,
+            'until': datetime.fromisoformat(request.args['until']) if request.args.get('until') else None,
+        }
+        # Validate filters before the response starts streaming
+        build_export_query(table, **filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    filename = f"{table}{export_file_extension(compression)}"
+    return Response(stream_export(table, compression=compression, **filters),
+                    mimetype='application/octet-stream',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# --- JSON API ---
+
+@web.route('/api/v1/<resource>')
+@requires_auth
+@conditional(archive_version)
+def api_list(resource):
+    """
+    Lists messages, attachments or app_logs, newest first. Query parameters:
+    fields (comma separated columns), limit, order (asc/desc), cursor (from
+    next_cursor) and per-resource filters (see archive_api.API_RESOURCES).
+    """
+    if resource not in API_RESOURCES:
+        return jsonify({"error": f"Unknown resource '{resource}'."}), 404
+    try:
+        with SessionLocal() as db:
+            return jsonify(fetch_api_page(db, resource, request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
 # --- Application Logs Route ---
 
-@app.route('/applogs')
+def load_app_log_filters():
+    """Distinct levels and event types for the app log filter dropdowns."""
+    with SessionLocal() as db:
+        return {
+            "levels": [row[0] for row in db.query(AppLog.level).distinct()],
+            "event_types": [row[0] for row in db.query(AppLog.event_type).distinct()],
+        }
+
+app_log_filters_cache = SharedRefreshingCache(shared_store, "app-log-filters", load_app_log_filters, ttl=float(os.getenv('APP_LOG_FILTERS_CACHE_TTL', 300)))
+
+@web.route('/applogs')
 @requires_auth
+@conditional(lambda: archive_version()[2])
 def view_app_logs():
-    db = SessionLocalWeb()
+    db = SessionLocal()
     try:
         # Filtering
         level = request.args.get('level', '')
@@ -486,12 +805,11 @@ def view_app_logs():
         logs = query.order_by(AppLog.timestamp.desc()).offset(offset).limit(per_page).all()
         total_pages = (total + per_page - 1) // per_page
 
-        all_levels = [row[0] for row in db.query(AppLog.level).distinct()]
-        all_event_types = [row[0] for row in db.query(AppLog.event_type).distinct()]
-
     finally:
         db.close()
 
+    filters = app_log_filters_cache.get()
+
     return render_template(
         'applogs.html',
         logs=logs,
@@ -502,14 +820,15 @@ def view_app_logs():
         level=level,
         event_type=event_type,
         search=search,
-        all_levels=all_levels,
-        all_event_types=all_event_types,
+        all_levels=filters["levels"],
+        all_event_types=filters["event_types"],
         json=json
     )
 
 # --- Run the App ---
 if __name__ == '__main__':
+    # Development server only; in production run `gunicorn -c gunicorn.conf.py`
     # Make sure tables exist before running the web app
     # You might run `python database.py` first
     print("Ensure database tables are created by running 'python database.py' or 'python archive.py' first.")
-    app.run(debug=True, host='0.0.0.0', port=8080) 
+    create_app().run(debug=os.getenv('FLASK_DEBUG', 'false').lower() == 'true', host='0.0.0.0', port=8080)